@@ -0,0 +1,51 @@
+"""Measures the import time of each mobilipy module in fresh interpreters and fails when one is over budget.
+
+Usage:
+    python benchmarks/import_time.py --repeat 5 --budget 1.5
+
+Heavy dependencies (sklearn, skfuzzy, shapely, folium, osmium) are loaded on first use, so importing a module should only cost numpy, pandas and numba.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+MODULES = ['mobilipy.preparation', 'mobilipy.segmentation', 'mobilipy.mode_detection', 'mobilipy.legs',
+           'mobilipy.poi_detection', 'mobilipy.privacy', 'mobilipy.gtfs_helper', 'mobilipy.map_matching', 'mobilipy.plot', 'mobilipy.reva']
+
+BUDGET_S = 1.5
+"""Largest accepted median import time of a module, in seconds"""
+
+
+def import_time(module) -> float:
+    """Imports a module in a fresh interpreter
+
+    Args:
+        module (str): Name of the module
+
+    Returns:
+        float: Seconds spent importing it, interpreter startup excluded
+    """
+    code = 'import time; start = time.perf_counter(); import {}; print(time.perf_counter() - start)'.format(module)
+    return float(subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per module')
+    parser.add_argument('--budget', type=float, default=BUDGET_S, help='largest accepted median, in seconds')
+    arguments = parser.parse_args()
+
+    over_budget = []
+    for module in MODULES:
+        median = statistics.median(import_time(module) for _ in range(arguments.repeat))
+        print('{:<26} {:.3f} s'.format(module, median))
+        if median > arguments.budget:
+            over_budget.append(module)
+
+    if over_budget:
+        print('over budget ({} s): {}'.format(arguments.budget, ', '.join(over_budget)))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Measures the throughput of map matching on a synthetic street grid: legs matched per minute on one core, and the error of the matched lengths.
+
+Usage:
+    python benchmarks/map_matching.py --legs 2000 --grid 30
+
+The first legs are matched once beforehand so that numba compilation isn't measured. Pass --graph to match against a GeoJSON or PBF extract instead, the legs then being random walks on its roads.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from mobilipy import map_matching, synthetic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--legs', type=int, default=2000)
+    parser.add_argument('--edges-per-leg', type=int, default=20)
+    parser.add_argument('--grid', type=int, default=30, help='streets in each direction of the synthetic grid')
+    parser.add_argument('--graph', help='GeoJSON or PBF file to be used instead of the grid')
+    parser.add_argument('--noise', type=float, default=5, help='standard deviation of the GPS noise, in meters')
+    arguments = parser.parse_args()
+
+    start = time.perf_counter()
+    if arguments.graph:
+        graph = map_matching.read_road_graph(arguments.graph)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'grid.geojson')
+            synthetic.write_road_network(path, size=arguments.grid)
+            graph = map_matching.read_road_graph(path, cache=False)
+    graph.edge_index
+    print('graph        {} nodes, {} edges, {:.2f} s'.format(graph.n_nodes, graph.n_edges, time.perf_counter() - start))
+
+    legs, lengths = synthetic.generate_road_legs(graph, arguments.legs, arguments.edges_per_leg, noise_m=arguments.noise, return_truth=True)
+    matcher = map_matching.MapMatcher(graph)
+    matcher.match_legs(legs.iloc[:10])
+
+    start = time.perf_counter()
+    matched = matcher.match_legs(legs)
+    elapsed = time.perf_counter() - start
+    errors = np.abs(matched.length.values - lengths[matched.index.values])
+    print('matching     {:>8.0f} legs/min {:>8.0f} points/s ({} legs, {:.2f} s)'.format(
+        len(matched) / elapsed * 60, matched.points.sum() / elapsed, len(matched), elapsed))
+    print('length error median {:.1f} m, 90th percentile {:.1f} m, {} breaks'.format(
+        np.median(errors), np.percentile(errors, 90), matched.breaks.sum()))
+
+
+if __name__ == '__main__':
+    main()
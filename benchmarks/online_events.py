@@ -0,0 +1,56 @@
+"""Measures the throughput of the online detector on one event loop: points ingested and events emitted per second.
+
+Usage:
+    python benchmarks/online_events.py --users 100 --days 1
+
+Points of all the users are submitted interleaved in time order, as they would arrive from live devices, and then again as one concurrent stream per user.
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+from mobilipy import online, synthetic
+
+
+async def _interleaved(data):
+    """Submits every point in time order and returns the number of events"""
+    events = []
+    detector = online.AsyncStreamDetector(on_event=events.append)
+    seconds = data.tracked_at.values.astype('datetime64[ns]').astype(np.int64) / 1e9
+    for user_id, timestamp, latitude, longitude in zip(data.user_id.values, seconds.tolist(), data.latitude.values.tolist(), data.longitude.values.tolist()):
+        await detector.submit(user_id, timestamp, latitude, longitude)
+    await detector.close()
+    return len(events)
+
+async def _concurrent(data):
+    """Consumes one stream per user concurrently and returns the number of events"""
+    events = []
+    detector = online.AsyncStreamDetector(on_event=events.append)
+    streams = {}
+    for user_id, user_data in data.groupby('user_id', sort=False):
+        seconds = user_data.tracked_at.values.astype('datetime64[ns]').astype(np.int64) / 1e9
+        streams[user_id] = list(zip(seconds.tolist(), user_data.latitude.values.tolist(), user_data.longitude.values.tolist()))
+    await detector.ingest_all(streams)
+    return len(events)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--sampling-interval', type=float, default=10, help='seconds between two waypoints')
+    arguments = parser.parse_args()
+
+    data = synthetic.generate(users=arguments.users, days=arguments.days, sampling_interval=arguments.sampling_interval)
+    data = data.sort_values('tracked_at', kind='stable')
+    for name, run in (('interleaved', _interleaved), ('concurrent', _concurrent)):
+        start = time.perf_counter()
+        n_events = asyncio.run(run(data))
+        elapsed = time.perf_counter() - start
+        print('{:<12} {:>10.0f} points/s {:>8.0f} events/s ({} points, {} events, {:.2f} s)'.format(
+            name, len(data) / elapsed, n_events / elapsed, len(data), n_events, elapsed))
+
+
+if __name__ == '__main__':
+    main()
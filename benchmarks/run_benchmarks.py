@@ -0,0 +1,135 @@
+"""Times and memory-profiles the public entry points of mobilipy on synthetic data, and checks that the serial and multiprocessing paths give the same outputs.
+
+Usage:
+    python benchmarks/run_benchmarks.py --sizes 1e4 1e5 1e6 --output results.json
+    python benchmarks/run_benchmarks.py --sizes 1e4 --parity
+
+Each size is a number of waypoints. The per-user stages run user after user, and their times are summed.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from mobilipy import execution, instrumentation, legs, mode_detection, poi_detection, preparation, privacy, segmentation, synthetic
+from mobilipy.gtfs_helper import GTFS_Helper
+from mobilipy.waypointsdataframe import WaypointsDataFrame
+
+
+def _measure(name, func, *args, **kwargs):
+    """Runs func inside a benchmark span, adding the peak of Python allocations when tracemalloc is tracing"""
+    with instrumentation.span('benchmark.' + name) as step:
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        result = func(*args, **kwargs)
+        if tracemalloc.is_tracing():
+            step.set(python_peak_bytes=tracemalloc.get_traced_memory()[1])
+    return result
+
+def run_size(n_points, sampling_interval, memory, seed=0):
+    """Runs every entry point on about n_points waypoints
+
+    Returns:
+        pandas.DataFrame: One row per entry point, with summed wall and CPU times and the largest peaks
+    """
+    data = synthetic.generate_points(n_points, sampling_interval=sampling_interval, seed=seed)
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic.write_gtfs(directory, seed=seed)
+        if memory:
+            tracemalloc.start()
+        with instrumentation.Recorder() as recorder:
+            waypoints = _measure('WaypointsDataFrame', WaypointsDataFrame, data)
+            gtfs = _measure('GTFS_Helper', lambda: GTFS_Helper(directory).connections)
+            for user_id, user_waypoints in waypoints.groupby('user_id', sort=False):
+                prepared = _measure('prepare', preparation.prepare, user_waypoints)
+                segments = _measure('segment', segmentation.segment, prepared, use_multiprocessing=False)
+                segments = _measure('mode_detection', mode_detection.mode_detection, segments, use_multiprocessing=False)
+                user_legs = _measure('get_user_legs', legs.get_user_legs, segments, user_id, use_multiprocessing=False)
+                home, work = _measure('detect_home_work', poi_detection.detect_home_work, user_legs, prepared)
+                locations = [location for location in (home, work) if location is not None]
+                if locations:
+                    _measure('obfuscate', privacy.obfuscate, prepared, locations)
+                _measure('aggregate', privacy.aggregate, prepared)
+        if memory:
+            tracemalloc.stop()
+
+    records = recorder.to_dataframe()
+    records = records[records.depth == 0]
+    aggregations = {'wall_s': 'sum', 'cpu_s': 'sum', 'rss_delta_bytes': 'max', 'process_peak_rss_bytes': 'max'}
+    if memory:
+        aggregations['python_peak_bytes'] = 'max'
+    result = records.groupby('name', sort=False).agg(aggregations).reset_index()
+    result['name'] = result.name.str.replace('benchmark.', '', regex=False)
+    result.insert(0, 'points', len(data))
+    result['points_per_s'] = len(data) / result.wall_s
+    return result
+
+def _same(left, right) -> bool:
+    """Compares two DataFrames, geometries included"""
+    if left.shape != right.shape or list(left.columns) != list(right.columns):
+        return False
+    for column in left.columns:
+        if column == 'geometry':
+            if not all(np.allclose(a, b) for a, b in zip(left[column], right[column])):
+                return False
+        elif not left[column].equals(right[column]):
+            return False
+    return True
+
+def check_parity(n_points, sampling_interval, seed=0):
+    """Runs segment, mode_detection and get_user_legs serially and in worker processes on the first user. Workers are started with the start method of the execution module.
+
+    Returns:
+        dict: Whether the outputs of each stage are the same
+    """
+    data = synthetic.generate_points(n_points, sampling_interval=sampling_interval, seed=seed)
+    user_id = data.user_id.iloc[0]
+    prepared = preparation.prepare(WaypointsDataFrame(data[data.user_id == user_id]))
+
+    outputs = {}
+    for use_multiprocessing in (execution.SERIAL, execution.PROCESSES):
+        segments = segmentation.segment(prepared.copy(), use_multiprocessing=use_multiprocessing)
+        modes = mode_detection.mode_detection(segments.copy(), use_multiprocessing=use_multiprocessing)
+        user_legs = legs.get_user_legs(modes, user_id, use_multiprocessing=use_multiprocessing)
+        outputs[use_multiprocessing] = (segments, modes, user_legs)
+
+    return {stage: _same(serial, parallel)
+            for stage, serial, parallel in zip(('segment', 'mode_detection', 'get_user_legs'), outputs[execution.SERIAL], outputs[execution.PROCESSES])}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', type=float, default=[1e4, 1e5], help='numbers of waypoints, from 1e4 to 1e8')
+    parser.add_argument('--sampling-interval', type=float, default=10, help='seconds between two waypoints')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, which slows the stages down')
+    parser.add_argument('--parity', action='store_true', help='check serial and multiprocessing outputs')
+    parser.add_argument('--output', help='JSON file where the results are written')
+    arguments = parser.parse_args()
+
+    results = []
+    for size in arguments.sizes:
+        start = time.perf_counter()
+        result = run_size(int(size), arguments.sampling_interval, not arguments.no_memory)
+        print(result.to_string(index=False))
+        print('{:.0f} points in {:.1f} s\n'.format(size, time.perf_counter() - start))
+        results.append(result)
+
+    report = {'results': pd.concat(results, ignore_index=True).to_dict(orient='records')}
+    if arguments.parity:
+        report['parity'] = check_parity(int(arguments.sizes[0]), arguments.sampling_interval)
+        print('parity:', report['parity'])
+
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=2, default=str)
+
+    if arguments.parity and not all(report.get('parity', {}).values()):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
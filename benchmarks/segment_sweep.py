@@ -0,0 +1,58 @@
+"""Compares segment_sweep with a loop calling segment for every combination of parameters, on synthetic days of one user, and checks that both give the same segments.
+
+Usage:
+    python benchmarks/segment_sweep.py --days 5 --radii 0.015 0.025 0.04 --min-samples 20 35 50 80 --time-gaps 600 850
+
+Both run serially and are compiled beforehand. The best of --repeat runs is reported.
+"""
+import argparse
+import time
+
+from mobilipy import preparation, segmentation, synthetic
+from mobilipy.waypointsdataframe import WaypointsDataFrame
+
+
+def _best_time(func, repeat):
+    """Returns the result of the last run and the shortest time of func over repeat runs"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--sampling-interval', type=float, default=10, help='seconds between two waypoints')
+    parser.add_argument('--radii', nargs='+', type=float, default=[0.015, 0.025, 0.04], help='in km')
+    parser.add_argument('--min-samples', nargs='+', type=int, default=[20, 35, 50, 80])
+    parser.add_argument('--time-gaps', nargs='+', type=float, default=[600, 850], help='in seconds')
+    parser.add_argument('--repeat', type=int, default=3)
+    arguments = parser.parse_args()
+
+    data = synthetic.generate_user('user_0', days=arguments.days, sampling_interval=arguments.sampling_interval)
+    prepared = preparation.prepare(WaypointsDataFrame(data))
+    combinations = [(radius, samples, time_gap) for radius in arguments.radii
+                    for samples in arguments.min_samples for time_gap in arguments.time_gaps]
+    print('data         {} waypoints, {} days, {} combinations'.format(len(prepared), arguments.days, len(combinations)))
+
+    segmentation.segment_sweep(prepared, arguments.radii[:2], arguments.min_samples[:1], arguments.time_gaps[:1], use_multiprocessing=False)
+    segmentation.segment(prepared.copy(), use_multiprocessing=False)
+
+    (_, swept), sweep_s = _best_time(lambda: segmentation.segment_sweep(
+        prepared, arguments.radii, arguments.min_samples, arguments.time_gaps, use_multiprocessing=False, return_segments=True), arguments.repeat)
+    looped, loop_s = _best_time(lambda: {
+        (radius, samples, time_gap): segmentation.segment(prepared.copy(), radius, samples, time_gap, use_multiprocessing=False)
+        for radius, samples, time_gap in combinations}, arguments.repeat)
+
+    different = sum(not looped[combination].equals(swept[combination]) for combination in combinations)
+    print('sweep        {:.2f} s'.format(sweep_s))
+    print('loop         {:.2f} s, {:.2f}x the sweep'.format(loop_s, loop_s / sweep_s))
+    print('different    {} of {} combinations'.format(different, len(combinations)))
+    if different:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
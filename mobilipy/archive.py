@@ -0,0 +1,368 @@
+import os
+import json
+import mmap
+import zlib
+import struct
+import numpy as np
+import pandas as pd
+
+MAGIC = b'MOBILIPY-ARCHIVE-1'
+"""Last bytes of an archive file, preceded by the offset of its index"""
+
+PRECISION = 1e-6
+"""Default quantization step of the coordinates, in degrees (about 11 cm)"""
+
+TIME_PRECISION = 1
+"""Default quantization step of the timestamps, in seconds"""
+
+ACCURACY_PRECISION = 1
+"""Quantization step of the accuracy column, in meters"""
+
+BLOCK_SIZE = 65536
+"""Largest number of waypoints in a block, a day with more waypoints is split into several blocks"""
+
+COMPRESSION_LEVEL = 6
+"""zlib compression level of the blocks"""
+
+LABELS = ['type', 'detected_mode', 'purpose']
+"""String columns of the legs, stored as JSON in their block"""
+
+_DAY_NS = 86400 * 10**9
+_INTEGER_TYPES = [np.dtype('<i1'), np.dtype('<i2'), np.dtype('<i4'), np.dtype('<i8')]
+
+
+def _nanoseconds(timestamps) -> np.ndarray:
+    """Converts timestamps to nanoseconds since the epoch in UTC. Naive timestamps are assumed to be in UTC."""
+    return pd.DatetimeIndex(pd.to_datetime(pd.Series(timestamps), utc=True)).asi8
+
+def _day(day) -> str:
+    """Formats a day given as a string, date or timestamp as 'YYYY-MM-DD'"""
+    return pd.Timestamp(day).strftime('%Y-%m-%d')
+
+def _encode(name, values, delta):
+    """Encodes an integer column with the narrowest integer type holding its values, or the differences between consecutive values if delta is True.
+
+    Args:
+        name (str): Name of the column
+        values (numpy.ndarray): int64 values
+        delta (bool): Specifies whether the differences should be stored
+
+    Returns:
+        (list, bytes): Specification of the column (name, dtype, first value, delta) and its bytes
+    """
+    first = int(values[0]) if delta and values.shape[0] else 0
+    stored = np.diff(values) if delta else values
+    dtype = _INTEGER_TYPES[-1]
+    if stored.shape[0]:
+        low, high = stored.min(), stored.max()
+        dtype = next(candidate for candidate in _INTEGER_TYPES
+                     if np.iinfo(candidate).min <= low and high <= np.iinfo(candidate).max)
+    return [name, dtype.str, first, delta], stored.astype(dtype).tobytes()
+
+def _decode(spec, raw, position, n, out):
+    """Decodes a column written by _encode into out.
+
+    Args:
+        spec (list): Specification of the column
+        raw (bytes): Decompressed block
+        position (int): Position of the column in raw
+        n (int): Number of values
+        out (numpy.ndarray): int64 array of length n
+
+    Returns:
+        int: Position after the column
+    """
+    _, dtype, first, delta = spec
+    dtype = np.dtype(dtype)
+    count = n - 1 if delta and n else n
+    stored = np.frombuffer(raw, dtype=dtype, count=count, offset=position)
+    if delta and n:
+        out[0] = first
+        np.cumsum(stored, dtype=np.int64, out=out[1:])
+        out[1:] += first
+    else:
+        out[:] = stored
+    return position + count * dtype.itemsize
+
+
+class ArchiveWriter:
+    """Writes waypoints and legs to an archive file. Timestamps and coordinates are quantized and delta-encoded into compressed integer blocks of one user and one day, and an index of the blocks is written at the end of the file for random access by user and day. The file is written under a temporary name and only appears once closed.
+    """
+    def __init__(self, path, precision=PRECISION, time_precision=TIME_PRECISION, block_size=BLOCK_SIZE, compression=COMPRESSION_LEVEL):
+        """Creates the archive.
+
+        Args:
+            path (str): Path of the archive file
+            precision (float, optional): Quantization step of the coordinates in degrees, 1 / precision is rounded to an integer. Defaults to PRECISION.
+            time_precision (float, optional): Quantization step of the timestamps in seconds. Defaults to TIME_PRECISION.
+            block_size (int, optional): Largest number of waypoints in a block. Defaults to BLOCK_SIZE.
+            compression (int, optional): zlib compression level. Defaults to COMPRESSION_LEVEL.
+        """
+        self.path = path
+        self.scale = int(round(1 / precision))
+        """Quantized coordinate units per degree"""
+        self.time_unit = int(round(time_precision * 10**9))
+        """Quantization step of the timestamps, in nanoseconds"""
+        self.block_size = block_size
+        self.compression = compression
+        self.blocks = []
+        """Index entries of the blocks written so far"""
+        self._temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        self._file = open(self._temporary_path, 'wb')
+
+    def _write_block(self, user_id, day, kind, n, times, columns, extra=b''):
+        """Compresses and writes one block, and adds it to the index"""
+        specs, parts = zip(*columns)
+        data = zlib.compress(b''.join(parts) + extra, self.compression)
+        self.blocks.append({'user_id': user_id, 'day': day, 'kind': kind, 'n': n,
+                            'started_at': int(times[0]) * self.time_unit, 'finished_at': int(times[-1]) * self.time_unit,
+                            'offset': self._file.tell(), 'nbytes': len(data), 'columns': list(specs), 'extra': len(extra)})
+        self._file.write(data)
+
+    def _quantize(self, degrees) -> np.ndarray:
+        return np.round(np.asarray(degrees, dtype=np.float64) * self.scale).astype(np.int64)
+
+    def write_waypoints(self, df):
+        """Adds waypoints to the archive, one block per user and day, in the order of the DataFrame.
+
+        Args:
+            df (pandas.DataFrame): Waypoints with tracked_at, latitude, longitude and user_id columns, and optionally accuracy and weight columns
+        """
+        if df.shape[0] == 0:
+            return
+        nanoseconds = _nanoseconds(df.tracked_at)
+        times = nanoseconds // self.time_unit
+        latitudes = self._quantize(df.latitude.values)
+        longitudes = self._quantize(df.longitude.values)
+        optional = []
+        if 'accuracy' in df.columns:
+            optional.append(('accuracy', np.round(df.accuracy.values.astype(np.float64) / ACCURACY_PRECISION).astype(np.int64), False))
+        if 'weight' in df.columns:
+            optional.append(('weight', df.weight.values.astype(np.int64), False))
+        user_ids = df.user_id.values if 'user_id' in df.columns else np.zeros(df.shape[0], dtype=np.int64)
+
+        groups = pd.DataFrame({'user_id': user_ids, 'day': nanoseconds // _DAY_NS}).groupby(['user_id', 'day'], sort=False).indices
+        for (user_id, day), positions in groups.items():
+            day = pd.Timestamp(int(day) * _DAY_NS).strftime('%Y-%m-%d')
+            user_id = user_id.item() if isinstance(user_id, np.generic) else user_id
+            for start in range(0, positions.shape[0], self.block_size):
+                block = positions[start:start + self.block_size]
+                columns = [_encode('tracked_at', times[block], True),
+                           _encode('latitude', latitudes[block], True),
+                           _encode('longitude', longitudes[block], True)]
+                columns += [_encode(name, values[block], False) for name, values, _ in optional]
+                self._write_block(user_id, day, 'waypoints', block.shape[0], times[block], columns)
+
+    def write_legs(self, legs):
+        """Adds legs to the archive, one block per user and day of their start.
+
+        Args:
+            legs (pandas.DataFrame): Legs coming from legs.get_user_legs
+        """
+        if legs.shape[0] == 0:
+            return
+        starts = _nanoseconds(legs.started_at)
+        ends = _nanoseconds(legs.finished_at)
+        groups = pd.DataFrame({'user_id': legs.user_id.values, 'day': starts // _DAY_NS}).groupby(['user_id', 'day'], sort=False).indices
+        for (user_id, day), positions in groups.items():
+            day = pd.Timestamp(int(day) * _DAY_NS).strftime('%Y-%m-%d')
+            user_id = user_id.item() if isinstance(user_id, np.generic) else user_id
+            geometries = [np.asarray(legs.geometry.values[position], dtype=np.float64).reshape(-1, 2) for position in positions]
+            points = np.concatenate(geometries)
+            labels = {label: [None if pd.isna(value) else value for value in legs[label].values[positions]]
+                      for label in LABELS if label in legs.columns}
+            columns = [_encode('started_at', starts[positions] // self.time_unit, True),
+                       _encode('finished_at', ends[positions] // self.time_unit, True),
+                       _encode('points', np.array([geometry.shape[0] for geometry in geometries], dtype=np.int64), False),
+                       _encode('latitude', self._quantize(points[:, 0]), True),
+                       _encode('longitude', self._quantize(points[:, 1]), True)]
+            self._write_block(user_id, day, 'legs', positions.shape[0], starts[positions] // self.time_unit,
+                              columns, json.dumps(labels).encode())
+
+    def close(self):
+        """Writes the index and moves the file to its final path"""
+        if self._file.closed:
+            return
+        offset = self._file.tell()
+        header = {'scale': self.scale, 'time_unit': self.time_unit, 'blocks': self.blocks}
+        self._file.write(zlib.compress(json.dumps(header).encode(), self.compression))
+        self._file.write(struct.pack('<Q', offset) + MAGIC)
+        self._file.close()
+        os.replace(self._temporary_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._temporary_path)
+
+
+class Archive:
+    """Reads an archive written by ArchiveWriter. The file is memory-mapped and only the blocks of the requested users and days are decompressed, straight into the arrays of the returned DataFrames.
+    """
+    def __init__(self, path):
+        """Opens the archive and reads its index.
+
+        Args:
+            path (str): Path of the archive file
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        footer = len(MAGIC) + 8
+        if len(self._map) < footer or self._map[-len(MAGIC):] != MAGIC:
+            self.close()
+            raise ValueError('{} is not a mobilipy archive'.format(path))
+        offset, = struct.unpack('<Q', self._map[-footer:-len(MAGIC)])
+        header = json.loads(zlib.decompress(self._map[offset:-footer]))
+        self.scale = header['scale']
+        """Quantized coordinate units per degree"""
+        self.time_unit = header['time_unit']
+        """Quantization step of the timestamps, in nanoseconds"""
+        self.blocks = header['blocks']
+        """Index entries of the blocks, in the order they were written"""
+        self._blocks = {}
+        for block in self.blocks:
+            self._blocks.setdefault((block['kind'], block['user_id'], block['day']), []).append(block)
+
+    @property
+    def index(self) -> pd.DataFrame:
+        """pandas.DataFrame: One row per block, with its user_id, day, kind, number of rows, time span and compressed size"""
+        index = pd.DataFrame(self.blocks, columns=['user_id', 'day', 'kind', 'n', 'started_at', 'finished_at', 'nbytes'])
+        index['started_at'] = pd.to_datetime(index.started_at, utc=True)
+        index['finished_at'] = pd.to_datetime(index.finished_at, utc=True)
+        return index
+
+    def users(self) -> list:
+        """Returns the users in the archive, in the order they were written"""
+        return list(dict.fromkeys(block['user_id'] for block in self.blocks))
+
+    def days(self, user_id, kind='waypoints') -> list:
+        """Returns the days of a user, as 'YYYY-MM-DD' strings
+
+        Args:
+            user_id (object): User ID
+            kind (str, optional): 'waypoints' or 'legs'. Defaults to 'waypoints'.
+        """
+        return sorted({day for block_kind, user, day in self._blocks if block_kind == kind and user == user_id})
+
+    def _select(self, kind, user_id, days):
+        """Returns the index entries of a user and some days, all of them if days is None"""
+        days = self.days(user_id, kind) if days is None else [_day(day) for day in ([days] if isinstance(days, str) else days)]
+        return [block for day in days for block in self._blocks.get((kind, user_id, day), [])]
+
+    def _decompress(self, block) -> bytes:
+        return zlib.decompress(self._map[block['offset']:block['offset'] + block['nbytes']])
+
+    def read_arrays(self, user_id, days=None) -> dict:
+        """Decodes the waypoints of a user into numpy arrays, block by block into preallocated arrays.
+
+        Args:
+            user_id (object): User ID
+            days (list, optional): Days to be read, as strings, dates or timestamps. Defaults to None, reading all the days.
+
+        Returns:
+            dict: 'tracked_at' as int64 nanoseconds since the epoch, 'latitude' and 'longitude' as float64 degrees, and 'accuracy' and 'weight' if they were written
+        """
+        blocks = self._select('waypoints', user_id, days)
+        total = sum(block['n'] for block in blocks)
+        names = list(dict.fromkeys(spec[0] for block in blocks for spec in block['columns']))
+        quantized = {name: np.empty(total, dtype=np.int64) for name in names}
+        start = 0
+        for block in blocks:
+            raw = self._decompress(block)
+            position = 0
+            for spec in block['columns']:
+                position = _decode(spec, raw, position, block['n'], quantized[spec[0]][start:start + block['n']])
+            start += block['n']
+
+        arrays = {'tracked_at': quantized.pop('tracked_at', np.empty(0, dtype=np.int64)) * self.time_unit,
+                  'latitude': quantized.pop('latitude', np.empty(0, dtype=np.int64)) / self.scale,
+                  'longitude': quantized.pop('longitude', np.empty(0, dtype=np.int64)) / self.scale}
+        if 'accuracy' in quantized:
+            arrays['accuracy'] = quantized['accuracy'] * float(ACCURACY_PRECISION)
+        if 'weight' in quantized:
+            arrays['weight'] = quantized['weight']
+        return arrays
+
+    def read_waypoints(self, user_id, days=None) -> pd.DataFrame:
+        """Reads the waypoints of a user, in the format of a WaypointsDataFrame, ready for preparation.prepare
+
+        Args:
+            user_id (object): User ID
+            days (list, optional): Days to be read, as strings, dates or timestamps. Defaults to None, reading all the days.
+
+        Returns:
+            pandas.DataFrame: Waypoints with tracked_at, latitude, longitude and user_id columns, and accuracy and weight if they were written
+        """
+        arrays = self.read_arrays(user_id, days)
+        res = pd.DataFrame({'tracked_at': pd.to_datetime(arrays.pop('tracked_at'), utc=True),
+                            'longitude': arrays.pop('longitude'),
+                            'latitude': arrays.pop('latitude')})
+        res['user_id'] = user_id
+        for name, values in arrays.items():
+            res[name] = values
+        return res
+
+    def read_legs(self, user_id, days=None) -> pd.DataFrame:
+        """Reads the legs of a user
+
+        Args:
+            user_id (object): User ID
+            days (list, optional): Days to be read, as strings, dates or timestamps. Defaults to None, reading all the days.
+
+        Returns:
+            pandas.DataFrame: Legs in the format of legs.get_user_legs, with geometries as lists of (latitude, longitude)
+        """
+        rows = []
+        for block in self._select('legs', user_id, days):
+            raw = self._decompress(block)
+            n = block['n']
+            columns = {}
+            position = 0
+            for spec in block['columns']:
+                count = sum(columns['points']) if spec[0] in ('latitude', 'longitude') else n
+                columns[spec[0]] = np.empty(count, dtype=np.int64)
+                position = _decode(spec, raw, position, count, columns[spec[0]])
+            labels = json.loads(raw[position:position + block['extra']])
+            bounds = np.concatenate(([0], np.cumsum(columns['points'])))
+            coordinates = np.column_stack((columns['latitude'] / self.scale, columns['longitude'] / self.scale))
+            for i in range(n):
+                rows.append((user_id, columns['started_at'][i] * self.time_unit, columns['finished_at'][i] * self.time_unit,
+                             *[labels.get(label, [None] * n)[i] for label in LABELS],
+                             [tuple(point) for point in coordinates[bounds[i]:bounds[i + 1]].tolist()]))
+
+        res = pd.DataFrame(rows, columns=['user_id', 'started_at', 'finished_at', *LABELS, 'geometry'])
+        res['started_at'] = pd.to_datetime(res.started_at.astype(np.int64), utc=True)
+        res['finished_at'] = pd.to_datetime(res.finished_at.astype(np.int64), utc=True)
+        return res
+
+    def close(self):
+        """Releases the memory map and the file"""
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write(path, waypoints, legs=None, **kwargs):
+    """Writes waypoints, and optionally legs, to a new archive file
+
+    Args:
+        path (str): Path of the archive file
+        waypoints (pandas.DataFrame): Waypoints with tracked_at, latitude, longitude and user_id columns
+        legs (pandas.DataFrame, optional): Legs coming from legs.get_user_legs. Defaults to None.
+        **kwargs: Parameters of ArchiveWriter, e.g. precision
+    """
+    with ArchiveWriter(path, **kwargs) as writer:
+        writer.write_waypoints(waypoints)
+        if legs is not None:
+            writer.write_legs(legs)
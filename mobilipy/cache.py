@@ -0,0 +1,185 @@
+import os
+import json
+import inspect
+import hashlib
+import pandas as pd
+
+MAX_BYTES = 2 * 1024 ** 3
+"""Default size bound of the cache directory, in bytes"""
+
+IGNORED_PARAMETERS = ('use_multiprocessing',)
+"""Parameters that don't change the output of a stage and are left out of its key"""
+
+
+def fingerprint(df) -> str:
+    """Returns a fingerprint of the content of a DataFrame: its columns, dtypes, index and values.
+
+    Args:
+        df (pandas.DataFrame): DataFrame to be fingerprinted
+
+    Returns:
+        str: Hexadecimal digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr([(str(column), str(dtype)) for column, dtype in df.dtypes.items()]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()
+
+def _parameter_token(value):
+    """Turns a stage parameter into a JSON-serializable value. Objects, such as a GTFS_Helper, are represented by their class, their simple attributes and the value of their cache_token method if they have one, so that their key stays the same across runs but changes with the data they read.
+
+    Args:
+        value (object): Parameter value
+
+    Returns:
+        object: JSON-serializable value
+    """
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_parameter_token(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _parameter_token(item) for key, item in value.items()}
+    attributes = getattr(value, '__dict__', {})
+    token = [type(value).__name__, {key: item for key, item in attributes.items()
+                                    if not key.startswith('_') and (isinstance(item, (str, int, float, bool)) or item is None)}]
+    if callable(getattr(value, 'cache_token', None)):
+        token.append(_parameter_token(value.cache_token()))
+    return token
+
+def _stage_parameters(func, parameters) -> dict:
+    """Returns the parameters a stage function is called with, including its defaults, except the first one which is the input DataFrame
+
+    Args:
+        func (callable): Stage function
+        parameters (dict): Keyword arguments given to the stage
+
+    Returns:
+        dict: All parameters of the call
+    """
+    bound = inspect.signature(func).bind(None, **parameters)
+    bound.apply_defaults()
+    arguments = dict(list(bound.arguments.items())[1:])
+    return {key: value for key, value in arguments.items() if key not in IGNORED_PARAMETERS}
+
+
+class StageCache:
+    """On-disk cache of the outputs of the pipeline stages, stored as Parquet files. The key of a stage's output is derived from the key of its input and its parameters, so that changing a parameter only recomputes the stages downstream of it. The directory is bounded in size, least recently used outputs being evicted first.
+    """
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        """Creates the cache.
+
+        Args:
+            directory (str): Directory where the stage outputs are stored
+            max_bytes (int, optional): Size bound of the directory. Defaults to MAX_BYTES.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        """Number of stage outputs read from the cache"""
+        self.misses = 0
+        """Number of stage outputs computed"""
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, stage, input_key, parameters) -> str:
+        """Returns the key of a stage's output.
+
+        Args:
+            stage (str): Name of the stage
+            input_key (str): Fingerprint of the input DataFrame or key of the stage that produced it
+            parameters (dict): Parameters of the stage
+
+        Returns:
+            str: Hexadecimal key
+        """
+        description = json.dumps([stage, input_key, _parameter_token(parameters)], sort_keys=True)
+        return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+    def _path(self, key) -> str:
+        return os.path.join(self.directory, key + '.parquet')
+
+    def get(self, key):
+        """Returns a cached stage output and marks it as recently used.
+
+        Args:
+            key (str): Key of the stage output
+
+        Returns:
+            pandas.DataFrame: Cached DataFrame, or None if it's not in the cache
+        """
+        path = self._path(key)
+        try:
+            df = pd.read_parquet(path)
+            os.utime(path)
+        except (FileNotFoundError, OSError):
+            return None
+        return df
+
+    def put(self, key, df):
+        """Stores a stage output, then evicts the least recently used outputs if the cache is over its size bound. Outputs that can't be stored as Parquet are not cached.
+
+        Args:
+            key (str): Key of the stage output
+            df (pandas.DataFrame): Stage output
+        """
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            df.to_parquet(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    def _evict(self):
+        """Removes the least recently used outputs until the directory is within its size bound"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.parquet'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def run(self, stage, func, df, input_key=None, **parameters):
+        """Returns the output of a stage, from the cache if its input and parameters were already seen, or by calling func otherwise.
+
+        Args:
+            stage (str): Name of the stage
+            func (callable): Stage function, called as func(df, **parameters)
+            df (pandas.DataFrame): Input of the stage
+            input_key (str, optional): Key of the stage that produced df. Defaults to the fingerprint of df.
+            **parameters: Parameters of the stage
+
+        Returns:
+            (pandas.DataFrame, str): Output of the stage and its key, to be given as input_key to the next stage
+        """
+        if input_key is None:
+            input_key = fingerprint(df)
+        key = self.key(stage, input_key, _stage_parameters(func, parameters))
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return result, key
+        self.misses += 1
+        result = func(df, **parameters)
+        self.put(key, result)
+        return result, key
+
+    def clear(self):
+        """Removes all the stored outputs"""
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.parquet'):
+                os.remove(entry.path)
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import pickle
+import builtins
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+from collections import namedtuple
+import numpy as np
+from mobilipy import instrumentation
+
+AUTO = 'auto'
+SERIAL = 'serial'
+THREADS = 'threads'
+PROCESSES = 'processes'
+POLICIES = (AUTO, SERIAL, THREADS, PROCESSES)
+"""Execution policies accepted by the use_multiprocessing parameter of the stages. True and False stand for 'processes' and 'serial'."""
+
+CALIBRATION_ENVIRONMENT_VARIABLE = 'MOBILIPY_CALIBRATION'
+"""Environment variable giving the path of a calibration written by calibrate, loaded on first use"""
+
+DEFAULT_CALIBRATION = {
+    'costs': {
+        # seconds per row, pickled bytes per row sent to a worker, fraction of the work releasing the GIL
+        'segment.dbscan': {'seconds_per_row': 2.0e-5, 'bytes_per_row': 180, 'gil_free': 0.3},
+        'segment_sweep': {'seconds_per_row': 1.5e-5, 'bytes_per_row': 180, 'gil_free': 0.0},
+        'mode_detection.walks': {'seconds_per_row': 4.0e-5, 'bytes_per_row': 250, 'gil_free': 0.0},
+        'mode_detection.modes': {'seconds_per_row': 1.5e-4, 'bytes_per_row': 250, 'gil_free': 0.0},
+        'get_user_legs': {'seconds_per_row': 2.0e-4, 'bytes_per_row': 250, 'gil_free': 0.0},
+        'analyse': {'seconds_per_row': 4.0e-4, 'bytes_per_row': 60, 'gil_free': 0.1},
+        'render_daily_maps': {'seconds_per_row': 1.0e-4, 'bytes_per_row': 100, 'gil_free': 0.0},
+    },
+    # seconds to start one worker, to dispatch one task, and to pickle, send and unpickle one byte
+    'process_start_s': 0.08,
+    'thread_start_s': 1e-4,
+    'task_s': 2e-4,
+    'byte_s': 2e-9,
+}
+"""Cost model used until calibrate or load_calibration is called. Rough defaults, meant to be refined with calibrate on the machine running the pipeline."""
+
+START_METHOD_ENVIRONMENT_VARIABLE = 'MOBILIPY_START_METHOD'
+"""Environment variable giving the start method of the worker processes, e.g. 'forkserver'"""
+
+START_METHOD = os.environ.get(START_METHOD_ENVIRONMENT_VARIABLE) or None
+"""Start method of the worker processes, None for the platform default (fork on Linux). 'forkserver' or 'spawn' are needed when the caller already ran numba kernels compiled with parallel=True on the TBB threading layer, as such a process hangs at exit once forked. Both re-import the main module in the workers, so scripts then need an if __name__ == '__main__' guard."""
+
+PRELOADED_MODULES = ['mobilipy.reva']
+"""Modules imported once by the fork server when START_METHOD is 'forkserver', so that its workers start without importing the stages"""
+
+Plan = namedtuple('Plan', ['mode', 'workers', 'estimated_s'])
+Plan.__doc__ = """Execution chosen for a stage: mode ('serial', 'threads' or 'processes'), number of workers and estimated wall time in seconds"""
+
+_calibration = None
+
+
+def _active_calibration() -> dict:
+    """Returns the calibration in use, loading the one of CALIBRATION_ENVIRONMENT_VARIABLE on first use"""
+    global _calibration
+    if _calibration is None:
+        path = os.environ.get(CALIBRATION_ENVIRONMENT_VARIABLE)
+        _calibration = load_calibration(path) if path and os.path.exists(path) else DEFAULT_CALIBRATION
+    return _calibration
+
+def load_calibration(path) -> dict:
+    """Makes a calibration written by calibrate the one in use. Stages missing from it keep their default cost.
+
+    Args:
+        path (str): Path of the JSON file
+
+    Returns:
+        dict: Calibration
+    """
+    global _calibration
+    with open(path) as file:
+        loaded = json.load(file)
+    _calibration = {**DEFAULT_CALIBRATION, **loaded, 'costs': {**DEFAULT_CALIBRATION['costs'], **loaded.get('costs', {})}}
+    return _calibration
+
+def max_workers(processes=None) -> int:
+    """Number of workers used at most: processes if given, otherwise the number of CPUs minus one, and at least one
+
+    Args:
+        processes (int, optional): Number of workers requested by the caller. Defaults to None.
+
+    Returns:
+        int: Number of workers
+    """
+    return processes or max((os.cpu_count() or 1) - 1, 1)
+
+def _policy(use_multiprocessing) -> str:
+    """Turns a use_multiprocessing argument into a policy"""
+    if use_multiprocessing is True:
+        return PROCESSES
+    if use_multiprocessing is False or use_multiprocessing is None:
+        return SERIAL
+    assert use_multiprocessing in POLICIES, "use_multiprocessing must be a bool or one of {}".format(', '.join(POLICIES))
+    return use_multiprocessing
+
+def estimate(stage, sizes, mode, workers, payload_bytes=None) -> float:
+    """Estimates the wall time of a stage run over partitions.
+
+    Args:
+        stage (str): Name of the stage, a key of the calibration costs
+        sizes (list(int)): Rows of each partition, one partition being one task
+        mode (str): 'serial', 'threads' or 'processes'
+        workers (int): Number of workers
+        payload_bytes (int, optional): Bytes pickled for the workers, if known. Defaults to the bytes per row of the stage times the rows.
+
+    Returns:
+        float: Estimated seconds
+    """
+    calibration = _active_calibration()
+    cost = calibration['costs'].get(stage, calibration['costs']['analyse'])
+    work = np.asarray(list(sizes), dtype=np.float64) * cost['seconds_per_row']
+    total = work.sum()
+    if mode == SERIAL or work.shape[0] == 0:
+        return float(total)
+    # a task runs on one worker, so the longest task bounds the parallel time
+    parallel = max(total / min(workers, work.shape[0]), work.max())
+    tasks = work.shape[0] * calibration['task_s']
+    if mode == THREADS:
+        return float(calibration['thread_start_s'] * workers + tasks + (1 - cost['gil_free']) * total + cost['gil_free'] * parallel)
+    if payload_bytes is None:
+        payload_bytes = cost['bytes_per_row'] * np.sum(sizes)
+    return float(calibration['process_start_s'] * workers + tasks + calibration['byte_s'] * payload_bytes + parallel)
+
+def plan(stage, sizes, use_multiprocessing=AUTO, processes=None, payload_bytes=None) -> Plan:
+    """Chooses how to run a stage over partitions. With 'auto', the serial run, threads and processes with every number of workers up to max_workers are compared with the cost model and the fastest is kept, so that small inputs stay serial.
+
+    Args:
+        stage (str): Name of the stage, a key of the calibration costs
+        sizes (list(int)): Rows of each partition, one partition being one task
+        use_multiprocessing (bool or str, optional): True for processes, False for serial, or one of POLICIES. Defaults to 'auto'.
+        processes (int, optional): Number of workers, overriding the choice of the cost model. Defaults to None.
+        payload_bytes (int, optional): Bytes pickled for the workers, if known. Defaults to None.
+
+    Returns:
+        Plan: Chosen execution
+    """
+    sizes = list(sizes)
+    policy = _policy(use_multiprocessing)
+    if policy == SERIAL or len(sizes) == 0:
+        return Plan(SERIAL, 1, estimate(stage, sizes, SERIAL, 1))
+    if policy != AUTO:
+        workers = min(max_workers(processes), len(sizes))
+        return Plan(policy, workers, estimate(stage, sizes, policy, workers, payload_bytes))
+
+    candidates = [Plan(SERIAL, 1, estimate(stage, sizes, SERIAL, 1))]
+    counts = [processes] if processes else range(2, min(max_workers(), len(sizes)) + 1)
+    for mode in (THREADS, PROCESSES):
+        candidates += [Plan(mode, workers, estimate(stage, sizes, mode, workers, payload_bytes)) for workers in counts]
+    return min(candidates, key=lambda candidate: candidate.estimated_s)
+
+def _context():
+    """Multiprocessing context of the worker processes"""
+    context = mp.get_context(START_METHOD)
+    if context.get_start_method() == 'forkserver':
+        context.set_forkserver_preload(PRELOADED_MODULES)
+    return context
+
+def _pool(plan):
+    return ThreadPool(plan.workers) if plan.mode == THREADS else _context().Pool(plan.workers)
+
+def _record(span, plan, arguments):
+    """Adds the chosen execution, and the payload of a process pool, to a span"""
+    if span is None:
+        return
+    span.set(execution=plan.mode, workers=plan.workers, estimated_s=plan.estimated_s)
+    if plan.mode == PROCESSES:
+        instrumentation.record_pool(span, arguments)
+
+def execute(func, arguments, plan, span=None) -> list:
+    """Calls func on every argument as planned and waits for all of them, without any timeout
+
+    Args:
+        func (callable): Function of one argument, defined at module level for processes
+        arguments (list): Arguments, one per task
+        plan (Plan): Execution coming from plan
+        span (context manager, optional): Span of the instrumentation module where the execution is recorded. Defaults to None.
+
+    Returns:
+        list: Results, in the order of the arguments
+    """
+    _record(span, plan, arguments)
+    if plan.mode == SERIAL:
+        return [func(argument) for argument in arguments]
+    pool = _pool(plan)
+    try:
+        return pool.map(func, arguments)
+    finally:
+        pool.close()
+        pool.join()
+
+def execute_unordered(func, arguments, plan, span=None):
+    """Calls func on every argument as planned, yielding the results as tasks finish
+
+    Args:
+        func (callable): Function of one argument, defined at module level for processes
+        arguments (iterable): Arguments, one per task
+        plan (Plan): Execution coming from plan
+        span (context manager, optional): Span of the instrumentation module where the execution is recorded. Defaults to None.
+
+    Yields:
+        object: Results, in order of completion
+    """
+    if span is not None:
+        span.set(execution=plan.mode, workers=plan.workers, estimated_s=plan.estimated_s)
+    if plan.mode == SERIAL:
+        yield from builtins.map(func, arguments)
+        return
+    pool = _pool(plan)
+    try:
+        yield from pool.imap_unordered(func, arguments)
+    finally:
+        pool.close()
+        pool.join()
+
+def _noop(argument):
+    return argument
+
+def calibrate(path=None, days=2, sampling_interval=10, processes=2) -> dict:
+    """Measures the cost model on this machine and makes it the one in use: the per-row time of each stage on a synthetic user, the start-up time of worker processes, the dispatch time of a task and the pickling time per byte.
+
+    Args:
+        path (str, optional): JSON file where the calibration is saved, e.g. for CALIBRATION_ENVIRONMENT_VARIABLE. Defaults to None.
+        days (int, optional): Days of the synthetic user. Defaults to 2.
+        sampling_interval (float, optional): Seconds between two waypoints of the synthetic user. Defaults to 10.
+        processes (int, optional): Workers of the pool used to measure the overheads. Defaults to 2.
+
+    Returns:
+        dict: Calibration
+    """
+    global _calibration
+    # imported here, the stages importing this module
+    from mobilipy import preparation, reva, segmentation, synthetic
+
+    start = time.perf_counter()
+    pool = _context().Pool(processes)
+    pool.map(_noop, range(processes))
+    process_start_s = (time.perf_counter() - start) / processes
+    tasks = 1000
+    start = time.perf_counter()
+    pool.map(_noop, range(tasks), chunksize=1)
+    task_s = (time.perf_counter() - start) / tasks
+    pool.close()
+    pool.join()
+
+    data = synthetic.generate_user('calibration', days=days, sampling_interval=sampling_interval, seed=0)
+    costs = {stage: dict(cost) for stage, cost in DEFAULT_CALIBRATION['costs'].items()}
+    with instrumentation.Recorder() as recorder:
+        reva.analyse(data, 'calibration')
+    for record in recorder.records:
+        if record['name'] in costs and record.get('rows_in'):
+            costs[record['name']]['seconds_per_row'] = record['wall_s'] / record['rows_in']
+
+    prepared = preparation.prepare(data)
+    start = time.perf_counter()
+    segmentation.segment_sweep(prepared, use_multiprocessing=SERIAL)
+    costs['segment_sweep']['seconds_per_row'] = (time.perf_counter() - start) / max(prepared.shape[0], 1)
+
+    route = segmentation._create_route(prepared)
+    start = time.perf_counter()
+    payload = pickle.dumps(route, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.loads(payload)
+    byte_s = (time.perf_counter() - start) / len(payload)
+    for stage in ('segment.dbscan', 'segment_sweep', 'mode_detection.walks', 'mode_detection.modes', 'get_user_legs'):
+        costs[stage]['bytes_per_row'] = len(payload) / max(route.shape[0], 1)
+
+    _calibration = {**DEFAULT_CALIBRATION, 'costs': costs, 'process_start_s': process_start_s, 'task_s': task_s, 'byte_s': byte_s}
+    if path is not None:
+        with open(path, 'w') as file:
+            json.dump(_calibration, file, indent=2)
+    return _calibration
@@ -0,0 +1,201 @@
+import numpy as np
+from numba import njit
+
+EARTH_RADIUS_M = 6371008.8
+"""Mean radius of the earth (IUGG), in meters. Every distance, neighbourhood radius and projection of the package uses it."""
+
+METERS_PER_DEGREE = EARTH_RADIUS_M * np.pi / 180
+"""Length of one degree of latitude, or of longitude on the equator, in meters"""
+
+
+def _as_array(values) -> np.ndarray:
+    """Returns values as a contiguous float32 array if they already are float32, float64 otherwise, so that float32 inputs get float32 outputs"""
+    values = np.asarray(values)
+    return np.ascontiguousarray(values, dtype=np.float32 if values.dtype == np.float32 else np.float64)
+
+def _output_dtype(*arrays):
+    return np.float32 if all(array.dtype == np.float32 for array in arrays) else np.float64
+
+@njit(cache=True)
+def haversine(latitude1, longitude1, latitude2, longitude2) -> float:
+    """Great-circle distance between two points, in meters. Also meant to be called from other numba kernels.
+
+    Args:
+        latitude1 (float): Latitude of the first point in degrees
+        longitude1 (float): Longitude of the first point in degrees
+        latitude2 (float): Latitude of the second point in degrees
+        longitude2 (float): Longitude of the second point in degrees
+
+    Returns:
+        float: Distance in meters
+    """
+    phi1 = np.deg2rad(latitude1)
+    phi2 = np.deg2rad(latitude2)
+    a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(np.deg2rad(longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(min(a, 1.0)))
+
+@njit(cache=True)
+def _distance_kernel(latitudes1, longitudes1, latitudes2, longitudes2, out):
+    for i in range(out.shape[0]):
+        out[i] = haversine(latitudes1[i], longitudes1[i], latitudes2[i], longitudes2[i])
+
+@njit(cache=True)
+def _distance_to_kernel(latitudes, longitudes, latitude, longitude, out):
+    for i in range(out.shape[0]):
+        out[i] = haversine(latitudes[i], longitudes[i], latitude, longitude)
+
+@njit(cache=True)
+def _consecutive_distance_kernel(latitudes, longitudes, out):
+    for i in range(out.shape[0]):
+        out[i] = haversine(latitudes[i], longitudes[i], latitudes[i + 1], longitudes[i + 1])
+
+@njit(cache=True)
+def _pairwise_distance_kernel(latitudes1, longitudes1, latitudes2, longitudes2, out):
+    for i in range(out.shape[0]):
+        for j in range(out.shape[1]):
+            out[i, j] = haversine(latitudes1[i], longitudes1[i], latitudes2[j], longitudes2[j])
+
+@njit(cache=True)
+def _bearing_kernel(latitudes1, longitudes1, latitudes2, longitudes2, out):
+    for i in range(out.shape[0]):
+        phi1 = np.deg2rad(latitudes1[i])
+        phi2 = np.deg2rad(latitudes2[i])
+        delta = np.deg2rad(longitudes2[i] - longitudes1[i])
+        y = np.sin(delta) * np.cos(phi2)
+        x = np.cos(phi1) * np.sin(phi2) - np.sin(phi1) * np.cos(phi2) * np.cos(delta)
+        out[i] = np.rad2deg(np.arctan2(y, x)) % 360.0
+
+@njit(cache=True)
+def _project_kernel(latitudes, longitudes, latitude0, longitude0, x, y):
+    scale = METERS_PER_DEGREE * np.cos(np.deg2rad(latitude0))
+    for i in range(x.shape[0]):
+        x[i] = (longitudes[i] - longitude0) * scale
+        y[i] = (latitudes[i] - latitude0) * METERS_PER_DEGREE
+
+@njit(cache=True)
+def _unproject_kernel(x, y, latitude0, longitude0, latitudes, longitudes):
+    scale = METERS_PER_DEGREE * np.cos(np.deg2rad(latitude0))
+    for i in range(x.shape[0]):
+        latitudes[i] = latitude0 + y[i] / METERS_PER_DEGREE
+        longitudes[i] = longitude0 + x[i] / scale
+
+def distance(latitudes1, longitudes1, latitudes2, longitudes2) -> np.ndarray:
+    """Great-circle distances between two sequences of points, element by element
+
+    Args:
+        latitudes1 (numpy.ndarray): Latitudes of the first points in degrees
+        longitudes1 (numpy.ndarray): Longitudes of the first points in degrees
+        latitudes2 (numpy.ndarray): Latitudes of the second points in degrees
+        longitudes2 (numpy.ndarray): Longitudes of the second points in degrees
+
+    Returns:
+        numpy.ndarray: Distances in meters, float32 if all the inputs are float32
+    """
+    arrays = [_as_array(values) for values in (latitudes1, longitudes1, latitudes2, longitudes2)]
+    out = np.empty(arrays[0].shape[0], dtype=_output_dtype(*arrays))
+    _distance_kernel(*arrays, out)
+    return out
+
+def distance_to(latitudes, longitudes, latitude, longitude) -> np.ndarray:
+    """Great-circle distances between points and one location
+
+    Args:
+        latitudes (numpy.ndarray): Latitudes of the points in degrees
+        longitudes (numpy.ndarray): Longitudes of the points in degrees
+        latitude (float): Latitude of the location in degrees
+        longitude (float): Longitude of the location in degrees
+
+    Returns:
+        numpy.ndarray: Distances in meters, float32 if the inputs are float32
+    """
+    latitudes, longitudes = _as_array(latitudes), _as_array(longitudes)
+    out = np.empty(latitudes.shape[0], dtype=_output_dtype(latitudes, longitudes))
+    _distance_to_kernel(latitudes, longitudes, float(latitude), float(longitude), out)
+    return out
+
+def consecutive_distance(latitudes, longitudes) -> np.ndarray:
+    """Great-circle distances between consecutive points of a track
+
+    Args:
+        latitudes (numpy.ndarray): Latitudes in degrees
+        longitudes (numpy.ndarray): Longitudes in degrees
+
+    Returns:
+        numpy.ndarray: n - 1 distances in meters, float32 if the inputs are float32
+    """
+    latitudes, longitudes = _as_array(latitudes), _as_array(longitudes)
+    out = np.empty(max(latitudes.shape[0] - 1, 0), dtype=_output_dtype(latitudes, longitudes))
+    _consecutive_distance_kernel(latitudes, longitudes, out)
+    return out
+
+def pairwise_distance(latitudes1, longitudes1, latitudes2, longitudes2) -> np.ndarray:
+    """Great-circle distances between every point of a first sequence and every point of a second one
+
+    Args:
+        latitudes1 (numpy.ndarray): Latitudes of the first points in degrees
+        longitudes1 (numpy.ndarray): Longitudes of the first points in degrees
+        latitudes2 (numpy.ndarray): Latitudes of the second points in degrees
+        longitudes2 (numpy.ndarray): Longitudes of the second points in degrees
+
+    Returns:
+        numpy.ndarray: n x m distances in meters, float32 if all the inputs are float32
+    """
+    arrays = [_as_array(values) for values in (latitudes1, longitudes1, latitudes2, longitudes2)]
+    out = np.empty((arrays[0].shape[0], arrays[2].shape[0]), dtype=_output_dtype(*arrays))
+    _pairwise_distance_kernel(*arrays, out)
+    return out
+
+def bearing(latitudes1, longitudes1, latitudes2, longitudes2) -> np.ndarray:
+    """Initial bearings from first points to second points, element by element
+
+    Args:
+        latitudes1 (numpy.ndarray): Latitudes of the first points in degrees
+        longitudes1 (numpy.ndarray): Longitudes of the first points in degrees
+        latitudes2 (numpy.ndarray): Latitudes of the second points in degrees
+        longitudes2 (numpy.ndarray): Longitudes of the second points in degrees
+
+    Returns:
+        numpy.ndarray: Bearings in degrees clockwise from north, in [0, 360)
+    """
+    arrays = [_as_array(values) for values in (latitudes1, longitudes1, latitudes2, longitudes2)]
+    out = np.empty(arrays[0].shape[0], dtype=_output_dtype(*arrays))
+    _bearing_kernel(*arrays, out)
+    return out
+
+def project(latitudes, longitudes, latitude0, longitude0):
+    """Projects points on the plane tangent at an origin (equirectangular projection), accurate for distances of a few tens of kilometers around it
+
+    Args:
+        latitudes (numpy.ndarray): Latitudes in degrees
+        longitudes (numpy.ndarray): Longitudes in degrees
+        latitude0 (float): Latitude of the origin in degrees
+        longitude0 (float): Longitude of the origin in degrees
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): Meters to the east and to the north of the origin
+    """
+    latitudes, longitudes = _as_array(latitudes), _as_array(longitudes)
+    dtype = _output_dtype(latitudes, longitudes)
+    x = np.empty(latitudes.shape[0], dtype=dtype)
+    y = np.empty(latitudes.shape[0], dtype=dtype)
+    _project_kernel(latitudes, longitudes, float(latitude0), float(longitude0), x, y)
+    return x, y
+
+def unproject(x, y, latitude0, longitude0):
+    """Inverse of project
+
+    Args:
+        x (numpy.ndarray): Meters to the east of the origin
+        y (numpy.ndarray): Meters to the north of the origin
+        latitude0 (float): Latitude of the origin in degrees
+        longitude0 (float): Longitude of the origin in degrees
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): Latitudes and longitudes in degrees
+    """
+    x, y = _as_array(x), _as_array(y)
+    dtype = _output_dtype(x, y)
+    latitudes = np.empty(x.shape[0], dtype=dtype)
+    longitudes = np.empty(x.shape[0], dtype=dtype)
+    _unproject_kernel(x, y, float(latitude0), float(longitude0), latitudes, longitudes)
+    return latitudes, longitudes
@@ -1,61 +1,359 @@
+import os
+import zipfile
+from contextlib import contextmanager
+from functools import cached_property
 import pytz
 from mobilipy.constants import *
 import pandas as pd
 import numpy as np
-from haversine import haversine, Unit
+from numba import njit
+from mobilipy import geodesy
+from mobilipy.lazy import LazyModule
+
+neighbors = LazyModule('sklearn.neighbors')
 
 WALK_SPEED_MS = 1
 TRANSFER = 60
+TRANSFER_RADIUS_M = 50
+MATCH_RADIUS_M = 150
+MATCH_TIME_TOLERANCE_S = 300
+PUBLIC_TRANSPORT_MODES = ('Urban', 'Rail')
+SECONDS_PER_DAY = 86400
+_UNREACHED = np.iinfo(np.int64).max
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+STOP_TIMES_CHUNKSIZE = 1000000
+
+# Columns read from each table, the other ones are never loaded
+STOPS_COLUMNS = ['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon', 'parent_station']
+CALENDAR_COLUMNS = ['service_id', *WEEKDAYS, 'start_date', 'end_date']
+CALENDAR_DATES_COLUMNS = ['service_id', 'date', 'exception_type']
+TRIPS_COLUMNS = ['route_id', 'service_id', 'trip_id', 'direction_id', 'shape_id']
+STOP_TIMES_COLUMNS = ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence']
+ID_COLUMNS = ['stop_id', 'stop_code', 'parent_station', 'service_id', 'route_id', 'trip_id', 'shape_id']
+
+
+def _time_to_seconds(times) -> np.ndarray:
+    """Converts GTFS 'HH:MM:SS' times to seconds since the start of the service day. Hours past 23 are kept as they are, so trips running after midnight stay ordered after the rest of their service day.
+
+    Args:
+        times (pandas.Series): GTFS times as strings, empty values are allowed
+
+    Returns:
+        numpy.ndarray: int32 array of seconds, -1 where the time is missing
+    """
+    parts = pd.Series(times).astype(str).str.strip().str.split(':', expand=True)
+    if parts.shape[1] < 3:
+        return np.full(len(parts), -1, dtype=np.int32)
+    parts = parts.iloc[:, :3].apply(pd.to_numeric, errors='coerce')
+    seconds = parts[0] * 3600 + parts[1] * 60 + parts[2]
+    return seconds.fillna(-1).values.astype(np.int32)
+
+
+def _seconds_to_time(seconds) -> str:
+    """Formats seconds since the start of the service day as a GTFS 'HH:MM:SS' time
+
+    Args:
+        seconds (int): Seconds since the start of the service day
+
+    Returns:
+        str: Time formatted as 'HH:MM:SS', with hours possibly past 23
+    """
+    seconds = int(seconds)
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+def _is_fresh(path, source_path) -> bool:
+    """Checks whether a file derived from another one exists and is more recent than it
+
+    Args:
+        path (str): Path of the derived file
+        source_path (str): Path of the file it was derived from
+
+    Returns:
+        bool: True if the derived file can be reused
+    """
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source_path)
+
+
+def _to_service_day(date) -> pd.Timestamp:
+    """Normalizes a date to the UTC midnight used by the calendar tables
+
+    Args:
+        date (datetime.date or str): Service day
+
+    Returns:
+        pandas.Timestamp: Midnight of the service day, localized to UTC
+    """
+    return pd.Timestamp(pd.Timestamp(date).date()).tz_localize(pytz.utc)
+
+
+def _stop_events_between(offsets, times, stops, distances, start, end):
+    """Selects the events of the given stops whose time lies in the given window, using the stop index of GTFS_Helper._stop_events.
+
+    Args:
+        offsets (numpy.ndarray): Offsets of the events of each stop
+        times (numpy.ndarray): Event times, sorted within each stop
+        stops (numpy.ndarray): Positions of the stops in GTFS_Helper.stops
+        distances (numpy.ndarray): Distance to each of the stops, in meters
+        start (float): Start of the window, in seconds since the start of the service day
+        end (float): End of the window, in seconds since the start of the service day
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): Positions of the selected events and distance to their stop
+    """
+    firsts = np.empty(len(stops), dtype=np.int64)
+    lasts = np.empty(len(stops), dtype=np.int64)
+    for i, stop in enumerate(stops):
+        stop_times = times[offsets[stop]:offsets[stop + 1]]
+        firsts[i] = offsets[stop] + np.searchsorted(stop_times, start, side='left')
+        lasts[i] = offsets[stop] + np.searchsorted(stop_times, end, side='right')
+
+    counts = lasts - firsts
+    positions = np.repeat(firsts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    return positions, np.repeat(distances, counts)
+
+
+@njit(cache=True)
+def _connection_scan(departure_stops, arrival_stops, departure_times, arrival_times, trips, active_today, active_previous,
+                     footpath_offsets, footpath_targets, footpath_durations, origin, destination, start_time):
+    """Earliest arrival Connection Scan over connections sorted by departure time. Connections of the previous service day that run past midnight are scanned together with the ones of the queried day.
+
+    Returns:
+        int: Earliest arrival at the destination in seconds since the start of the queried service day
+    """
+    n_connections = departure_times.shape[0]
+    earliest = np.full(footpath_offsets.shape[0] - 1, _UNREACHED, dtype=np.int64)
+    earliest[origin] = start_time
+    for k in range(footpath_offsets[origin], footpath_offsets[origin + 1]):
+        walk_arrival = start_time + footpath_durations[k]
+        if walk_arrival < earliest[footpath_targets[k]]:
+            earliest[footpath_targets[k]] = walk_arrival
+
+    boarded_today = np.zeros(active_today.shape[0], dtype=np.bool_)
+    boarded_previous = np.zeros(active_previous.shape[0], dtype=np.bool_)
+
+    i = np.searchsorted(departure_times, start_time)
+    j = np.searchsorted(departure_times, start_time + SECONDS_PER_DAY)
+    while i < n_connections or j < n_connections:
+        if j >= n_connections or (i < n_connections and departure_times[i] <= departure_times[j] - SECONDS_PER_DAY):
+            c = i
+            shift = 0
+            active = active_today
+            boarded = boarded_today
+            i += 1
+        else:
+            c = j
+            shift = SECONDS_PER_DAY
+            active = active_previous
+            boarded = boarded_previous
+            j += 1
+
+        departure = departure_times[c] - shift
+        if departure >= earliest[destination]:
+            break
+        trip = trips[c]
+        if not active[trip]:
+            continue
+        if boarded[trip] or earliest[departure_stops[c]] <= departure:
+            boarded[trip] = True
+            arrival = arrival_times[c] - shift
+            stop = arrival_stops[c]
+            if arrival < earliest[stop]:
+                earliest[stop] = arrival
+                for k in range(footpath_offsets[stop], footpath_offsets[stop + 1]):
+                    walk_arrival = arrival + footpath_durations[k]
+                    if walk_arrival < earliest[footpath_targets[k]]:
+                        earliest[footpath_targets[k]] = walk_arrival
+
+    return earliest[destination]
 
 
 class GTFS_Helper:
 
-    def __init__(self, directory, lon_lat_step=0.003):
-        self.stops = pd.read_csv(
-            directory + "stops.txt").drop(['stop_url', 'location_type'], axis=1, errors='ignore')
-        self.stops['bucket'] = list(zip(round(self.stops.stop_lon - (self.stops.stop_lon % lon_lat_step), 3),
-                                    round(self.stops.stop_lat - (self.stops.stop_lat % lon_lat_step), 3)))
-        self.stops_dic = {}
-        for index, row in self.stops.iterrows():
-            self.stops_dic.setdefault(row['bucket'], []).append(
-                (row['stop_id'], row['stop_name'], row['stop_lon'], row['stop_lat']))
-
-        self.calendar = pd.read_csv(directory + 'calendar.txt')
-        self.calendar['start_date'] = pd.to_datetime(
-            self.calendar['start_date'], format='%Y%m%d', yearfirst=True, infer_datetime_format=True).map(lambda x: pytz.utc.localize(x))
-        self.calendar['end_date'] = pd.to_datetime(
-            self.calendar['end_date'], format='%Y%m%d', yearfirst=True, infer_datetime_format=True).map(lambda x: pytz.utc.localize(x))
-
-        def get_days_of_week(row):
-            l = []
-            for i in range(0, 7):
-                if row[i] == 1:
-                    l.append(i)
-            return l
-        self.calendar['days'] = self.calendar[['monday', 'tuesday', 'wednesday',
-                                               'thursday', 'friday', 'saturday', 'sunday']].apply(get_days_of_week, axis=1)
-
-        self.calendar_dates = pd.read_csv(directory + 'calendar_dates.txt')
-        self.calendar_dates['date'] = pd.to_datetime(
-            self.calendar_dates['date'], format='%Y%m%d', yearfirst=True, infer_datetime_format=True).map(lambda x: pytz.utc.localize(x))
-
-        self.stop_times = pd.read_csv(directory + 'stop_times.txt')
-
-        arrival_times = self.stop_times['arrival_time'].values
-        departure_times = self.stop_times['departure_time'].values
-
-        self.stop_times['arrival_time'] = np.array(
-            [str(int(x[:2]) % 24) + x[2:] for x in arrival_times])
-        self.stop_times['departure_time'] = np.array(
-            [str(int(x[:2]) % 24) + x[2:] for x in departure_times])
-
-        self.stop_times['arrival_time'] = pd.to_datetime(
-            self.stop_times['arrival_time'], format="%H:%M:%S").dt.time
-        self.stop_times['departure_time'] = pd.to_datetime(
-            self.stop_times['departure_time'], format="%H:%M:%S").dt.time
-
-        self.trips = pd.read_csv(directory + 'trips.txt').set_index('trip_id')
-        self.transfers = self.get_transfers()
+    def __init__(self, directory, lon_lat_step=0.003, transfer_radius=TRANSFER_RADIUS_M, walk_speed=WALK_SPEED_MS, cache_transfers=False):
+        """Opens a GTFS feed. Tables are only read on first access, with the columns needed by the helper and compact dtypes, so that a helper only used for stop lookups never reads stop_times.
+
+        Args:
+            directory (str): Path of the directory containing the GTFS files, or of a zipped GTFS feed
+            lon_lat_step (float, optional): Size of the grid cells used by get_nearby_stops, in latitude/longitude degrees. Defaults to 0.003.
+            transfer_radius (float, optional): Maximal walking distance of a transfer, in meters. Defaults to TRANSFER_RADIUS_M.
+            walk_speed (float, optional): Walking speed used for the transfer times, in m/s. Defaults to WALK_SPEED_MS.
+            cache_transfers (bool, optional): Specifies whether the transfers should be stored as a hidden file in the feed directory and reused by later instances. Defaults to False.
+        """
+        self.directory = directory
+        self.lon_lat_step = lon_lat_step
+        self.transfer_radius = transfer_radius
+        self.walk_speed = walk_speed
+        self.cache_transfers = cache_transfers
+        self._transfers_cache = {}
+
+    @contextmanager
+    def _open(self, name):
+        """Opens a file of the feed, either from the directory or from the zip archive. The archive is closed together with the file.
+
+        Args:
+            name (str): Name of the file, e.g. 'stops.txt'
+
+        Yields:
+            file: Binary file object, None if the feed doesn't contain the file
+        """
+        if zipfile.is_zipfile(self.directory):
+            with zipfile.ZipFile(self.directory) as archive:
+                members = [member for member in archive.namelist() if os.path.basename(member) == name]
+                if not members:
+                    yield None
+                    return
+                with archive.open(members[0]) as file:
+                    yield file
+            return
+
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            yield None
+            return
+        with open(path, 'rb') as file:
+            yield file
+
+    def _read_table(self, name, columns, dtype=None, chunksize=None):
+        """Reads the projected columns of a table of the feed, IDs being read as strings.
+
+        Args:
+            name (str): Name of the file, e.g. 'stops.txt'
+            columns (list(str)): Columns to be read, the ones missing from the file are skipped
+            dtype (dict, optional): dtypes of the columns, on top of the ID ones. Defaults to None.
+            chunksize (int, optional): Number of rows per chunk, the whole table is returned at once if None. Defaults to None.
+
+        Returns:
+            pandas.DataFrame: The table, or a generator of its chunks if chunksize is given. Empty with the given columns if the feed doesn't contain the file.
+        """
+        dtype = {**{column: str for column in ID_COLUMNS}, **(dtype or {})}
+        if chunksize:
+            return self._read_chunks(name, columns, dtype, chunksize)
+
+        with self._open(name) as file:
+            if file is None:
+                return pd.DataFrame({column: pd.Series(dtype=dtype.get(column, 'float64')) for column in columns})
+            return pd.read_csv(file, usecols=lambda column: column in columns, dtype=dtype, encoding='utf-8-sig')
+
+    def _read_chunks(self, name, columns, dtype, chunksize):
+        """Yields the chunks of a table of the feed, keeping the file open until the last one is read.
+        """
+        with self._open(name) as file:
+            if file is None:
+                yield pd.DataFrame({column: pd.Series(dtype=dtype.get(column, 'float64')) for column in columns})
+                return
+            yield from pd.read_csv(file, usecols=lambda column: column in columns, dtype=dtype, encoding='utf-8-sig', chunksize=chunksize)
+
+    def _cache_path(self, name) -> str:
+        """Path of a file derived from the feed and stored next to it
+
+        Args:
+            name (str): Name of the derived file
+
+        Returns:
+            str: Hidden file in the feed directory, or next to the zip archive
+        """
+        if zipfile.is_zipfile(self.directory):
+            head, tail = os.path.split(os.path.abspath(self.directory))
+            return os.path.join(head, '.' + tail + name)
+        return os.path.join(self.directory, '.' + name.lstrip('.'))
+
+    def _source_path(self) -> str:
+        """Path of the file the stops are read from, used to tell whether cached files are outdated
+
+        Returns:
+            str: Path of the zip archive or of stops.txt
+        """
+        return self.directory if zipfile.is_zipfile(self.directory) else os.path.join(self.directory, 'stops.txt')
+
+    def cache_token(self) -> list:
+        """Identifies the content of the feed for the stage cache of the reva module, so that outputs computed against a feed updated in place aren't reused
+
+        Returns:
+            list: Name, size and modification time in nanoseconds of the zip archive, or of every file of the feed directory
+        """
+        if zipfile.is_zipfile(self.directory):
+            paths = [self.directory]
+        else:
+            paths = sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                           if name.endswith('.txt'))
+        return [(os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths]
+
+    @cached_property
+    def stops(self) -> pd.DataFrame:
+        """Stops of the feed, with the grid cell used by get_nearby_stops in the 'bucket' column
+        """
+        stops = self._read_table('stops.txt', STOPS_COLUMNS, dtype={'stop_lat': np.float64, 'stop_lon': np.float64})
+        stops['bucket'] = list(zip(round(stops.stop_lon - (stops.stop_lon % self.lon_lat_step), 3),
+                                   round(stops.stop_lat - (stops.stop_lat % self.lon_lat_step), 3)))
+        return stops
+
+    @cached_property
+    def stops_dic(self) -> dict:
+        """Stops grouped by grid cell, used by get_nearby_stops
+        """
+        stops_dic = {}
+        for row in self.stops[['bucket', 'stop_id', 'stop_name', 'stop_lon', 'stop_lat']].itertuples(index=False):
+            stops_dic.setdefault(row[0], []).append(tuple(row[1:]))
+        return stops_dic
+
+    @cached_property
+    def calendar(self) -> pd.DataFrame:
+        """Weekly service patterns, with the indexes of the days of the week each service runs on in the 'days' column
+        """
+        calendar = self._read_table('calendar.txt', CALENDAR_COLUMNS,
+                                    dtype={**{day: np.int8 for day in WEEKDAYS}, 'start_date': str, 'end_date': str})
+        calendar['start_date'] = pd.to_datetime(calendar['start_date'], format='%Y%m%d').dt.tz_localize(pytz.utc)
+        calendar['end_date'] = pd.to_datetime(calendar['end_date'], format='%Y%m%d').dt.tz_localize(pytz.utc)
+        calendar['days'] = [list(np.flatnonzero(days)) for days in calendar[WEEKDAYS].values == 1]
+        return calendar
+
+    @cached_property
+    def calendar_dates(self) -> pd.DataFrame:
+        """Exceptions to the weekly service patterns
+        """
+        calendar_dates = self._read_table('calendar_dates.txt', CALENDAR_DATES_COLUMNS, dtype={'date': str, 'exception_type': np.int8})
+        calendar_dates['date'] = pd.to_datetime(calendar_dates['date'], format='%Y%m%d').dt.tz_localize(pytz.utc)
+        return calendar_dates
+
+    @cached_property
+    def trips(self) -> pd.DataFrame:
+        """Trips of the feed, indexed by trip_id
+        """
+        trips = self._read_table('trips.txt', TRIPS_COLUMNS, dtype={'direction_id': 'float32'}).set_index('trip_id')
+        trips['service_id'] = trips['service_id'].astype('category')
+        return trips
+
+    @cached_property
+    def stop_times(self) -> pd.DataFrame:
+        """Stop times of the feed, read in chunks. Times are kept as int32 seconds since the start of the service day, e.g. 25:10:00 becomes 90600, and stop_id and trip_id are categoricals over the IDs of stops and trips.
+        """
+        stop_categories = pd.CategoricalDtype(self.stops.stop_id.values)
+        trip_categories = pd.CategoricalDtype(self.trips.index.values)
+
+        chunks = []
+        for chunk in self._read_table('stop_times.txt', STOP_TIMES_COLUMNS, dtype={'arrival_time': str, 'departure_time': str},
+                                      chunksize=STOP_TIMES_CHUNKSIZE):
+            chunks.append(pd.DataFrame({
+                'trip_id': chunk['trip_id'].astype(trip_categories),
+                'arrival_time': _time_to_seconds(chunk['arrival_time']),
+                'departure_time': _time_to_seconds(chunk['departure_time']),
+                'stop_id': chunk['stop_id'].astype(stop_categories),
+                'stop_sequence': chunk['stop_sequence'].values.astype(np.int32),
+            }))
+        return pd.concat(chunks, ignore_index=True)
+
+    @cached_property
+    def transfers(self) -> pd.DataFrame:
+        """Transfers between close stops, see get_transfers
+        """
+        return self.get_transfers(self.transfer_radius, self.walk_speed)
+
+    @cached_property
+    def connections(self) -> pd.DataFrame:
+        """Connection list of the timetable, see _get_connections
+        """
+        return self._get_connections()
 
     def id_to_name(self, stop_id) -> str:
         """Finds the name of the stop with the given ID
@@ -115,33 +413,395 @@ class GTFS_Helper:
             longitude (float): Longitude as degrees
             latitude (float): Latitude as degrees
             n (int, optional): Number of stops to be returned. Defaults to 1.
-            lon_lat_step (float, optional): Size of cells on map, in latitude/longitude degrees. Defaults to 0.003.
+            lon_lat_step (float, optional): Unused, the search goes through the stop index. Defaults to 0.003.
 
         Returns:
             pandas.DataFrame: DataFrame with information about n closest stops
         """
-        stops_df = self.get_nearby_stops(longitude, latitude, lon_lat_step)
-        stops_df['dist'] = stops_df.apply(lambda row: haversine(
-            (row.stop_lat, row.stop_lon), (latitude, longitude), Unit.METERS), axis=1)
-        return stops_df.sort_values('dist', ascending=True).head(n)
+        indices, distances = self.nearest_stops([latitude], [longitude], k=n)
+        stops_df = self.stops.iloc[indices[0]][['stop_id', 'stop_name', 'stop_lon', 'stop_lat']]
+        stops_df['dist'] = distances[0]
+        return stops_df
+
+    @cached_property
+    def stop_index(self):
+        """Haversine BallTree over the stops, built on first use. Query results are positions in self.stops.
+        """
+        return neighbors.BallTree(np.radians(self.stops[['stop_lat', 'stop_lon']].values), metric='haversine')
+
+    def nearest_stops(self, latitudes, longitudes, k=1):
+        """Finds the k closest stops to each of the given locations.
+
+        Args:
+            latitudes (numpy.ndarray): Latitudes as degrees
+            longitudes (numpy.ndarray): Longitudes as degrees
+            k (int, optional): Number of stops to be returned per location. Defaults to 1.
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray): Positions in self.stops and distances in meters, both of shape (n_locations, k) and sorted by distance
+        """
+        points = np.radians(np.column_stack((np.asarray(latitudes, dtype=np.float64), np.asarray(longitudes, dtype=np.float64))))
+        k = min(k, len(self.stops))
+        if points.shape[0] == 0 or k == 0:
+            return np.empty((points.shape[0], k), dtype=np.int64), np.empty((points.shape[0], k))
+        distances, indices = self.stop_index.query(points, k=k)
+        return indices, distances * geodesy.EARTH_RADIUS_M
+
+    def stops_within(self, latitudes, longitudes, radius_m):
+        """Finds all the stops within the given radius of each of the given locations.
+
+        Args:
+            latitudes (numpy.ndarray): Latitudes as degrees
+            longitudes (numpy.ndarray): Longitudes as degrees
+            radius_m (float): Search radius in meters
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray, numpy.ndarray): Flat arrays of location positions, positions in self.stops and distances in meters, one entry per (location, stop) pair, ordered by location and then by distance
+        """
+        points = np.radians(np.column_stack((np.asarray(latitudes, dtype=np.float64), np.asarray(longitudes, dtype=np.float64))))
+        if points.shape[0] == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+        indices, distances = self.stop_index.query_radius(
+            points, r=radius_m / geodesy.EARTH_RADIUS_M, return_distance=True, sort_results=True)
+        counts = np.fromiter((len(x) for x in indices), dtype=np.int64, count=len(indices))
+        if counts.sum() == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+        return (np.repeat(np.arange(len(indices)), counts),
+                np.concatenate(indices).astype(np.int64),
+                np.concatenate(distances) * geodesy.EARTH_RADIUS_M)
+
+    def get_transfers(self, radius=TRANSFER_RADIUS_M, walk_speed=WALK_SPEED_MS) -> pd.DataFrame:
+        """Finds the possible walking transfers between stops. Every pair of distinct stops of the feed closer than the radius is a transfer, whatever their parent stations, and all the pairs are found with a single self-join on the stop index.
 
-    def get_transfers(self) -> pd.DataFrame:
-        """Finds possible transfers within the same parent station.
+        The result is kept in memory for every (radius, walk_speed) pair and, when cache_transfers is set, stored in the feed directory until stops.txt changes.
+
+        Args:
+            radius (float, optional): Maximal walking distance between the two stops, in meters. Defaults to TRANSFER_RADIUS_M.
+            walk_speed (float, optional): Walking speed used for the transfer time, in m/s. Defaults to WALK_SPEED_MS.
 
         Returns:
             pandas.DataFrame: DataFrame containing all the possible transfers in the dataset.
         """
-        transfers = self.stops.copy()
-        transfers['neigh'] = transfers.apply(lambda row: self.get_nearby_stops(
-            row.stop_lon, row.stop_lat, df=False), axis=1)
-        transfers = transfers.explode('neigh')
-        transfers[['neigh_id', 'neigh_name', 'neigh_lon', 'neigh_lat']] = pd.DataFrame(
-            transfers['neigh'].tolist(), index=transfers.index)
-        transfers = transfers[transfers.stop_id != transfers.neigh_id]
-        transfers['distance'] = transfers.apply(lambda row: haversine(
-            (row['stop_lat'], row['stop_lon']), (row['neigh_lat'], row['neigh_lon']), Unit.METERS), axis=1)
-        transfers = transfers[transfers.distance <= 50]
-        transfers['time_s'] = transfers.distance.map(
-            lambda dist: dist * WALK_SPEED_MS)
+        key = (float(radius), float(walk_speed))
+        transfers = self._transfers_cache.get(key)
+
+        cache_path = self._cache_path('.transfers_{:g}m_{:g}ms.csv'.format(*key))
+        if transfers is None and self.cache_transfers and _is_fresh(cache_path, self._source_path()):
+            transfers = pd.read_csv(cache_path, dtype={'stop_id': str, 'neigh_id': str})
+
+        if transfers is None:
+            stops = self.stops[['stop_id', 'stop_name', 'stop_lon', 'stop_lat']]
+            origins, neighbours, distances = self.stops_within(stops.stop_lat.values, stops.stop_lon.values, radius)
+            different = origins != neighbours
+            origins, neighbours, distances = origins[different], neighbours[different], distances[different]
+
+            transfers = stops.iloc[origins].reset_index(drop=True)
+            neighbour_stops = stops.iloc[neighbours].reset_index(drop=True)
+            transfers['neigh_id'] = neighbour_stops.stop_id
+            transfers['neigh_name'] = neighbour_stops.stop_name
+            transfers['neigh_lon'] = neighbour_stops.stop_lon
+            transfers['neigh_lat'] = neighbour_stops.stop_lat
+            transfers['distance'] = distances
+            transfers['time_s'] = distances / walk_speed
+
+            if self.cache_transfers:
+                try:
+                    transfers.to_csv(cache_path, index=False)
+                except OSError:
+                    pass
+
+        self._transfers_cache[key] = transfers
         self.transfers = transfers
+        self.__dict__.pop('_footpaths', None)
         return self.transfers
+
+    def _get_trip_events(self) -> pd.DataFrame:
+        """Encodes stop_times with the positions of their stops and trips, sorted by trip and stop sequence. Rows with unknown stops or trips, or without any time, are dropped.
+
+        Returns:
+            pandas.DataFrame: DataFrame with int32 'stop' (position in self.stops), 'trip' (position in self.trips), 'stop_sequence', 'arrival_time' and 'departure_time' (seconds since the start of the service day) columns
+        """
+        stop_times = self.stop_times
+        trips = stop_times.trip_id.cat.codes.values
+        order = np.lexsort((stop_times.stop_sequence.values, trips))
+        stop_times = stop_times.iloc[order]
+
+        # GTFS only requires times at timepoints, fall back on the other time of the same stop when one is missing
+        arrival_times = stop_times.arrival_time.values
+        departure_times = stop_times.departure_time.values
+        arrival_times = np.where(arrival_times < 0, departure_times, arrival_times)
+        departure_times = np.where(departure_times < 0, arrival_times, departure_times)
+
+        events = pd.DataFrame({
+            'stop': stop_times.stop_id.cat.codes.values,
+            'trip': trips[order],
+            'stop_sequence': stop_times.stop_sequence.values,
+            'arrival_time': arrival_times,
+            'departure_time': departure_times,
+        })
+        events = events[(events.stop >= 0) & (events.trip >= 0) & (events.departure_time >= 0)]
+        return events.astype(np.int32).reset_index(drop=True)
+
+    def _get_connections(self) -> pd.DataFrame:
+        """Builds the connection list of the timetable: one row per pair of consecutive stops of a trip, sorted by departure time.
+
+        Returns:
+            pandas.DataFrame: DataFrame with int32 'departure_stop', 'arrival_stop' (positions in self.stops), 'departure_time', 'arrival_time' (seconds since the start of the service day) and 'trip' (position in self.trips) columns
+        """
+        events = self._get_trip_events()
+        stops = events.stop.values
+        trips = events.trip.values
+        same_trip = trips[:-1] == trips[1:]
+
+        connections = pd.DataFrame({
+            'departure_stop': stops[:-1][same_trip],
+            'arrival_stop': stops[1:][same_trip],
+            'departure_time': events.departure_time.values[:-1][same_trip],
+            'arrival_time': events.arrival_time.values[1:][same_trip],
+            'trip': trips[:-1][same_trip],
+        }).astype(np.int32)
+
+        return connections.sort_values('departure_time', kind='stable').reset_index(drop=True)
+
+    @cached_property
+    def _footpaths(self):
+        """Transfers table as CSR arrays indexed by stop position, rebuilt whenever get_transfers changes the transfers.
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray, numpy.ndarray): offsets, target stops and walking durations in seconds
+        """
+        stop_ids = pd.Index(self.stops.stop_id)
+        sources = stop_ids.get_indexer(self.transfers.stop_id)
+        targets = stop_ids.get_indexer(self.transfers.neigh_id)
+        durations = np.ceil(self.transfers.time_s.values.astype(np.float64)).astype(np.int64)
+
+        valid = (sources >= 0) & (targets >= 0)
+        sources, targets, durations = sources[valid], targets[valid], durations[valid]
+        order = np.argsort(sources, kind='stable')
+        offsets = np.searchsorted(sources[order], np.arange(len(self.stops) + 1))
+
+        return offsets.astype(np.int64), targets[order].astype(np.int64), durations[order]
+
+    @cached_property
+    def _service_calendar(self):
+        """Bitset of the days each service runs on, merging the weekday patterns and date ranges of calendar with the exceptions of calendar_dates. Bit d of a service's row is set when it runs d days after the first day of the feed.
+
+        Returns:
+            (pandas.Index, pandas.Timestamp, int, numpy.ndarray, numpy.ndarray): IDs of the services, first day of the feed, number of days, packed bits of shape (n_services, ceil(n_days / 8)) and position of the service of each trip
+        """
+        dates = pd.concat([self.calendar.start_date, self.calendar.end_date, self.calendar_dates.date])
+        service_ids = pd.Index(pd.concat([self.calendar.service_id, self.calendar_dates.service_id]).astype(str).unique())
+        first_day = dates.min()
+        n_days = (dates.max() - first_day).days + 1 if len(dates) else 0
+
+        days = np.arange(n_days)
+        weekdays = (days + (first_day.weekday() if n_days else 0)) % 7
+        start_days = (self.calendar.start_date - first_day).dt.days.values
+        end_days = (self.calendar.end_date - first_day).dt.days.values
+
+        running = np.zeros((len(service_ids), n_days), dtype=bool)
+        running[service_ids.get_indexer(self.calendar.service_id)] = (
+            (self.calendar[WEEKDAYS].values == 1)[:, weekdays]
+            & (days >= start_days[:, None]) & (days <= end_days[:, None]))
+
+        exceptions = self.calendar_dates
+        services = service_ids.get_indexer(exceptions.service_id)
+        exception_days = (exceptions.date - first_day).dt.days.values
+        added = (exceptions.exception_type == 1).values
+        removed = (exceptions.exception_type == 2).values
+        running[services[added], exception_days[added]] = True
+        running[services[removed], exception_days[removed]] = False
+
+        # Trips whose service_id isn't in the calendar point at the last position, which is never active
+        trip_services = service_ids.get_indexer(self.trips.service_id.astype(str))
+        return service_ids, first_day, n_days, np.packbits(running, axis=1), trip_services
+
+    def _active_services_mask(self, date) -> np.ndarray:
+        """Reads the active services for the given service day from the bitset.
+
+        Args:
+            date (datetime.date or str): Service day
+
+        Returns:
+            numpy.ndarray: Boolean array aligned with the service IDs of the bitset, with one additional False entry at the end
+        """
+        service_ids, first_day, n_days, service_bits, _ = self._service_calendar
+        mask = np.zeros(len(service_ids) + 1, dtype=bool)
+        offset = (_to_service_day(date) - first_day).days if n_days else -1
+        if 0 <= offset < n_days:
+            mask[:-1] = (service_bits[:, offset >> 3] >> (7 - (offset & 7))) & 1
+        return mask
+
+    def _active_trips_mask(self, date) -> np.ndarray:
+        """Finds the trips running on the given service day.
+
+        Args:
+            date (datetime.date or str): Service day
+
+        Returns:
+            numpy.ndarray: Boolean array aligned with self.trips
+        """
+        return self._active_services_mask(date)[self._service_calendar[-1]]
+
+    def active_services(self, date) -> np.ndarray:
+        """Finds the services running on the given service day.
+
+        Args:
+            date (datetime.date or str): Service day
+
+        Returns:
+            numpy.ndarray: IDs of the active services
+        """
+        return self._service_calendar[0].values[self._active_services_mask(date)[:-1]]
+
+    def active_trips(self, date) -> np.ndarray:
+        """Finds the trips running on the given service day.
+
+        Args:
+            date (datetime.date or str): Service day
+
+        Returns:
+            numpy.ndarray: IDs of the active trips
+        """
+        return self.trips.index.values[self._active_trips_mask(date)]
+
+    def earliest_arrival(self, origin_stop_id, destination_stop_id, date, departure_time):
+        """Finds the earliest arrival at a stop when leaving from another one at the given date and time, using the Connection Scan Algorithm. Walking between stops follows the transfers table.
+
+        Args:
+            origin_stop_id (str): ID of the stop the journey starts at
+            destination_stop_id (str): ID of the stop the journey ends at
+            date (datetime.date or str): Service day of the departure
+            departure_time (str or int): Departure time, either as 'HH:MM:SS' or in seconds since the start of the service day
+
+        Returns:
+            int: Earliest arrival in seconds since the start of the service day of the departure, None if the destination can't be reached
+        """
+        stop_ids = pd.Index(self.stops.stop_id)
+        origin = stop_ids.get_loc(origin_stop_id)
+        destination = stop_ids.get_loc(destination_stop_id)
+
+        if isinstance(departure_time, str):
+            departure_time = int(_time_to_seconds([departure_time])[0])
+
+        day = _to_service_day(date)
+        offsets, targets, durations = self._footpaths
+        arrival = _connection_scan(
+            self.connections.departure_stop.values, self.connections.arrival_stop.values,
+            self.connections.departure_time.values, self.connections.arrival_time.values,
+            self.connections.trip.values, self._active_trips_mask(day), self._active_trips_mask(day - pd.Timedelta(days=1)),
+            offsets, targets, durations, origin, destination, int(departure_time))
+
+        if arrival == _UNREACHED:
+            return None
+        return int(arrival)
+
+    @cached_property
+    def _stop_events(self):
+        """Index of the stop_times by stop, built once per feed: the events of each stop are sorted by departure time and, separately, by arrival time.
+
+        Returns:
+            (numpy.ndarray, dict, dict): offsets of the events of each stop, arrays of the events sorted by stop and departure time, arrays of the events sorted by stop and arrival time
+        """
+        events = self._get_trip_events()
+        by_departure = events.sort_values(['stop', 'departure_time'], kind='stable')
+        by_arrival = events.sort_values(['stop', 'arrival_time'], kind='stable')
+        offsets = np.searchsorted(by_departure.stop.values, np.arange(len(self.stops) + 1))
+        return (offsets, {column: by_departure[column].values for column in events.columns},
+                {column: by_arrival[column].values for column in events.columns})
+
+    def match_legs(self, legs, timezone=UTC, radius=MATCH_RADIUS_M, time_tolerance=MATCH_TIME_TOLERANCE_S, modes=PUBLIC_TRANSPORT_MODES) -> pd.DataFrame:
+        """Finds the scheduled trip most likely ridden during each public transport leg. Boarding and alighting stop candidates are taken around the first and last point of the leg, and combined with the departures and arrivals of the trips active on the service day within the time tolerance. Candidates are scored by their time difference to the leg plus the time needed to walk between the leg ends and the stops.
+
+        Args:
+            legs (pandas.DataFrame): DataFrame with legs, coming from legs.get_user_legs
+            timezone (str, optional): Timezone of the GTFS feed, in which its times are expressed. Defaults to UTC.
+            radius (float, optional): Distance from the leg ends within which stops are candidates, in meters. Defaults to MATCH_RADIUS_M.
+            time_tolerance (float, optional): Maximal difference between the leg times and the scheduled times, in seconds. Defaults to MATCH_TIME_TOLERANCE_S.
+            modes (tuple(str), optional): Detected modes of the legs to be matched. Defaults to PUBLIC_TRANSPORT_MODES.
+
+        Returns:
+            pandas.DataFrame: DataFrame indexed like the matched legs, with 'trip_id', 'route_id', 'service_date', 'boarding_stop_id', 'alighting_stop_id', 'departure_time', 'arrival_time' (seconds since the start of the service day) and 'score' columns
+        """
+        columns = ['trip_id', 'route_id', 'service_date', 'boarding_stop_id', 'alighting_stop_id', 'departure_time', 'arrival_time', 'score']
+        detected_modes = legs.detected_mode.fillna('').astype(str).str.split(',')
+        pt_legs = legs[(legs.type == TRACK) & detected_modes.map(lambda leg_modes: any(mode in modes for mode in leg_modes))]
+        pt_legs = pt_legs[pt_legs.geometry.map(len) > 0]
+        if pt_legs.shape[0] == 0:
+            return pd.DataFrame(columns=columns)
+
+        first_points = np.array([geometry[0] for geometry in pt_legs.geometry], dtype=np.float64)
+        last_points = np.array([geometry[-1] for geometry in pt_legs.geometry], dtype=np.float64)
+        boarding = self.stops_within(first_points[:, 0], first_points[:, 1], radius)
+        alighting = self.stops_within(last_points[:, 0], last_points[:, 1], radius)
+        boarding_offsets = np.searchsorted(boarding[0], np.arange(pt_legs.shape[0] + 1))
+        alighting_offsets = np.searchsorted(alighting[0], np.arange(pt_legs.shape[0] + 1))
+
+        started_at = pd.to_datetime(pt_legs.started_at)
+        finished_at = pd.to_datetime(pt_legs.finished_at)
+        if started_at.dt.tz is None:
+            started_at = started_at.dt.tz_localize(UTC)
+            finished_at = finished_at.dt.tz_localize(UTC)
+        started_at = started_at.dt.tz_convert(timezone)
+        finished_at = finished_at.dt.tz_convert(timezone)
+        local_days = started_at.dt.normalize()
+        # Seconds since the start of the local day of the departure
+        starts = (started_at - local_days).dt.total_seconds().values
+        ends = (finished_at - local_days).dt.total_seconds().values
+        local_days = local_days.dt.date.values
+
+        offsets, by_departure, by_arrival = self._stop_events
+        active_trips = {}
+        matches = []
+        for i in range(pt_legs.shape[0]):
+            leg_boarding = slice(boarding_offsets[i], boarding_offsets[i + 1])
+            leg_alighting = slice(alighting_offsets[i], alighting_offsets[i + 1])
+            if leg_boarding.start == leg_boarding.stop or leg_alighting.start == leg_alighting.stop:
+                continue
+            best = None
+
+            # A trip running past midnight belongs to the previous service day, with times past 24:00:00
+            for days_before in (0, 1):
+                service_day = local_days[i] - pd.Timedelta(days=days_before).to_pytimedelta()
+                start = starts[i] + days_before * SECONDS_PER_DAY
+                end = ends[i] + days_before * SECONDS_PER_DAY
+                if service_day not in active_trips:
+                    active_trips[service_day] = self._active_trips_mask(service_day)
+
+                departures, departure_distances = _stop_events_between(
+                    offsets, by_departure['departure_time'], boarding[1][leg_boarding], boarding[2][leg_boarding],
+                    start - time_tolerance, start + time_tolerance)
+                active = active_trips[service_day][by_departure['trip'][departures]]
+                departures, departure_distances = departures[active], departure_distances[active]
+                arrivals, arrival_distances = _stop_events_between(
+                    offsets, by_arrival['arrival_time'], alighting[1][leg_alighting], alighting[2][leg_alighting],
+                    end - time_tolerance, end + time_tolerance)
+                if len(departures) == 0 or len(arrivals) == 0:
+                    continue
+
+                # Pairs of a departure and a later arrival of the same trip
+                pairs = ((by_departure['trip'][departures][:, None] == by_arrival['trip'][arrivals][None, :])
+                         & (by_departure['stop_sequence'][departures][:, None] < by_arrival['stop_sequence'][arrivals][None, :]))
+                d, a = np.nonzero(pairs)
+                if len(d) == 0:
+                    continue
+
+                scores = (np.abs(by_departure['departure_time'][departures[d]] - start)
+                          + np.abs(by_arrival['arrival_time'][arrivals[a]] - end)
+                          + (departure_distances[d] + arrival_distances[a]) / self.walk_speed)
+                k = np.argmin(scores)
+                if best is None or scores[k] < best[-1]:
+                    best = (departures[d[k]], arrivals[a[k]], service_day, scores[k])
+
+            if best is not None:
+                departure, arrival, service_day, score = best
+                trip = by_departure['trip'][departure]
+                matches.append((pt_legs.index[i], self.trips.index[trip],
+                                self.trips.route_id.iloc[trip] if 'route_id' in self.trips.columns else np.nan, service_day,
+                                self.stops.stop_id.iloc[by_departure['stop'][departure]], self.stops.stop_id.iloc[by_arrival['stop'][arrival]],
+                                int(by_departure['departure_time'][departure]), int(by_arrival['arrival_time'][arrival]), score))
+
+        matches = pd.DataFrame(matches, columns=['index'] + columns)
+        return matches.set_index('index').rename_axis(legs.index.name)
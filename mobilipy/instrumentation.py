@@ -0,0 +1,235 @@
+import os
+import sys
+import json
+import time
+import pickle
+import functools
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_recorders = []
+"""Stack of the active recorders, the innermost being the last one"""
+
+
+def _rss_bytes():
+    """Returns the current resident set size of the process, or None where it can't be measured
+
+    Returns:
+        int: Current RSS in bytes
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _process_peak_rss_bytes():
+    """Returns the highest resident set size reached by the process since it started, or None where it can't be measured. It never decreases, so it only tells which span first reached the peak.
+
+    Returns:
+        int: Peak RSS in bytes
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _rows(value):
+    """Returns the number of rows of a stage's input or output, or None if it's not a DataFrame
+
+    Args:
+        value (object): Input or output of a stage. For tuples, the first element is considered.
+
+    Returns:
+        int: Number of rows
+    """
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.shape[0]
+    return None
+
+def enabled() -> bool:
+    """Returns whether a recorder is active, so that costly measurements such as payload sizes can be skipped otherwise
+
+    Returns:
+        bool: True if a recorder is active
+    """
+    return bool(_recorders)
+
+
+class _NullSpan:
+    """Span used while no recorder is active, doing nothing"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """Measures one stage or sub-step and adds its record to a recorder when it exits"""
+    def __init__(self, recorder, name, rows_in):
+        self.recorder = recorder
+        self.record = {'name': name, 'parent': recorder._open[-1]['name'] if recorder._open else None,
+                       'depth': len(recorder._open), 'rows_in': rows_in, 'rows_out': None}
+
+    def __enter__(self):
+        self.recorder._open.append(self.record)
+        children = os.times()
+        self._start = (time.perf_counter(), time.process_time(), children.children_user + children.children_system, _rss_bytes())
+        return self
+
+    def __exit__(self, *exc_info):
+        children = os.times()
+        wall_start, cpu_start, children_start, rss_start = self._start
+        self.record['wall_s'] = time.perf_counter() - wall_start
+        self.record['cpu_s'] = time.process_time() - cpu_start
+        self.record['children_cpu_s'] = children.children_user + children.children_system - children_start
+        rss = _rss_bytes()
+        self.record['rss_bytes'] = rss
+        self.record['rss_delta_bytes'] = rss - rss_start if rss is not None and rss_start is not None else None
+        self.record['process_peak_rss_bytes'] = _process_peak_rss_bytes()
+        self.record['failed'] = exc_info[0] is not None
+        self.recorder._open.pop()
+        self.recorder.records.append(self.record)
+        return False
+
+    def set(self, **attributes):
+        """Adds attributes to the record, e.g. rows_out or payload_bytes"""
+        self.record.update(attributes)
+
+
+def span(name, rows_in=None):
+    """Returns a context manager measuring a stage or a sub-step in the active recorder, or a no-op one if no recorder is active.
+
+    Args:
+        name (str): Name of the stage or sub-step, e.g. 'segment.dbscan'
+        rows_in (int, optional): Number of input rows. Defaults to None.
+
+    Returns:
+        context manager: Span, whose set method adds attributes to the record
+    """
+    if not _recorders:
+        return _NULL_SPAN
+    return _Span(_recorders[-1], name, rows_in)
+
+def record_pool(span, arguments):
+    """Adds the size of the pickled pool arguments to a span, when a recorder is active
+
+    Args:
+        span (context manager): Span coming from span
+        arguments (list): Arguments sent to the pool workers
+    """
+    if _recorders:
+        start = time.perf_counter()
+        payload = pickle.dumps(arguments, protocol=pickle.HIGHEST_PROTOCOL)
+        span.set(payload_bytes=len(payload), serialization_s=time.perf_counter() - start)
+
+def instrumented(name):
+    """Decorator measuring a stage function in the active recorder, with the rows of its first argument and of its result. When no recorder is active, the function is called directly.
+
+    Args:
+        name (str): Name of the stage
+
+    Returns:
+        callable: Decorator
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _recorders:
+                return func(*args, **kwargs)
+            with _Span(_recorders[-1], name, _rows(args[0]) if args else None) as stage:
+                result = func(*args, **kwargs)
+                stage.set(rows_out=_rows(result))
+            return result
+        return wrapper
+    return decorator
+
+
+class Recorder:
+    """Context manager recording the wall time, CPU time, CPU time of the pool workers, rows in and out and resident set size of each instrumented stage and sub-step run inside it. The RSS is recorded at the end of the span and as its change over the span, next to the peak RSS of the process since it started, which is shared by all the spans following the heaviest one. Only the calling process is recorded: work done in pool workers shows up as children CPU time and pool overhead of the enclosing span.
+    """
+    def __init__(self):
+        self.records = []
+        """One dict per finished span, in order of completion"""
+        self._open = []
+
+    def __enter__(self):
+        _recorders.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _recorders.remove(self)
+        return False
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Returns the records as a DataFrame
+
+        Returns:
+            pandas.DataFrame: One row per span
+        """
+        return pd.DataFrame(self.records)
+
+    def to_json(self, path=None) -> str:
+        """Exports the records as JSON
+
+        Args:
+            path (str, optional): File where the JSON is written. Defaults to None.
+
+        Returns:
+            str: JSON list of records
+        """
+        text = json.dumps(self.records, indent=2)
+        if path is not None:
+            with open(path, 'w') as file:
+                file.write(text)
+        return text
+
+    def to_prometheus(self, prefix='mobilipy') -> str:
+        """Exports the records in the Prometheus text format, summed by span name
+
+        Args:
+            prefix (str, optional): Prefix of the metric names. Defaults to 'mobilipy'.
+
+        Returns:
+            str: Prometheus exposition text
+        """
+        metrics = [
+            ('stage_calls_total', 'counter', 'Number of calls', None),
+            ('stage_wall_seconds_total', 'counter', 'Wall time', 'wall_s'),
+            ('stage_cpu_seconds_total', 'counter', 'CPU time of the calling process', 'cpu_s'),
+            ('stage_children_cpu_seconds_total', 'counter', 'CPU time of the pool workers', 'children_cpu_s'),
+            ('stage_rows_in_total', 'counter', 'Input rows', 'rows_in'),
+            ('stage_rows_out_total', 'counter', 'Output rows', 'rows_out'),
+            ('stage_payload_bytes_total', 'counter', 'Pickled bytes sent to pool workers', 'payload_bytes'),
+            ('stage_rss_bytes', 'gauge', 'Resident set size at the end of the stage', 'rss_bytes'),
+            ('stage_rss_delta_bytes', 'gauge', 'Change of the resident set size over the stage', 'rss_delta_bytes'),
+            ('process_peak_rss_bytes', 'gauge', 'Peak resident set size of the process since it started, at the end of the stage', 'process_peak_rss_bytes'),
+        ]
+        names = list(dict.fromkeys(record['name'] for record in self.records))
+        lines = []
+        for metric, kind, description, field in metrics:
+            lines.append('# HELP {}_{} {}'.format(prefix, metric, description))
+            lines.append('# TYPE {}_{} {}'.format(prefix, metric, kind))
+            for name in names:
+                records = [record for record in self.records if record['name'] == name]
+                if field is None:
+                    value = len(records)
+                else:
+                    values = [record[field] for record in records if record.get(field) is not None]
+                    if not values:
+                        continue
+                    value = max(values) if kind == 'gauge' else sum(values)
+                lines.append('{}_{}{{stage="{}"}} {}'.format(prefix, metric, name, value))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,22 @@
+import importlib
+
+
+class LazyModule:
+    """Stands for a module that is only imported when one of its attributes is first used, so that importing mobilipy doesn't pay for heavy dependencies (sklearn, skfuzzy, shapely, folium) that a given job never needs.
+    """
+    def __init__(self, name):
+        """Creates the placeholder, without importing anything.
+
+        Args:
+            name (str): Full name of the module, e.g. 'sklearn.cluster'
+        """
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attribute):
+        # Only called for attributes not found yet, they are then kept on the instance
+        value = getattr(importlib.import_module(self._name), attribute)
+        self.__dict__[attribute] = value
+        return value
+
+    def __repr__(self):
+        return '<lazy module {}>'.format(self._name)
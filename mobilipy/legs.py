@@ -2,9 +2,11 @@ import pandas as pd
 import numpy as np
 import more_itertools as mit
 import datetime
-import multiprocessing as mp
-from shapely.geometry import MultiPoint
-from haversine import haversine, Unit
+from mobilipy import execution
+from mobilipy.instrumentation import instrumented
+from mobilipy.lazy import LazyModule
+
+shapely_geometry = LazyModule('shapely.geometry')
 
 
 
@@ -18,6 +20,82 @@ LEG_FEATURES = [
     "geometry",
 ]
 
+def _to_utc_nanoseconds(timestamps) -> np.ndarray:
+    """Converts timestamps to nanoseconds since the epoch in UTC. Naive timestamps and strings without offset are assumed to be in UTC.
+
+    Args:
+        timestamps (pandas.Series): Timestamps as datetimes or ISO strings
+
+    Returns:
+        numpy.ndarray: int64 nanoseconds since the epoch
+    """
+    return pd.DatetimeIndex(pd.to_datetime(pd.Series(timestamps), utc=True)).asi8
+
+
+class LegPointIndex:
+    """Interval index mapping each leg to the waypoints recorded during it. Waypoints are sorted once by timestamp, so that the points of a leg are a contiguous slice found with two binary searches.
+    """
+    def __init__(self, legs, waypoints):
+        """Builds the index.
+
+        Args:
+            legs (pandas.DataFrame): DataFrame with legs, coming from get_user_legs
+            waypoints (pandas.DataFrame): DataFrame with a tracked_at column
+        """
+        times = _to_utc_nanoseconds(waypoints.tracked_at)
+        if np.any(times[1:] < times[:-1]):
+            order = np.argsort(times, kind='stable')
+            waypoints = waypoints.iloc[order]
+            times = times[order]
+        self.waypoints = waypoints
+        """Waypoints sorted by timestamp"""
+
+        starts = _to_utc_nanoseconds(legs.started_at)
+        ends = _to_utc_nanoseconds(legs.finished_at)
+        self.starts = np.searchsorted(times, starts, side='left')
+        """Position in self.waypoints of the first point of each leg"""
+        self.ends = np.searchsorted(times, ends, side='right')
+        """Position in self.waypoints after the last point of each leg"""
+
+        # A waypoint on the boundary of two legs goes to the later one
+        order = np.argsort(starts, kind='stable')
+        candidates = np.searchsorted(starts[order], times, side='right') - 1
+        leg_ids = np.where(candidates >= 0, order[np.maximum(candidates, 0)], -1)
+        self.leg_ids = np.where((leg_ids >= 0) & (times <= ends[np.maximum(leg_ids, 0)]), leg_ids, -1)
+        """Position in legs of the leg each waypoint of self.waypoints belongs to, -1 if none"""
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def counts(self) -> np.ndarray:
+        """Number of waypoints of each leg
+        """
+        return self.ends - self.starts
+
+    def slice(self, leg) -> slice:
+        """Range of the waypoints of the given leg
+
+        Args:
+            leg (int): Position of the leg in legs
+
+        Returns:
+            slice: Slice of self.waypoints, also valid on arrays aligned with it
+        """
+        return slice(self.starts[leg], self.ends[leg])
+
+    def points(self, leg) -> pd.DataFrame:
+        """Waypoints of the given leg, as a slice of self.waypoints without copy
+
+        Args:
+            leg (int): Position of the leg in legs
+
+        Returns:
+            pandas.DataFrame: Waypoints recorded between the start and the end of the leg, both included
+        """
+        return self.waypoints.iloc[self.starts[leg]:self.ends[leg]]
+
+
 def _append_one_category(args):
     """
 
@@ -39,7 +117,7 @@ def _append_one_category(args):
     purpose = np.nan
     type_ = category_name
     if type_ == "Stay":
-        points = MultiPoint(list(df.loc[df.index[indexes], ["latitude_start","longitude_start"]].values))
+        points = shapely_geometry.MultiPoint(list(df.loc[df.index[indexes], ["latitude_start","longitude_start"]].values))
         #diameter = haversine((points.bounds[0], points.bounds[1]), (points.bounds[2], points.bounds[3])) * 1000
         geometry = [(points.centroid.x, points.centroid.y)] #, diameter)
     else:
@@ -61,7 +139,8 @@ def _append_one_category(args):
     return res
 
 
-def get_user_legs(df, user_id, use_multiprocessing=True) -> pd.DataFrame:
+@instrumented('get_user_legs')
+def get_user_legs(df, user_id, use_multiprocessing='auto') -> pd.DataFrame:
     
     """
     Builds the legs DataFrame for the given user.
@@ -69,7 +148,7 @@ def get_user_legs(df, user_id, use_multiprocessing=True) -> pd.DataFrame:
     Args:
         df (pandas.DataFrame): waypoints DataFrame
         user_id (str): ID of the user whose legs are to be created
-        use_multiprocessing (bool, optional): Specifies whether the multiprocessing package should be used. Defaults to True.
+        use_multiprocessing (bool or str, optional): True for processes, False for serial, or a policy of the execution module. Defaults to 'auto', chosen by the cost model.
 
     Returns:
         pandas.DataFrame: DataFrame of user's legs
@@ -93,42 +172,12 @@ def get_user_legs(df, user_id, use_multiprocessing=True) -> pd.DataFrame:
     arguments_walks = [list(x) for x in mit.consecutive_groups(walks)]
     arguments_walks = list(map(lambda x: (x, df, user_id, "Track"), arguments_walks))
 
-    if use_multiprocessing:
-        pool = mp.Pool(processes = (mp.cpu_count() - 1))
-        result = pool.map_async(_append_one_category, arguments_act)
-        pool.close()
-        pool.join()
-        for res_ in result.get(timeout=1):
-            res += res_
-    else:
-        for argument_list in arguments_act:
-            res_ = _append_one_category(argument_list)
-            res += res_
-    
-    if use_multiprocessing:
-        pool = mp.Pool(processes = (mp.cpu_count() - 1))
-        result = pool.map_async(_append_one_category, arguments_trips)
-        pool.close()
-        pool.join()
-        for res_ in result.get(timeout=1):
-            res += res_
-    else:
-        for argument_list in arguments_trips:
-            res_ = _append_one_category(argument_list)
-            res += res_
-
-       
-    if use_multiprocessing:
-        pool = mp.Pool(processes = (mp.cpu_count() - 1))
-        result = pool.map_async(_append_one_category, arguments_walks)
-        pool.close()
-        pool.join()
-        for res_ in result.get(timeout=1):
-            res += res_
-    else:
-        for argument_list in arguments_walks:
-            res_ = _append_one_category(argument_list)
-            res += res_
+    # one pool for the three categories, each task carrying the whole DataFrame
+    arguments = arguments_act + arguments_trips + arguments_walks
+    execution_plan = execution.plan('get_user_legs', [len(argument[0]) for argument in arguments], use_multiprocessing,
+                                    payload_bytes=len(arguments) * int(df.memory_usage(deep=False).sum()))
+    for res_ in execution.execute(_append_one_category, arguments, execution_plan):
+        res += res_
     
     res = pd.DataFrame(res, columns=LEG_FEATURES)
     res = res.sort_values(by='started_at')
@@ -0,0 +1,656 @@
+import os
+import io
+import json
+import heapq
+from functools import cached_property
+import numpy as np
+import pandas as pd
+from numba import njit, types
+from mobilipy import geodesy, instrumentation
+from mobilipy.constants import TRACK
+from mobilipy.gtfs_helper import _is_fresh
+from mobilipy.lazy import LazyModule
+
+osmium = LazyModule('osmium')
+numba_typed = LazyModule('numba.typed')
+
+SIGMA_M = 10.0
+"""Standard deviation of the distance between a point and the road it was recorded on, in meters"""
+
+BETA_M = 30.0
+"""Scale of the difference between the route distance and the great-circle distance of two consecutive points, in meters. Smaller values favour direct routes."""
+
+SEARCH_RADIUS_M = 50.0
+"""Roads farther than this from a point aren't candidates for it, in meters"""
+
+MAX_CANDIDATES = 8
+"""Number of closest road positions kept as candidates for each point"""
+
+ROUTE_FACTOR = 3.0
+"""Routes between two consecutive points longer than ROUTE_FACTOR times their great-circle distance plus ROUTE_SLACK_M aren't searched"""
+
+ROUTE_SLACK_M = 2 * SEARCH_RADIUS_M
+"""Route length allowed on top of ROUTE_FACTOR times the great-circle distance, in meters"""
+
+CELL_SIZE_M = 100.0
+"""Size of the square cells of the spatial edge index, in meters"""
+
+ROUTE_CACHE_SIZE = 1000000
+"""Number of shortest-path distances a MapMatcher keeps between legs before starting afresh"""
+
+ONEWAY_FORWARD = ('yes', 'true', '1')
+ONEWAY_BACKWARD = ('-1', 'reverse')
+
+_COORDINATE_SCALE = 1e7
+_CELL_OFFSET = 2 ** 20
+_CELL_STRIDE = 2 ** 21
+
+
+def _direction(properties) -> int:
+    """Directions a way can be travelled in from its OSM-like tags: 0 both, 1 along its points, -1 against them"""
+    oneway = str(properties.get('oneway', '')).lower()
+    if oneway in ONEWAY_FORWARD or (properties.get('junction') == 'roundabout' and oneway != 'no'):
+        return 1
+    if oneway in ONEWAY_BACKWARD:
+        return -1
+    return 0
+
+@njit(cache=True)
+def _thin(latitudes, longitudes, min_step):
+    """Keeps the first and last points and the ones at least min_step meters away from the previous kept point"""
+    n = latitudes.shape[0]
+    kept = np.zeros(n, dtype=np.bool_)
+    last = 0
+    for i in range(n):
+        if i == 0 or i == n - 1 or geodesy.haversine(latitudes[last], longitudes[last], latitudes[i], longitudes[i]) >= min_step:
+            kept[i] = True
+            last = i
+    return kept
+
+@njit(cache=True)
+def _index_cells(x, y, edge_sources, edge_targets, cell_size):
+    """Cells of the spatial index overlapped by the bounding box of each edge
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): Cell keys and edge of each (cell, edge) pair
+    """
+    n_edges = edge_sources.shape[0]
+    first_x = np.empty(n_edges, dtype=np.int64)
+    first_y = np.empty(n_edges, dtype=np.int64)
+    last_x = np.empty(n_edges, dtype=np.int64)
+    last_y = np.empty(n_edges, dtype=np.int64)
+    total = 0
+    for e in range(n_edges):
+        a = edge_sources[e]
+        b = edge_targets[e]
+        first_x[e] = int(np.floor(min(x[a], x[b]) / cell_size))
+        first_y[e] = int(np.floor(min(y[a], y[b]) / cell_size))
+        last_x[e] = int(np.floor(max(x[a], x[b]) / cell_size))
+        last_y[e] = int(np.floor(max(y[a], y[b]) / cell_size))
+        total += (last_x[e] - first_x[e] + 1) * (last_y[e] - first_y[e] + 1)
+
+    keys = np.empty(total, dtype=np.int64)
+    edges = np.empty(total, dtype=np.int64)
+    k = 0
+    for e in range(n_edges):
+        for cx in range(first_x[e], last_x[e] + 1):
+            for cy in range(first_y[e], last_y[e] + 1):
+                keys[k] = (cx + _CELL_OFFSET) * _CELL_STRIDE + cy + _CELL_OFFSET
+                edges[k] = e
+                k += 1
+    return keys, edges
+
+@njit(cache=True)
+def _candidates(px, py, cell_keys, cell_edges, x, y, edge_sources, edge_targets, cell_size, radius, edges, fractions, distances):
+    """Closest positions on the edges within the radius of each point, sorted by distance and without duplicates, written to rows of edges, fractions and distances padded with -1"""
+    k = edges.shape[1]
+    for i in range(px.shape[0]):
+        n = 0
+        for cx in range(int(np.floor((px[i] - radius) / cell_size)), int(np.floor((px[i] + radius) / cell_size)) + 1):
+            for cy in range(int(np.floor((py[i] - radius) / cell_size)), int(np.floor((py[i] + radius) / cell_size)) + 1):
+                key = (cx + _CELL_OFFSET) * _CELL_STRIDE + cy + _CELL_OFFSET
+                for position in range(np.searchsorted(cell_keys, key), np.searchsorted(cell_keys, key, side='right')):
+                    e = cell_edges[position]
+                    a = edge_sources[e]
+                    b = edge_targets[e]
+                    dx = x[b] - x[a]
+                    dy = y[b] - y[a]
+                    squared_length = dx * dx + dy * dy
+                    fraction = 0.0
+                    if squared_length > 0:
+                        fraction = min(max(((px[i] - x[a]) * dx + (py[i] - y[a]) * dy) / squared_length, 0.0), 1.0)
+                    distance = np.hypot(px[i] - x[a] - fraction * dx, py[i] - y[a] - fraction * dy)
+                    if distance > radius or (n == k and distance >= distances[i, n - 1]):
+                        continue
+                    # an edge found in several cells has the same distance every time
+                    duplicate = False
+                    for j in range(n):
+                        if edges[i, j] == e:
+                            duplicate = True
+                    if duplicate:
+                        continue
+                    j = min(n, k - 1)
+                    while j > 0 and distances[i, j - 1] > distance:
+                        edges[i, j] = edges[i, j - 1]
+                        fractions[i, j] = fractions[i, j - 1]
+                        distances[i, j] = distances[i, j - 1]
+                        j -= 1
+                    edges[i, j] = e
+                    fractions[i, j] = fraction
+                    distances[i, j] = distance
+                    n = min(n + 1, k)
+        for j in range(n, k):
+            edges[i, j] = -1
+            fractions[i, j] = -1.0
+            distances[i, j] = -1.0
+
+@njit(cache=True)
+def _dijkstra(offsets, targets, lengths, source, bound, goals, distances, predecessors, touched) -> int:
+    """Shortest paths from source, stopped once every goal node is settled or the bound is exceeded. distances must be infinite on entry and is left filled for the nodes listed in touched, to be reset by the caller.
+
+    Returns:
+        int: Number of touched nodes
+    """
+    distances[source] = 0.0
+    predecessors[source] = -1
+    touched[0] = source
+    n_touched = 1
+    remaining = goals.shape[0]
+    heap = [(0.0, source)]
+    while len(heap) > 0:
+        distance, node = heapq.heappop(heap)
+        if distance > distances[node]:
+            continue
+        for goal in goals:
+            if goal == node:
+                remaining -= 1
+        if remaining <= 0:
+            break
+        for e in range(offsets[node], offsets[node + 1]):
+            target = targets[e]
+            candidate = distance + lengths[e]
+            if candidate < distances[target] and candidate <= bound:
+                if distances[target] == np.inf:
+                    touched[n_touched] = target
+                    n_touched += 1
+                distances[target] = candidate
+                predecessors[target] = e
+                heapq.heappush(heap, (candidate, target))
+    return n_touched
+
+@njit(cache=True)
+def _viterbi(steps, edges, fractions, distances, offsets, targets, lengths, edge_sources, edge_targets, sigma, beta, route_factor, route_slack,
+             node_distances, predecessors, touched, route_cache):
+    """Most likely sequence of candidates of a Hidden Markov Model with Gaussian emissions and exponential transitions on the difference between route and great-circle distances. Shortest paths from one node are searched once per step for all the candidates of the next point, and their lengths kept in route_cache across calls. When no candidate can follow any previous one, the sequence is broken and restarted.
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): Chosen candidate of each point, and whether a new sequence starts at each point
+    """
+    n, k = edges.shape
+    n_nodes = offsets.shape[0] - 1
+    scores = np.full(k, -np.inf)
+    new_scores = np.empty(k)
+    back = np.full((n, k), -1, dtype=np.int64)
+    breaks = np.zeros(n, dtype=np.bool_)
+    last_best = np.full(n, -1, dtype=np.int64)
+    breaks[0] = True
+    for j in range(k):
+        if edges[0, j] >= 0:
+            scores[j] = -0.5 * (distances[0, j] / sigma) ** 2
+
+    for t in range(1, n):
+        bound = route_factor * steps[t - 1] + route_slack
+        new_scores[:] = -np.inf
+        goals = np.empty(k, dtype=np.int64)
+        n_goals = 0
+        for j in range(k):
+            if edges[t, j] >= 0:
+                goals[n_goals] = edge_sources[edges[t, j]]
+                n_goals += 1
+        goals = goals[:n_goals]
+
+        for i in range(k):
+            if scores[i] == -np.inf:
+                continue
+            previous = edges[t - 1, i]
+            source = edge_targets[previous]
+            searched = False
+            for j in range(k):
+                current = edges[t, j]
+                if current < 0:
+                    continue
+                if current == previous:
+                    # noise moves points slightly backwards along their edge
+                    route = abs(fractions[t, j] - fractions[t - 1, i]) * lengths[previous]
+                else:
+                    key = source * n_nodes + edge_sources[current]
+                    if key not in route_cache and not searched:
+                        n_touched = _dijkstra(offsets, targets, lengths, source, bound, goals, node_distances, predecessors, touched)
+                        for goal in goals:
+                            if node_distances[goal] < np.inf:
+                                route_cache[source * n_nodes + goal] = node_distances[goal]
+                        for position in range(n_touched):
+                            node_distances[touched[position]] = np.inf
+                        searched = True
+                    if key not in route_cache:
+                        continue
+                    route = (1 - fractions[t - 1, i]) * lengths[previous] + route_cache[key] + fractions[t, j] * lengths[current]
+                if route > bound:
+                    continue
+                score = scores[i] - abs(route - steps[t - 1]) / beta - 0.5 * (distances[t, j] / sigma) ** 2
+                if score > new_scores[j]:
+                    new_scores[j] = score
+                    back[t, j] = i
+
+        if np.max(new_scores) == -np.inf:
+            breaks[t] = True
+            last_best[t - 1] = np.argmax(scores)
+            for j in range(k):
+                new_scores[j] = -0.5 * (distances[t, j] / sigma) ** 2 if edges[t, j] >= 0 else -np.inf
+        scores[:] = new_scores
+
+    choices = np.empty(n, dtype=np.int64)
+    choices[n - 1] = np.argmax(scores)
+    for t in range(n - 1, 0, -1):
+        choices[t - 1] = last_best[t - 1] if breaks[t] else back[t, choices[t]]
+    return choices, breaks
+
+@njit(cache=True)
+def _routes(edges, fractions, choices, breaks, steps, offsets, targets, lengths, edge_sources, edge_targets, route_factor, route_slack,
+            node_distances, predecessors, touched):
+    """Edges travelled between consecutive chosen candidates
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray): Offsets of the route edges of each point, route edges (the edges entered after leaving the previous candidate's edge, up to and including the candidate's edge) and route length to each point in meters
+    """
+    n = choices.shape[0]
+    route_offsets = np.zeros(n + 1, dtype=np.int64)
+    route_edges = []
+    route_lengths = np.zeros(n)
+    goal = np.empty(1, dtype=np.int64)
+    for t in range(n):
+        current = edges[t, choices[t]]
+        if breaks[t]:
+            route_edges.append(current)
+        else:
+            previous = edges[t - 1, choices[t - 1]]
+            if current == previous:
+                # signed, so that points jittering back and forth along an edge add up to their net progress
+                route_lengths[t] = (fractions[t, choices[t]] - fractions[t - 1, choices[t - 1]]) * lengths[current]
+            else:
+                source = edge_targets[previous]
+                goal[0] = edge_sources[current]
+                n_touched = _dijkstra(offsets, targets, lengths, source, route_factor * steps[t - 1] + route_slack, goal,
+                                      node_distances, predecessors, touched)
+                route_lengths[t] = (1 - fractions[t - 1, choices[t - 1]]) * lengths[previous] + node_distances[goal[0]] + fractions[t, choices[t]] * lengths[current]
+                path = []
+                node = goal[0]
+                while node != source:
+                    path.append(predecessors[node])
+                    node = edge_sources[predecessors[node]]
+                for position in range(len(path) - 1, -1, -1):
+                    route_edges.append(path[position])
+                route_edges.append(current)
+                for position in range(n_touched):
+                    node_distances[touched[position]] = np.inf
+        route_offsets[t + 1] = len(route_edges)
+    res = np.empty(len(route_edges), dtype=np.int64)
+    for position in range(len(route_edges)):
+        res[position] = route_edges[position]
+    return route_offsets, res, route_lengths
+
+
+class RoadGraph:
+    """Directed road graph in compressed sparse row form: the edges leaving node u are edge_targets[offsets[u]:offsets[u + 1]]. Each edge is a straight segment between two consecutive points of a way, two-way roads giving one edge per direction. Nodes are projected once on a plane around the center of the graph, where a grid of cells indexes the edges.
+
+    The projection being equirectangular, it suits extracts spanning up to a few hundred kilometers.
+    """
+    def __init__(self, latitudes, longitudes, edge_sources, edge_targets, edge_ways, ways=None):
+        """Builds the graph from its nodes and edges.
+
+        Args:
+            latitudes (numpy.ndarray): Latitudes of the nodes in degrees
+            longitudes (numpy.ndarray): Longitudes of the nodes in degrees
+            edge_sources (numpy.ndarray): Node each edge starts from
+            edge_targets (numpy.ndarray): Node each edge ends at
+            edge_ways (numpy.ndarray): Position in ways of the way each edge belongs to
+            ways (pandas.DataFrame, optional): Properties of the ways, e.g. 'highway' and 'name'. Defaults to None.
+        """
+        self.latitudes = np.ascontiguousarray(latitudes, dtype=np.float64)
+        self.longitudes = np.ascontiguousarray(longitudes, dtype=np.float64)
+        order = np.argsort(edge_sources, kind='stable')
+        self.edge_sources = np.ascontiguousarray(np.asarray(edge_sources, dtype=np.int64)[order])
+        """Node each edge starts from, edges being sorted by it"""
+        self.edge_targets = np.ascontiguousarray(np.asarray(edge_targets, dtype=np.int64)[order])
+        """Node each edge ends at"""
+        self.edge_ways = np.asarray(edge_ways, dtype=np.int64)[order]
+        """Position in self.ways of the way each edge belongs to"""
+        self.edge_lengths = geodesy.distance(self.latitudes[self.edge_sources], self.longitudes[self.edge_sources],
+                                             self.latitudes[self.edge_targets], self.longitudes[self.edge_targets])
+        """Length of each edge in meters"""
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(self.edge_sources, minlength=self.latitudes.shape[0])))).astype(np.int64)
+        """Offsets of the edges leaving each node"""
+        self.ways = ways if ways is not None else pd.DataFrame(index=pd.RangeIndex(int(self.edge_ways.max(initial=-1)) + 1))
+        """Properties of the ways"""
+
+        empty = self.latitudes.shape[0] == 0
+        self.latitude0 = 0.0 if empty else float((self.latitudes.min() + self.latitudes.max()) / 2)
+        """Latitude of the center of the projection"""
+        self.longitude0 = 0.0 if empty else float((self.longitudes.min() + self.longitudes.max()) / 2)
+        """Longitude of the center of the projection"""
+        self.x, self.y = geodesy.project(self.latitudes, self.longitudes, self.latitude0, self.longitude0)
+
+    @classmethod
+    def from_lines(cls, lines, directions=None, ways=None):
+        """Builds the graph from polylines, points shared by several lines (at 1e-7 degrees) becoming the same node.
+
+        Args:
+            lines (list(numpy.ndarray)): Points of each way, as arrays of (latitude, longitude) rows
+            directions (list(int), optional): Directions each way can be travelled in: 0 both, 1 along its points, -1 against them. Defaults to both for every way.
+            ways (pandas.DataFrame, optional): Properties of the ways, one row per line. Defaults to None.
+
+        Returns:
+            RoadGraph: Graph
+        """
+        lines = [np.asarray(line, dtype=np.float64).reshape(-1, 2) for line in lines]
+        counts = np.array([line.shape[0] for line in lines], dtype=np.int64)
+        points = np.concatenate(lines) if lines else np.empty((0, 2))
+        quantized = np.round(points * _COORDINATE_SCALE).astype(np.int64)
+        nodes, keys = pd.factorize((quantized[:, 0] + 900000000) * 2 ** 32 + quantized[:, 1] + 1800000000)
+        first = np.empty(keys.shape[0], dtype=np.int64)
+        first[nodes] = np.arange(nodes.shape[0])
+
+        line_ids = np.repeat(np.arange(len(lines)), counts)
+        consecutive = np.flatnonzero((line_ids[1:] == line_ids[:-1]) & (nodes[1:] != nodes[:-1]))
+        sources, targets, way_ids = nodes[consecutive], nodes[consecutive + 1], line_ids[consecutive]
+        directions = np.zeros(len(lines), dtype=np.int64) if directions is None else np.asarray(directions, dtype=np.int64)
+        forward = directions[way_ids] >= 0
+        backward = directions[way_ids] <= 0
+        return cls(points[first, 0], points[first, 1],
+                   np.concatenate((sources[forward], targets[backward])), np.concatenate((targets[forward], sources[backward])),
+                   np.concatenate((way_ids[forward], way_ids[backward])), ways)
+
+    @classmethod
+    def from_geojson(cls, path):
+        """Reads the LineString and MultiLineString features of a GeoJSON file, e.g. a road extract exported from OpenStreetMap. An 'oneway' property of 'yes' or '-1' makes a way one-way.
+
+        Args:
+            path (str): Path of the GeoJSON file
+
+        Returns:
+            RoadGraph: Graph, with the feature properties in ways
+        """
+        with open(path, encoding='utf-8') as file:
+            features = json.load(file).get('features', [])
+        lines = []
+        directions = []
+        properties = []
+        for feature in features:
+            geometry = feature.get('geometry') or {}
+            parts = {'LineString': [geometry.get('coordinates')], 'MultiLineString': geometry.get('coordinates')}.get(geometry.get('type'), [])
+            for part in parts:
+                if part and len(part) > 1:
+                    # GeoJSON positions are (longitude, latitude)
+                    lines.append(np.asarray(part, dtype=np.float64)[:, 1::-1])
+                    directions.append(_direction(feature.get('properties') or {}))
+                    properties.append(feature.get('properties') or {})
+        return cls.from_lines(lines, directions, pd.DataFrame(properties, index=pd.RangeIndex(len(properties))))
+
+    @classmethod
+    def from_pbf(cls, path, highways=None):
+        """Reads the highways of an OpenStreetMap PBF extract. Requires the osmium package.
+
+        Args:
+            path (str): Path of the .osm.pbf file
+            highways (list(str), optional): Values of the highway tag to be kept, e.g. ['primary', 'residential']. Defaults to every highway.
+
+        Returns:
+            RoadGraph: Graph, with 'osm_id', 'highway', 'name' and 'oneway' columns in ways
+        """
+        lines = []
+        directions = []
+        properties = []
+
+        class Handler(osmium.SimpleHandler):
+            def way(self, way):
+                highway = way.tags.get('highway')
+                if highway is None or (highways is not None and highway not in highways):
+                    return
+                points = [(node.lat, node.lon) for node in way.nodes if node.location.valid()]
+                if len(points) < 2:
+                    return
+                tags = {'osm_id': way.id, 'highway': highway, 'name': way.tags.get('name'),
+                        'oneway': way.tags.get('oneway'), 'junction': way.tags.get('junction')}
+                lines.append(points)
+                directions.append(_direction(tags))
+                properties.append(tags)
+
+        Handler().apply_file(path, locations=True)
+        return cls.from_lines(lines, directions, pd.DataFrame(properties, index=pd.RangeIndex(len(properties))))
+
+    def save(self, path):
+        """Writes the graph to a .npz file, read back with load
+
+        Args:
+            path (str): Path of the file
+        """
+        np.savez(path, latitudes=self.latitudes, longitudes=self.longitudes, edge_sources=self.edge_sources,
+                 edge_targets=self.edge_targets, edge_ways=self.edge_ways, ways=np.array(self.ways.to_json(orient='split')))
+
+    @classmethod
+    def load(cls, path):
+        """Reads a graph written by save
+
+        Args:
+            path (str): Path of the .npz file
+
+        Returns:
+            RoadGraph: Graph
+        """
+        with np.load(path) as arrays:
+            ways = pd.read_json(io.StringIO(str(arrays['ways'])), orient='split', dtype=False, convert_dates=False)
+            return cls(arrays['latitudes'], arrays['longitudes'], arrays['edge_sources'], arrays['edge_targets'], arrays['edge_ways'],
+                       ways.reset_index(drop=True))
+
+    @cached_property
+    def edge_index(self):
+        """Grid over the projected edges, built on first use: sorted cell keys and the edge of each of them
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray): Cell keys and edges
+        """
+        keys, edges = _index_cells(self.x, self.y, self.edge_sources, self.edge_targets, CELL_SIZE_M)
+        order = np.argsort(keys, kind='stable')
+        return keys[order], edges[order]
+
+    @property
+    def n_nodes(self) -> int:
+        return self.latitudes.shape[0]
+
+    @property
+    def n_edges(self) -> int:
+        return self.edge_sources.shape[0]
+
+    def candidates(self, latitudes, longitudes, radius=SEARCH_RADIUS_M, k=MAX_CANDIDATES):
+        """Finds the closest positions on the edges around each point.
+
+        Args:
+            latitudes (numpy.ndarray): Latitudes in degrees
+            longitudes (numpy.ndarray): Longitudes in degrees
+            radius (float, optional): Search radius in meters. Defaults to SEARCH_RADIUS_M.
+            k (int, optional): Maximal number of candidates per point. Defaults to MAX_CANDIDATES.
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray, numpy.ndarray): Edges, fractions of the edges from their source and distances in meters, of shape (n_points, k), sorted by distance and padded with -1
+        """
+        px, py = geodesy.project(np.asarray(latitudes, dtype=np.float64), np.asarray(longitudes, dtype=np.float64), self.latitude0, self.longitude0)
+        edges = np.empty((px.shape[0], k), dtype=np.int64)
+        fractions = np.empty((px.shape[0], k))
+        distances = np.empty((px.shape[0], k))
+        cell_keys, cell_edges = self.edge_index
+        _candidates(px, py, cell_keys, cell_edges, self.x, self.y, self.edge_sources, self.edge_targets, CELL_SIZE_M, radius, edges, fractions, distances)
+        return edges, fractions, distances
+
+    def positions(self, edges, fractions):
+        """Coordinates of positions along edges
+
+        Args:
+            edges (numpy.ndarray): Edges
+            fractions (numpy.ndarray): Fractions of the edges from their source
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray): Latitudes and longitudes in degrees
+        """
+        sources, targets = self.edge_sources[edges], self.edge_targets[edges]
+        return (self.latitudes[sources] + fractions * (self.latitudes[targets] - self.latitudes[sources]),
+                self.longitudes[sources] + fractions * (self.longitudes[targets] - self.longitudes[sources]))
+
+
+def read_road_graph(path, cache=True, highways=None) -> RoadGraph:
+    """Reads a road graph from a GeoJSON file (.geojson or .json), an OpenStreetMap PBF extract (.pbf) or a file written by RoadGraph.save (.npz).
+
+    Args:
+        path (str): Path of the file
+        cache (bool, optional): Specifies whether a GeoJSON or PBF file should be converted once to a .npz file stored next to it, and reused until the source changes. Defaults to True.
+        highways (list(str), optional): Values of the highway tag to be kept from a PBF extract. Defaults to every highway.
+
+    Returns:
+        RoadGraph: Graph
+    """
+    if path.endswith('.npz'):
+        return RoadGraph.load(path)
+    head, tail = os.path.split(os.path.abspath(path))
+    cache_path = os.path.join(head, '.' + tail + '.npz')
+    if cache and highways is None and _is_fresh(cache_path, path):
+        return RoadGraph.load(cache_path)
+
+    graph = RoadGraph.from_pbf(path, highways) if path.endswith('.pbf') else RoadGraph.from_geojson(path)
+    if cache and highways is None:
+        graph.save(cache_path)
+    return graph
+
+
+class MapMatcher:
+    """Matches GPS tracks to a RoadGraph with a Hidden Markov Model (Newson and Krumm, 2009). Candidates are the closest road positions within the search radius of each point, and transitions compare the shortest route between candidates with the great-circle distance between the points. The Viterbi search, shortest paths and candidate lookups are compiled with numba, and route lengths are cached across the legs matched by the same matcher.
+    """
+    def __init__(self, graph, sigma=SIGMA_M, beta=BETA_M, radius=SEARCH_RADIUS_M, max_candidates=MAX_CANDIDATES,
+                 route_factor=ROUTE_FACTOR, route_slack=ROUTE_SLACK_M, min_step=None):
+        """Creates a matcher.
+
+        Args:
+            graph (RoadGraph): Road graph
+            sigma (float, optional): Standard deviation of the GPS error, in meters. Defaults to SIGMA_M.
+            beta (float, optional): Scale of the transition probabilities, in meters. Defaults to BETA_M.
+            radius (float, optional): Search radius of the candidates, in meters. Defaults to SEARCH_RADIUS_M.
+            max_candidates (int, optional): Number of candidates per point. Defaults to MAX_CANDIDATES.
+            route_factor (float, optional): Longest route searched, relative to the great-circle distance. Defaults to ROUTE_FACTOR.
+            route_slack (float, optional): Route length allowed on top of it, in meters. Defaults to ROUTE_SLACK_M.
+            min_step (float, optional): Points closer than this to the previous matched point are skipped, as their noise would outweigh their move, in meters. Defaults to 2 * sigma.
+        """
+        self.graph = graph
+        self.sigma = sigma
+        self.beta = beta
+        self.radius = radius
+        self.max_candidates = max_candidates
+        self.route_factor = route_factor
+        self.route_slack = route_slack
+        self.min_step = 2 * sigma if min_step is None else min_step
+        self._node_distances = np.full(graph.n_nodes, np.inf)
+        self._predecessors = np.empty(graph.n_nodes, dtype=np.int64)
+        self._touched = np.empty(graph.n_nodes, dtype=np.int64)
+        self._route_cache = None
+
+    def _cache(self):
+        """Shortest-path distances between nodes, keyed by source * n_nodes + target, emptied when it grows past ROUTE_CACHE_SIZE"""
+        if self._route_cache is None or len(self._route_cache) > ROUTE_CACHE_SIZE:
+            self._route_cache = numba_typed.Dict.empty(key_type=types.int64, value_type=types.float64)
+        return self._route_cache
+
+    def match_points(self, latitudes, longitudes) -> dict:
+        """Matches one track.
+
+        Args:
+            latitudes (numpy.ndarray): Latitudes of the points in degrees, in time order
+            longitudes (numpy.ndarray): Longitudes of the points in degrees
+
+        Returns:
+            dict: 'edges' (edge of each point, -1 if it was skipped or no road is within the radius), 'latitude' and 'longitude' (matched positions, NaN if unmatched), 'route' (edges travelled, without consecutive repeats), 'geometry' (matched positions and the nodes between them, as [latitude, longitude] arrays), 'length' (meters travelled along the roads) and 'breaks' (number of times the sequence was restarted)
+        """
+        graph = self.graph
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        point_edges = np.full(latitudes.shape[0], -1, dtype=np.int64)
+        matched_latitudes = np.full(latitudes.shape[0], np.nan)
+        matched_longitudes = np.full(latitudes.shape[0], np.nan)
+        res = {'edges': point_edges, 'latitude': matched_latitudes, 'longitude': matched_longitudes,
+               'route': np.empty(0, dtype=np.int64), 'geometry': [], 'length': 0.0, 'breaks': 0}
+
+        kept = np.flatnonzero(_thin(latitudes, longitudes, self.min_step))
+        edges, fractions, distances = graph.candidates(latitudes[kept], longitudes[kept], self.radius, self.max_candidates)
+        found = edges[:, 0] >= 0
+        if not found.any():
+            return res
+        kept, edges, fractions, distances = kept[found], edges[found], fractions[found], distances[found]
+        steps = geodesy.consecutive_distance(latitudes[kept], longitudes[kept])
+
+        choices, breaks = _viterbi(steps, edges, fractions, distances, graph.offsets, graph.edge_targets, graph.edge_lengths,
+                                   graph.edge_sources, graph.edge_targets, self.sigma, self.beta, self.route_factor, self.route_slack,
+                                   self._node_distances, self._predecessors, self._touched, self._cache())
+        route_offsets, route_edges, route_lengths = _routes(edges, fractions, choices, breaks, steps, graph.offsets, graph.edge_targets,
+                                                            graph.edge_lengths, graph.edge_sources, graph.edge_targets, self.route_factor,
+                                                            self.route_slack, self._node_distances, self._predecessors, self._touched)
+
+        rows = np.arange(kept.shape[0])
+        chosen_edges = edges[rows, choices]
+        point_edges[kept] = chosen_edges
+        matched_latitudes[kept], matched_longitudes[kept] = graph.positions(chosen_edges, fractions[rows, choices])
+
+        geometry = []
+        for t in range(kept.shape[0]):
+            if not breaks[t]:
+                # nodes passed since the previous point: the sources of the edges entered
+                for edge in route_edges[route_offsets[t]:route_offsets[t + 1]]:
+                    node = graph.edge_sources[edge]
+                    geometry.append(np.array([graph.latitudes[node], graph.longitudes[node]]))
+            geometry.append(np.array([matched_latitudes[kept[t]], matched_longitudes[kept[t]]]))
+
+        route = route_edges[np.concatenate(([True], route_edges[1:] != route_edges[:-1]))] if route_edges.shape[0] else route_edges
+        res.update(route=route, geometry=geometry, length=float(route_lengths.sum()), breaks=int(breaks.sum()) - 1)
+        return res
+
+    def match_legs(self, legs, types=(TRACK,)) -> pd.DataFrame:
+        """Matches the geometry of legs, one after the other.
+
+        Args:
+            legs (pandas.DataFrame): DataFrame with legs, coming from legs.get_user_legs
+            types (tuple(str), optional): Types of the legs to be matched. Defaults to Track legs only.
+
+        Returns:
+            pandas.DataFrame: DataFrame indexed like the matched legs, with 'geometry' (matched line, as in legs), 'route' (edges of the graph travelled), 'length' (meters along the roads), 'points', 'matched_points' (points kept and within the radius of a road) and 'breaks' columns
+        """
+        columns = ['geometry', 'route', 'length', 'points', 'matched_points', 'breaks']
+        selected = legs[legs.type.isin(types)]
+        selected = selected[selected.geometry.map(len) > 1]
+        rows = []
+        for geometry in selected.geometry.values:
+            points = np.asarray([point for point in geometry], dtype=np.float64).reshape(-1, 2)
+            res = self.match_points(points[:, 0], points[:, 1])
+            rows.append((res['geometry'], res['route'], res['length'], points.shape[0], int((res['edges'] >= 0).sum()), res['breaks']))
+        return pd.DataFrame(rows, index=selected.index, columns=columns)
+
+
+@instrumentation.instrumented('map_matching')
+def match_legs(legs, graph, **kwargs) -> pd.DataFrame:
+    """Matches the Track legs of a legs table to a road graph
+
+    Args:
+        legs (pandas.DataFrame): DataFrame with legs, coming from legs.get_user_legs
+        graph (RoadGraph or str): Road graph, or the path of a file read with read_road_graph
+        **kwargs: Parameters of MapMatcher
+
+    Returns:
+        pandas.DataFrame: Matched legs, as MapMatcher.match_legs
+    """
+    if isinstance(graph, str):
+        graph = read_road_graph(graph)
+    return MapMatcher(graph, **kwargs).match_legs(legs)
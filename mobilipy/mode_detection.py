@@ -1,10 +1,23 @@
 import numpy as np
 import more_itertools as mit
-import skfuzzy as fuzz
-import multiprocessing as mp
 import pandas as pd
+from mobilipy import execution, instrumentation
+from mobilipy.lazy import LazyModule
+
+fuzz = LazyModule('skfuzzy')
 pd.options.mode.chained_assignment = None
 
+STOP_RADIUS_M = 50
+"""Distance from a public transport stop under which a point is considered to be at the stop, in meters"""
+DWELL_SPEED_TH = 1
+"""Speed under which a point of a trip is considered a dwell, in m/s"""
+TRANSIT_DWELL_RATIO = 0.5
+"""Minimal fraction of a trip's dwell points located at stops for the trip to be considered as public transport"""
+TRANSIT_MIN_STOPS = 2
+"""Minimal number of distinct stops passed for a trip to be considered as public transport"""
+TRANSIT_FEATURE_COLUMNS = ['stop_dwell_ratio', 'stops_passed', 'in_feed_area']
+"""Per-trip columns computed from the GTFS feed for _detect_modes, dropped before mode_detection returns"""
+
 def _detect_walks(args):
     """Tags the DataFrame at given indexes with 'walk' in the 'detection' column, for the points corresponding to walks
 
@@ -194,11 +207,80 @@ def _detect_modes(df):
     if medspeed_high_bool and acc95_high_bool:
         possible_modes.append("Car")
 
+    if 'stops_passed' in df.columns:
+        possible_modes = _apply_transit_features(possible_modes, medspeed_high_bool,
+                                                 df['stop_dwell_ratio'].iloc[0], df['stops_passed'].iloc[0],
+                                                 df['in_feed_area'].iloc[0])
+
     df['detected_mode'] = ",".join(possible_modes)
     return df
 
+def _apply_transit_features(possible_modes, medspeed_high, stop_dwell_ratio, stops_passed, in_feed_area):
+    """Refines the modes detected from speed and acceleration with the proximity of the trip to public transport stops. Car-like trips that dwell at stops become Urban (or Rail at high speed), while Urban and Rail trips that never pass a stop become Car, provided the trip lies within the area covered by the feed.
+
+    Args:
+        possible_modes (list(str)): Modes detected by the fuzzy engine
+        medspeed_high (bool): Whether the median speed of the trip is high
+        stop_dwell_ratio (float): Fraction of the trip's dwell points located at stops
+        stops_passed (int): Number of distinct stops passed by the trip
+        in_feed_area (bool): Whether all the points of the trip lie within the bounding box of the stops of the feed
+
+    Returns:
+        list(str): Refined list of modes
+    """
+    transit_mode = "Rail" if medspeed_high else "Urban"
+    if stop_dwell_ratio >= TRANSIT_DWELL_RATIO and stops_passed >= TRANSIT_MIN_STOPS:
+        possible_modes = [transit_mode if mode == "Car" else mode for mode in possible_modes]
+    elif stops_passed == 0 and in_feed_area:
+        possible_modes = ["Car" if mode in ("Urban", "Rail") else mode for mode in possible_modes]
+    return list(dict.fromkeys(possible_modes))
+
+def _add_transit_features(df, trip_groups, gtfs, stop_radius=STOP_RADIUS_M, dwell_speed_th=DWELL_SPEED_TH):
+    """Adds the TRANSIT_FEATURE_COLUMNS to the rows of the given trips. The points of all the trips are joined against the stop index of the GTFS feed in a single query.
 
-def mode_detection(df, speed_th=2.78, acceleration_th=0.5, minimal_walking_duration=100, minimal_trip_duration=120, use_multiprocessing=True):
+    Args:
+        df (pandas.DataFrame): DataFrame coming from the segmentation module
+        trip_groups (list(list(int))): Positions of the rows of each trip
+        gtfs (mobilipy.gtfs_helper.GTFS_Helper): GTFS feed covering the area of the trips
+        stop_radius (float, optional): Distance from a stop under which a point is at the stop, in meters. Defaults to STOP_RADIUS_M.
+        dwell_speed_th (float, optional): Speed under which a point is a dwell, in m/s. Defaults to DWELL_SPEED_TH.
+    """
+    df['stop_dwell_ratio'] = np.nan
+    df['stops_passed'] = np.nan
+    df['in_feed_area'] = False
+    if len(trip_groups) == 0:
+        return
+
+    lengths = np.array([len(group) for group in trip_groups])
+    rows = np.concatenate(trip_groups)
+    trip_ids = np.repeat(np.arange(len(trip_groups)), lengths)
+
+    latitudes, longitudes = df['latitude_start'].values[rows], df['longitude_start'].values[rows]
+    points, stops, _ = gtfs.stops_within(latitudes, longitudes, stop_radius)
+    near_stop = np.zeros(len(rows), dtype=bool)
+    near_stop[points] = True
+    dwell = df['speed'].values[rows] < dwell_speed_th
+
+    dwell_count = np.bincount(trip_ids, weights=dwell, minlength=len(trip_groups))
+    dwell_near_stop_count = np.bincount(trip_ids, weights=dwell & near_stop, minlength=len(trip_groups))
+    stop_dwell_ratio = np.divide(dwell_near_stop_count, dwell_count, out=np.zeros(len(trip_groups)), where=dwell_count > 0)
+
+    n_stops = len(gtfs.stops)
+    trip_stop_pairs = np.unique(trip_ids[points].astype(np.int64) * n_stops + stops)
+    stops_passed = np.bincount(trip_stop_pairs // n_stops, minlength=len(trip_groups))
+
+    df.iloc[rows, df.columns.get_loc('stop_dwell_ratio')] = np.repeat(stop_dwell_ratio, lengths)
+    df.iloc[rows, df.columns.get_loc('stops_passed')] = np.repeat(stops_passed, lengths)
+
+    stop_lat, stop_lon = gtfs.stops.stop_lat.values, gtfs.stops.stop_lon.values
+    outside = ((latitudes < stop_lat.min()) | (latitudes > stop_lat.max())
+               | (longitudes < stop_lon.min()) | (longitudes > stop_lon.max()))
+    in_feed_area = np.bincount(trip_ids, weights=outside, minlength=len(trip_groups)) == 0
+    df.iloc[rows, df.columns.get_loc('in_feed_area')] = np.repeat(in_feed_area, lengths)
+
+
+@instrumentation.instrumented('mode_detection')
+def mode_detection(df, speed_th=2.78, acceleration_th=0.5, minimal_walking_duration=100, minimal_trip_duration=120, use_multiprocessing='auto', gtfs=None, stop_radius=STOP_RADIUS_M):
     """Tags the DataFrame at 'trip' indexes with detected modes in the 'detected_mode' column.
 
     Args:
@@ -207,7 +289,9 @@ def mode_detection(df, speed_th=2.78, acceleration_th=0.5, minimal_walking_durat
         acceleration_th (float, optional): The walk acceleration threshold. Defaults to 0.5.
         minimal_walking_duration (int, optional): The walk duration threshold. Defaults to 100.
         minimal_trip_duration (int, optional): The minimal trip duration threshold. Defaults to 120.
-        use_multiprocessing (bool, optional): Specifies whether the multiprocessing package should be used. Defaults to True.
+        use_multiprocessing (bool or str, optional): True for processes, False for serial, or a policy of the execution module. Defaults to 'auto', chosen by the cost model.
+        gtfs (mobilipy.gtfs_helper.GTFS_Helper, optional): GTFS feed used to tell public transport from car trips by their proximity to stops. Defaults to None.
+        stop_radius (float, optional): Distance from a stop under which a point is at the stop, in meters. Defaults to STOP_RADIUS_M.
 
     Returns:
         pandas.DataFrame: Segments DataFrame with modes of transport tagged in the mode_detected column.
@@ -219,38 +303,27 @@ def mode_detection(df, speed_th=2.78, acceleration_th=0.5, minimal_walking_durat
     arguments = list(
         map(lambda x: (df.iloc[x], speed_th, acceleration_th, minimal_walking_duration, minimal_trip_duration), arguments))
 
-    if use_multiprocessing:
-        pool = mp.Pool(processes=(mp.cpu_count() - 1))
-        results = pool.map_async(_detect_walks, arguments)
-        pool.close()
-        pool.join()
-
-        for res in results.get(timeout=1):
-            df.loc[res.index] = res
-    else:
-        for argument_list in arguments:
-            res = _detect_walks(argument_list)
+    with instrumentation.span('mode_detection.walks', df.shape[0]) as step:
+        execution_plan = execution.plan('mode_detection.walks', [argument[0].shape[0] for argument in arguments], use_multiprocessing)
+        for res in execution.execute(_detect_walks, arguments, execution_plan, step):
             df.loc[res.index] = res
 
     # Pool on speed detection also
     user_trips = df[df.detection == "trip"].index.values
 
     arguments = [list(x) for x in mit.consecutive_groups(user_trips)]
+    if gtfs is not None:
+        with instrumentation.span('mode_detection.transit_features', df.shape[0]):
+            _add_transit_features(df, arguments, gtfs, stop_radius)
     arguments = list(map(lambda x: (df.iloc[x]), arguments))
 
-    if use_multiprocessing:
-        pool = mp.Pool(processes=(mp.cpu_count() - 1))
-        results = pool.map_async(_detect_modes, arguments)
-        pool.close()
-        pool.join()
-
-        for res in results.get(timeout=1):
-            df.loc[res.index] = res
-    else:
-        for argument_list in arguments:
-            res = _detect_modes(argument_list)
+    with instrumentation.span('mode_detection.modes', df.shape[0]) as step:
+        execution_plan = execution.plan('mode_detection.modes', [argument.shape[0] for argument in arguments], use_multiprocessing)
+        for res in execution.execute(_detect_modes, arguments, execution_plan, step):
             df.loc[res.index] = res
 
     df.loc[df.detection == "walk", 'detected_mode'] = "Walk"
-    
+    if gtfs is not None:
+        df.drop(columns=TRANSIT_FEATURE_COLUMNS, inplace=True)
+
     return df
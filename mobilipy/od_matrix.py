@@ -0,0 +1,252 @@
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from mobilipy import instrumentation, privacy
+from mobilipy.lazy import LazyModule
+
+sparse = LazyModule('scipy.sparse')
+
+CELL_SIZE_KM = 1.0
+"""Default size of the square zones of the grid, in kilometers"""
+
+DELTA = timedelta(hours=1)
+"""Default time bucket of the OD matrices, trips being bucketed by their start"""
+
+UNKNOWN_MODE = 'Unknown'
+"""Mode of the Track legs without a detected_mode"""
+
+OD_COLUMNS = ['time_bucket', 'mode', 'origin', 'destination', 'count', 'duration']
+
+_OFFSET = 2 ** 30
+
+
+def _values_at(matrix, rows, columns) -> np.ndarray:
+    """Values of a sparse matrix at the given positions"""
+    if rows.shape[0] == 0:
+        return np.empty(0, dtype=matrix.dtype)
+    return np.asarray(matrix.tocsr()[rows, columns]).ravel()
+
+
+class GridZones:
+    """Assigns points to the square cells of the lattice used by privacy.assign_cell_center, labelled by an int64 packing the cell's column and row. Being a class rather than a closure, it can be sent to worker processes.
+    """
+    def __init__(self, cell_size=CELL_SIZE_KM):
+        """Creates the grid.
+
+        Args:
+            cell_size (float, optional): Size of the cells in kilometers. Defaults to CELL_SIZE_KM.
+        """
+        self.cell_size = cell_size
+
+    def __call__(self, latitudes, longitudes) -> np.ndarray:
+        """Labels of the cells of the points
+
+        Args:
+            latitudes (numpy.ndarray): Latitudes in degrees
+            longitudes (numpy.ndarray): Longitudes in degrees
+
+        Returns:
+            numpy.ndarray: int64 cell labels
+        """
+        columns = np.floor(privacy.lon_to_km(latitudes, longitudes) / self.cell_size).astype(np.int64)
+        rows = np.floor(privacy.lat_to_km(latitudes) / self.cell_size).astype(np.int64)
+        return (columns + _OFFSET) * (2 * _OFFSET) + (rows + _OFFSET)
+
+    def centers(self, labels):
+        """Centers of cells, as privacy.assign_cell_center gives them
+
+        Args:
+            labels (numpy.ndarray): int64 cell labels
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray): Latitudes and longitudes of the centers in degrees
+        """
+        labels = np.asarray(labels, dtype=np.int64)
+        columns = labels // (2 * _OFFSET) - _OFFSET
+        rows = labels % (2 * _OFFSET) - _OFFSET
+        latitudes = privacy.km_to_lat(rows * self.cell_size + self.cell_size / 2)
+        longitudes = privacy.km_to_lon(columns * self.cell_size + self.cell_size / 2, latitudes)
+        return latitudes, longitudes
+
+
+def trip_ends(legs) -> pd.DataFrame:
+    """Pairs each Track leg with the Stay before it and the Stay after it, for the same user. The Track legs of a multi-modal trip share the same origin and destination.
+
+    Args:
+        legs (pandas.DataFrame): Legs of one or more users, coming from legs.get_user_legs
+
+    Returns:
+        pandas.DataFrame: One row per Track leg with both Stays, with 'user_id', 'started_at', 'duration' (seconds), 'mode', 'origin_latitude', 'origin_longitude', 'destination_latitude' and 'destination_longitude' columns
+    """
+    legs = legs.sort_values(['user_id', 'started_at'], kind='stable').reset_index(drop=True)
+    is_stay = (legs.type == 'Stay').values
+    positions = pd.Series(np.where(is_stay, np.arange(legs.shape[0]), np.nan))
+    by_user = positions.groupby(legs.user_id.values, sort=False)
+    previous_stay = by_user.ffill().values
+    next_stay = by_user.bfill().values
+
+    tracks = ~is_stay & ~np.isnan(previous_stay) & ~np.isnan(next_stay)
+    stay_coordinates = np.full((legs.shape[0], 2), np.nan)
+    stay_coordinates[is_stay] = np.array([geometry[0] for geometry in legs.geometry.values[is_stay]], dtype=np.float64).reshape(-1, 2)
+    origins = stay_coordinates[previous_stay[tracks].astype(np.int64)]
+    destinations = stay_coordinates[next_stay[tracks].astype(np.int64)]
+
+    started_at = pd.to_datetime(legs.started_at[tracks], utc=True)
+    finished_at = pd.to_datetime(legs.finished_at[tracks], utc=True)
+    modes = legs.detected_mode[tracks] if 'detected_mode' in legs.columns else pd.Series(np.nan, index=started_at.index)
+    return pd.DataFrame({
+        'user_id': legs.user_id.values[tracks],
+        'started_at': started_at.values,
+        'duration': (finished_at - started_at).dt.total_seconds().values,
+        'mode': modes.fillna(UNKNOWN_MODE).values,
+        'origin_latitude': origins[:, 0],
+        'origin_longitude': origins[:, 1],
+        'destination_latitude': destinations[:, 0],
+        'destination_longitude': destinations[:, 1],
+    })
+
+
+class ODBuilder:
+    """Accumulates origin-destination flows into sparse zone x zone matrices of trip counts and total durations, one per time bucket and mode. Legs can be added chunk by chunk, e.g. per user or per partition, and builders filled in separate processes can be merged.
+    """
+    def __init__(self, zones=None, delta=DELTA):
+        """Creates an empty builder.
+
+        Args:
+            zones (callable, optional): Maps arrays of latitudes and longitudes to an array of hashable zone labels, None or NaN outside of every zone. Defaults to GridZones().
+            delta (datetime.timedelta, optional): Time bucket. Defaults to DELTA.
+        """
+        self.zones = zones if zones is not None else GridZones()
+        self.delta = delta
+        self.labels = pd.Index([])
+        """Zone labels, in the order of the rows and columns of the matrices"""
+        self.counts = {}
+        """Maps (time_bucket, mode) to a scipy.sparse.csr_matrix of trip counts"""
+        self.durations = {}
+        """Maps (time_bucket, mode) to a scipy.sparse.csr_matrix of total trip durations, in seconds"""
+
+    def _zone_indices(self, labels) -> np.ndarray:
+        """Positions of labels in self.labels, appending the new ones"""
+        labels = pd.Index(labels)
+        if len(self.labels) == 0:
+            self.labels = labels.unique()
+        else:
+            new_labels = labels.unique().difference(self.labels, sort=False)
+            if len(new_labels):
+                self.labels = self.labels.append(new_labels)
+        return self.labels.get_indexer(labels)
+
+    def _accumulate(self, key, origins, destinations, counts, durations):
+        """Adds flows to the matrices of a time bucket and mode, growing them to the current number of zones"""
+        n = len(self.labels)
+        for matrices, values in ((self.counts, counts), (self.durations, durations)):
+            matrix = sparse.csr_matrix((values, (origins, destinations)), shape=(n, n))
+            if key in matrices:
+                previous = matrices[key]
+                previous.resize((n, n))
+                matrix = matrix + previous
+            matrices[key] = matrix
+
+    def add(self, legs):
+        """Adds the trips of a chunk of legs
+
+        Args:
+            legs (pandas.DataFrame): Legs of one or more users, coming from legs.get_user_legs
+
+        Returns:
+            ODBuilder: self
+        """
+        with instrumentation.span('od_matrix.add', legs.shape[0]) as step:
+            trips = trip_ends(legs)
+            origins = np.asarray(self.zones(trips.origin_latitude.values, trips.origin_longitude.values))
+            destinations = np.asarray(self.zones(trips.destination_latitude.values, trips.destination_longitude.values))
+            inside = ~(pd.isna(origins) | pd.isna(destinations))
+            trips = trips[inside]
+            origins = self._zone_indices(origins[inside])
+            destinations = self._zone_indices(destinations[inside])
+
+            delta = pd.Timedelta(self.delta).value
+            buckets = pd.DatetimeIndex(trips.started_at).asi8 // delta * delta
+            groups = pd.DataFrame({'time_bucket': buckets, 'mode': trips['mode'].values}).groupby(['time_bucket', 'mode']).indices
+            durations = trips.duration.values
+            for (bucket, mode), positions in groups.items():
+                self._accumulate((pd.Timestamp(bucket, tz='UTC'), mode), origins[positions], destinations[positions],
+                                 np.ones(positions.shape[0], dtype=np.int64), durations[positions])
+            step.set(rows_out=trips.shape[0])
+        return self
+
+    def merge(self, other):
+        """Adds the flows of another builder with the same time bucket, e.g. one filled by another process
+
+        Args:
+            other (ODBuilder): Builder to be merged into this one
+
+        Returns:
+            ODBuilder: self
+        """
+        assert pd.Timedelta(other.delta) == pd.Timedelta(self.delta), 'builders must have the same delta'
+        mapping = self._zone_indices(other.labels)
+        for key, counts in other.counts.items():
+            counts = counts.tocoo()
+            durations = _values_at(other.durations[key], counts.row, counts.col)
+            self._accumulate(key, mapping[counts.row], mapping[counts.col], counts.data, durations)
+        return self
+
+    def matrices(self, min_count=None) -> dict:
+        """Returns the matrices, optionally suppressing the small flows
+
+        Args:
+            min_count (int, optional): If given, flows of fewer trips are removed from both matrices with privacy.suppress_small_counts. Defaults to None.
+
+        Returns:
+            dict: Maps (time_bucket, mode) to (counts, durations), both scipy.sparse.csr_matrix over self.labels
+        """
+        n = len(self.labels)
+        res = {}
+        for key in sorted(self.counts):
+            counts = self.counts[key].copy()
+            counts.resize((n, n))
+            durations = self.durations[key].copy()
+            durations.resize((n, n))
+            if min_count is not None:
+                counts = privacy.suppress_small_counts(counts, min_count)
+                durations = durations.multiply(counts > 0).tocsr()
+            res[key] = (counts, durations)
+        return res
+
+    def to_dataframe(self, min_count=None) -> pd.DataFrame:
+        """Returns the flows as a long table
+
+        Args:
+            min_count (int, optional): If given, flows of fewer trips are suppressed. Defaults to None.
+
+        Returns:
+            pandas.DataFrame: One row per non-empty flow, with 'time_bucket', 'mode', 'origin', 'destination', 'count' and 'duration' (total seconds) columns, and the zone centers for a GridZones
+        """
+        labels = np.asarray(self.labels)
+        frames = []
+        for (bucket, mode), (counts, durations) in self.matrices(min_count).items():
+            counts = counts.tocoo()
+            frames.append(pd.DataFrame({'time_bucket': bucket, 'mode': mode, 'origin': labels[counts.row], 'destination': labels[counts.col],
+                                        'count': counts.data, 'duration': _values_at(durations, counts.row, counts.col)}))
+        res = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=OD_COLUMNS)
+        if isinstance(self.zones, GridZones) and res.shape[0]:
+            res['origin_latitude'], res['origin_longitude'] = self.zones.centers(res.origin.values.astype(np.int64))
+            res['destination_latitude'], res['destination_longitude'] = self.zones.centers(res.destination.values.astype(np.int64))
+        return res
+
+
+@instrumentation.instrumented('od_matrix')
+def od_matrix(legs, zones=None, delta=DELTA, min_count=None) -> pd.DataFrame:
+    """Builds the origin-destination flows of a legs table in one go
+
+    Args:
+        legs (pandas.DataFrame): Legs of one or more users, e.g. the first output of reva.analyse_population
+        zones (callable, optional): Zone assignment, see ODBuilder. Defaults to GridZones().
+        delta (datetime.timedelta, optional): Time bucket. Defaults to DELTA.
+        min_count (int, optional): If given, flows of fewer trips are suppressed. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: Flows, as ODBuilder.to_dataframe
+    """
+    return ODBuilder(zones, delta).add(legs).to_dataframe(min_count)
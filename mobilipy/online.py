@@ -0,0 +1,325 @@
+import asyncio
+import inspect
+from collections import deque, namedtuple
+import pandas as pd
+from mobilipy import geodesy
+
+STAY_RADIUS_M = 50
+"""Distance from the centroid of a stay under which a point belongs to it, in meters"""
+
+STAY_MIN_DURATION_S = 300
+"""Time a user has to remain within STAY_RADIUS_M for a stay to start, in seconds"""
+
+TIME_GAP_S = 850
+"""Silence after which the current leg is closed, in seconds, as the time_gap of segmentation.segment"""
+
+BUFFER_SIZE = 64
+"""Number of recent points kept per user"""
+
+Event = namedtuple('Event', ['user_id', 'type', 'time', 'latitude', 'longitude', 'leg'])
+Event.__doc__ = """Event emitted by the online detector: 'stay_start', 'trip_start' or 'leg_closed'. For 'leg_closed', leg is a dict with 'type' ('Stay' or 'Track'), 'started_at', 'finished_at', 'latitude', 'longitude' (centroid of a stay, last point of a track), 'points', 'distance', 'mean_speed' and 'max_speed'."""
+
+
+def _to_seconds(timestamp) -> float:
+    """Converts a timestamp to seconds since the epoch. Numbers are taken as seconds already, naive datetimes as UTC."""
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp.value / 1e9
+
+def _to_timestamp(seconds) -> pd.Timestamp:
+    return pd.Timestamp(round(seconds * 1e9), unit='ns', tz='UTC')
+
+
+class OnlineDetector:
+    """Per-user stay and trip detector fed one point at a time. Its state is bounded: a ring buffer of recent points, the current stay candidate and running statistics of the current leg.
+
+    A stay starts once the user has remained within stay_radius of the candidate's centroid for stay_min_duration, and ends at the first point outside of it. A silence longer than time_gap closes the current leg.
+    """
+    def __init__(self, user_id, stay_radius=STAY_RADIUS_M, stay_min_duration=STAY_MIN_DURATION_S, time_gap=TIME_GAP_S, buffer_size=BUFFER_SIZE):
+        """Creates the detector of one user.
+
+        Args:
+            user_id (str): user's ID
+            stay_radius (float, optional): Radius of a stay, in meters. Defaults to STAY_RADIUS_M.
+            stay_min_duration (float, optional): Minimal duration of a stay, in seconds. Defaults to STAY_MIN_DURATION_S.
+            time_gap (float, optional): Silence closing the current leg, in seconds. Defaults to TIME_GAP_S.
+            buffer_size (int, optional): Number of recent points kept. Defaults to BUFFER_SIZE.
+        """
+        self.user_id = user_id
+        self.stay_radius = stay_radius
+        self.stay_min_duration = stay_min_duration
+        self.time_gap = time_gap
+        self.recent = deque(maxlen=buffer_size)
+        """Recent points, as (seconds, latitude, longitude)"""
+        self.state = None
+        """'stay', 'trip' or None before the first leg is known"""
+        self._candidate = None
+        self._leg = None
+
+    def _reset_candidate(self, point):
+        """Starts a new stay candidate at point, with the running statistics of a leg"""
+        self._candidate = None if point is None else self._new_leg(None, point)
+
+    @staticmethod
+    def _new_leg(type_, point):
+        return {'type': type_, 'started_at': point[0], 'first': point, 'latitude': point[1], 'longitude': point[2], 'points': 1,
+                'distance': 0.0, 'speed_sum': 0.0, 'speed_count': 0, 'max_speed': 0.0, 'last': point}
+
+    @staticmethod
+    def _extend(leg, point, distance, speed):
+        leg['latitude'] += point[1]
+        leg['longitude'] += point[2]
+        leg['points'] += 1
+        leg['distance'] += distance
+        if speed is not None:
+            leg['speed_sum'] += speed
+            leg['speed_count'] += 1
+            leg['max_speed'] = max(leg['max_speed'], speed)
+        leg['last'] = point
+
+    @staticmethod
+    def _merge(leg, candidate):
+        """Adds the points of a broken stay candidate, except its first one which is already in the leg"""
+        for key in ('latitude', 'longitude'):
+            leg[key] += candidate[key] - candidate['first'][1 if key == 'latitude' else 2]
+        leg['points'] += candidate['points'] - 1
+        for key in ('distance', 'speed_sum', 'speed_count'):
+            leg[key] += candidate[key]
+        leg['max_speed'] = max(leg['max_speed'], candidate['max_speed'])
+        leg['last'] = candidate['last']
+
+    @staticmethod
+    def _centroid(leg):
+        return leg['latitude'] / leg['points'], leg['longitude'] / leg['points']
+
+    def _close_leg(self, finished_at):
+        """Returns the 'leg_closed' event of the current leg, ending at finished_at"""
+        leg = self._leg
+        self._leg = None
+        latitude, longitude = self._centroid(leg) if leg['type'] == 'Stay' else leg['last'][1:]
+        closed = {'type': leg['type'], 'started_at': _to_timestamp(leg['started_at']), 'finished_at': _to_timestamp(finished_at),
+                  'latitude': latitude, 'longitude': longitude, 'points': leg['points'], 'distance': leg['distance'],
+                  'mean_speed': leg['speed_sum'] / leg['speed_count'] if leg['speed_count'] else 0.0, 'max_speed': leg['max_speed']}
+        return Event(self.user_id, 'leg_closed', closed['finished_at'], latitude, longitude, closed)
+
+    def _start(self, leg):
+        """Makes leg the current one and returns its start event"""
+        self._leg = leg
+        self.state = 'stay' if leg['type'] == 'Stay' else 'trip'
+        first = leg['first']
+        return Event(self.user_id, 'stay_start' if self.state == 'stay' else 'trip_start', _to_timestamp(first[0]), first[1], first[2], None)
+
+    def update(self, timestamp, latitude, longitude) -> list:
+        """Processes one point. Points must arrive in time order; older points are ignored.
+
+        Args:
+            timestamp (float or datetime): seconds since the epoch, or a datetime
+            latitude (float): latitude in degrees
+            longitude (float): longitude in degrees
+
+        Returns:
+            list(Event): Events caused by the point, possibly none
+        """
+        seconds = _to_seconds(timestamp)
+        point = (seconds, latitude, longitude)
+        events = []
+
+        previous = self.recent[-1] if self.recent else None
+        if previous is not None and seconds <= previous[0]:
+            return events
+        if previous is not None and seconds - previous[0] > self.time_gap:
+            events += self.flush()
+            previous = None
+        self.recent.append(point)
+
+        if previous is None:
+            self._reset_candidate(point)
+            return events
+        distance = geodesy.haversine(previous[1], previous[2], latitude, longitude)
+        speed = distance / (seconds - previous[0])
+
+        if self.state == 'stay':
+            if geodesy.haversine(*self._centroid(self._leg), latitude, longitude) <= self.stay_radius:
+                self._extend(self._leg, point, distance, speed)
+                return events
+            events.append(self._close_leg(previous[0]))
+            events.append(self._start(self._new_leg('Track', previous)))
+            self._extend(self._leg, point, distance, speed)
+            self._reset_candidate(point)
+            return events
+
+        candidate = self._candidate
+        if geodesy.haversine(*self._centroid(candidate), latitude, longitude) <= self.stay_radius:
+            self._extend(candidate, point, distance, speed)
+            if seconds - candidate['started_at'] >= self.stay_min_duration:
+                if self.state == 'trip':
+                    events.append(self._close_leg(candidate['started_at']))
+                candidate['type'] = 'Stay'
+                events.append(self._start(candidate))
+                self._candidate = None
+            return events
+
+        # the candidate is broken: its points belong to the trip, which starts with it if there's none yet
+        if self.state is None:
+            candidate['type'] = 'Track'
+            events.append(self._start(candidate))
+        else:
+            self._merge(self._leg, candidate)
+        self._extend(self._leg, point, distance, speed)
+        self._reset_candidate(point)
+        return events
+
+    def flush(self) -> list:
+        """Closes the current leg at the last point, e.g. when the stream ends or goes silent
+
+        Returns:
+            list(Event): The 'leg_closed' event, if a leg was open
+        """
+        events = []
+        if self._leg is not None:
+            events.append(self._close_leg(self.recent[-1][0]))
+        self.state = None
+        self.recent.clear()
+        self._reset_candidate(None)
+        return events
+
+
+class StreamDetector:
+    """Online detector of many users, keeping one OnlineDetector per user
+    """
+    def __init__(self, **params):
+        """Creates the detector.
+
+        Args:
+            **params: Arguments of OnlineDetector
+        """
+        self.params = params
+        self.detectors = {}
+        """OnlineDetector of each user"""
+
+    def update(self, user_id, timestamp, latitude, longitude) -> list:
+        """Processes one point of a user
+
+        Returns:
+            list(Event): Events caused by the point, possibly none
+        """
+        detector = self.detectors.get(user_id)
+        if detector is None:
+            detector = self.detectors[user_id] = OnlineDetector(user_id, **self.params)
+        return detector.update(timestamp, latitude, longitude)
+
+    def evict_idle(self, now) -> list:
+        """Closes the legs of the users silent for more than their time_gap and drops their state, so that memory stays bounded by the active users
+
+        Args:
+            now (float or datetime): current time
+
+        Returns:
+            list(Event): 'leg_closed' events of the evicted users
+        """
+        seconds = _to_seconds(now)
+        events = []
+        for user_id in [user_id for user_id, detector in self.detectors.items()
+                        if not detector.recent or seconds - detector.recent[-1][0] > detector.time_gap]:
+            events += self.detectors.pop(user_id).flush()
+        return events
+
+    def flush(self) -> list:
+        """Closes the legs of all the users
+
+        Returns:
+            list(Event): 'leg_closed' events
+        """
+        events = []
+        for detector in self.detectors.values():
+            events += detector.flush()
+        self.detectors.clear()
+        return events
+
+
+class AsyncStreamDetector(StreamDetector):
+    """asyncio front of StreamDetector: concurrent user streams are consumed on one event loop, and events are handed to a callback or put in a bounded queue, which slows the streams down when the consumer lags behind.
+    """
+    def __init__(self, on_event=None, max_queued_events=10000, **params):
+        """Creates the detector.
+
+        Args:
+            on_event (callable, optional): Function or coroutine function called with each event. If None, events are put in self.events. Defaults to None.
+            max_queued_events (int, optional): Size of self.events. Defaults to 10000.
+            **params: Arguments of OnlineDetector
+        """
+        super().__init__(**params)
+        self.on_event = on_event
+        self._awaitable = inspect.iscoroutinefunction(on_event)
+        self.events = asyncio.Queue(maxsize=max_queued_events) if on_event is None else None
+        """Queue of the events, when there's no callback"""
+
+    async def _emit(self, events):
+        for event in events:
+            if self.on_event is None:
+                await self.events.put(event)
+            elif self._awaitable:
+                await self.on_event(event)
+            else:
+                self.on_event(event)
+
+    async def submit(self, user_id, timestamp, latitude, longitude):
+        """Processes one point pushed by a source, e.g. a websocket handler"""
+        await self._emit(self.update(user_id, timestamp, latitude, longitude))
+
+    async def ingest(self, user_id, stream, yield_every=100):
+        """Consumes a stream of points of one user until it ends, then closes its current leg
+
+        Args:
+            user_id (str): user's ID
+            stream (async iterable or iterable): (timestamp, latitude, longitude) tuples
+            yield_every (int, optional): Number of points after which control is given back to the event loop, for synchronous streams. Defaults to 100.
+        """
+        if hasattr(stream, '__aiter__'):
+            async for timestamp, latitude, longitude in stream:
+                await self.submit(user_id, timestamp, latitude, longitude)
+        else:
+            for k, (timestamp, latitude, longitude) in enumerate(stream, start=1):
+                await self.submit(user_id, timestamp, latitude, longitude)
+                if k % yield_every == 0:
+                    await asyncio.sleep(0)
+        detector = self.detectors.pop(user_id, None)
+        if detector is not None:
+            await self._emit(detector.flush())
+
+    async def close(self):
+        """Closes the legs of all the users and emits their 'leg_closed' events"""
+        await self._emit(self.flush())
+
+    async def ingest_all(self, streams):
+        """Consumes the streams of many users concurrently
+
+        Args:
+            streams (dict): stream of each user ID, as accepted by ingest
+        """
+        await asyncio.gather(*(self.ingest(user_id, stream) for user_id, stream in streams.items()))
+
+
+def detect_legs(df, **params) -> pd.DataFrame:
+    """Runs the online detector over a WaypointsDataFrame, e.g. to compare it with the batch pipeline
+
+    Args:
+        df (pandas.DataFrame): WaypointsDataFrame, of one or more users
+        **params: Arguments of OnlineDetector
+
+    Returns:
+        pandas.DataFrame: Closed legs with 'user_id', 'type', 'started_at', 'finished_at', 'latitude', 'longitude', 'points', 'distance', 'mean_speed' and 'max_speed' columns
+    """
+    detector = StreamDetector(**params)
+    df = df.sort_values('tracked_at', kind='stable')
+    seconds = pd.DatetimeIndex(pd.to_datetime(df.tracked_at, utc=True)).asi8 / 1e9
+    events = []
+    for user_id, timestamp, latitude, longitude in zip(df.user_id.values, seconds, df.latitude.values, df.longitude.values):
+        events += detector.update(user_id, float(timestamp), float(latitude), float(longitude))
+    events += detector.flush()
+    legs = [dict(user_id=event.user_id, **event.leg) for event in events if event.type == 'leg_closed']
+    return pd.DataFrame(legs, columns=['user_id', 'type', 'started_at', 'finished_at', 'latitude', 'longitude',
+                                       'points', 'distance', 'mean_speed', 'max_speed'])
@@ -1,7 +1,129 @@
-import folium
+import os
 from mobilipy.constants import *
+from mobilipy import execution, geodesy
 from mobilipy.preparation import prepare
+from mobilipy.legs import LegPointIndex, _to_utc_nanoseconds
 import pandas as pd
+import numpy as np
+from numba import njit
+from mobilipy.lazy import LazyModule
+
+folium = LazyModule('folium')
+
+SIMPLIFY_PIXELS = 1000
+"""Number of pixels the map bounds are assumed to span when the simplification tolerance is derived from them"""
+
+@njit(cache=True)
+def _time_aware_douglas_peucker(x, y, t, tolerance):
+    """Douglas-Peucker simplification using the synchronized euclidean distance: a point is compared to the position interpolated at its timestamp between the ends of the segment, instead of to the segment itself.
+
+    Args:
+        x (numpy.ndarray): Eastings in meters
+        y (numpy.ndarray): Northings in meters
+        t (numpy.ndarray): Timestamps in seconds
+        tolerance (float): Maximal distance between a dropped point and its interpolated position, in meters
+
+    Returns:
+        numpy.ndarray: Boolean mask of the points to be kept
+    """
+    n = x.shape[0]
+    keep = np.zeros(n, dtype=np.bool_)
+    if n == 0:
+        return keep
+    keep[0] = True
+    keep[n - 1] = True
+
+    # Segments still to be simplified, they never overlap so n entries are enough
+    stack = np.empty((n, 2), dtype=np.int64)
+    stack[0, 0] = 0
+    stack[0, 1] = n - 1
+    top = 1
+    tolerance_squared = tolerance ** 2
+    while top > 0:
+        top -= 1
+        first = stack[top, 0]
+        last = stack[top, 1]
+        if last - first < 2:
+            continue
+
+        duration = t[last] - t[first]
+        max_distance = -1.0
+        index = first
+        for k in range(first + 1, last):
+            ratio = (t[k] - t[first]) / duration if duration > 0 else 0.0
+            distance = (x[k] - x[first] - (x[last] - x[first]) * ratio) ** 2 + (y[k] - y[first] - (y[last] - y[first]) * ratio) ** 2
+            if distance > max_distance:
+                max_distance = distance
+                index = k
+
+        if max_distance > tolerance_squared:
+            keep[index] = True
+            stack[top, 0] = first
+            stack[top, 1] = index
+            stack[top + 1, 0] = index
+            stack[top + 1, 1] = last
+            top += 2
+    return keep
+
+def get_simplification_tolerance(df, zoom=None) -> float:
+    """Finds the distance under which details can't be seen on the map, i.e. the size of one pixel.
+
+    Args:
+        df (pd.DataFrame): DataFrame with latitude and longitude columns.
+        zoom (int, optional): Zoom level of the map. If None, the map is assumed to fit the bounds of the DataFrame. Defaults to None.
+
+    Returns:
+        float: Tolerance in meters
+    """
+    latitude = np.deg2rad(df.latitude.mean())
+    if zoom is not None:
+        return 156543.03 * np.cos(latitude) / 2 ** zoom
+    bounds = get_map_bounds(df)
+    height = (bounds[1][0] - bounds[0][0]) * geodesy.METERS_PER_DEGREE
+    width = (bounds[1][1] - bounds[0][1]) * geodesy.METERS_PER_DEGREE * np.cos(latitude)
+    return np.hypot(height, width) / SIMPLIFY_PIXELS
+
+def simplify_gps(df, tolerance=None, zoom=None) -> pd.DataFrame:
+    """Drops the points that don't change the rendered trajectory, using a time-aware Douglas-Peucker simplification.
+
+    Args:
+        df (pd.DataFrame): DataFrame with latitude, longitude and tracked_at columns.
+        tolerance (float, optional): Tolerance in meters. If None, it is derived from the zoom or the bounds with get_simplification_tolerance. Defaults to None.
+        zoom (int, optional): Zoom level of the map. Defaults to None.
+
+    Returns:
+        pd.DataFrame: DataFrame with the kept points
+    """
+    if df.shape[0] < 3:
+        return df
+    if tolerance is None:
+        tolerance = get_simplification_tolerance(df, zoom)
+
+    latitudes = df.latitude.values.astype(np.float64)
+    longitudes = df.longitude.values.astype(np.float64)
+    timestamps = pd.to_datetime(df.tracked_at).values.astype('datetime64[ns]').astype(np.int64) / 10**9
+    x, y = geodesy.project(latitudes, longitudes, np.mean(latitudes), np.mean(longitudes))
+    return df[_time_aware_douglas_peucker(x, y, timestamps, float(tolerance))]
+
+def _add_points_layer(df, loc_map, type_):
+    """Adds the points to the map as one GeoJSON layer of circle markers, with their timestamp as popup.
+
+    Args:
+        df (pd.DataFrame): DataFrame with latitude, longitude and tracked_at columns.
+        loc_map (folium.Map): Map to add the layer to
+        type_ (str): Type of data, defines the color of the markers
+    """
+    features = [{
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+        'properties': {'tracked_at': str(tracked_at)},
+    } for latitude, longitude, tracked_at in zip(df.latitude.values.tolist(), df.longitude.values.tolist(), df.tracked_at.astype(str).values)]
+
+    folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        marker=folium.CircleMarker(radius=5, color=color_type[type_], opacity=0.5),
+        popup=folium.GeoJsonPopup(fields=['tracked_at'], labels=False),
+    ).add_to(loc_map)
 
 def get_map_bounds(df):
     """Finds the map bounding box for the given WaypointsDataFrame
@@ -25,7 +147,7 @@ def get_map_bounds(df):
 
     return bounds
 
-def plot_gps(df, loc_map=None, type_=TRANSPORT, line=True):
+def plot_gps(df, loc_map=None, type_=TRANSPORT, line=True, fast=False, tolerance=None, zoom=None):
     """Plots supplied GPS points on a folium Map.
 
     Args:
@@ -33,6 +155,9 @@ def plot_gps(df, loc_map=None, type_=TRANSPORT, line=True):
         loc_map (folium.Map, optional): Existing Map object to plot the points on. Defaults to None.
         type_ (str, optional): Type of data, can TRANSPORT, ACTIVITY. Defaults to TRANSPORT.
         line (bool, optional): Specifies whether consecutive points should be connected by a line. Defaults to True.
+        fast (bool, optional): Specifies whether the points should be simplified with simplify_gps and plotted as a single layer, for large DataFrames. Defaults to False.
+        tolerance (float, optional): Simplification tolerance in meters, used if fast is True. Defaults to None.
+        zoom (int, optional): Zoom level the simplification tolerance is derived from if no tolerance is given, used if fast is True. Defaults to None.
 
     Returns:
         folium.Map: Map with points from the DataFrame
@@ -46,6 +171,8 @@ def plot_gps(df, loc_map=None, type_=TRANSPORT, line=True):
      
     #Then, we plot the points in lines
     points = df[['latitude', 'longitude', 'tracked_at']]
+    if fast:
+        points = simplify_gps(points, tolerance, zoom)
     
     if line:
         points = points[['latitude', 'longitude']].values.tolist()
@@ -53,41 +180,45 @@ def plot_gps(df, loc_map=None, type_=TRANSPORT, line=True):
             folium.PolyLine(points, color=color_type[type_]).add_to(loc_map)
             folium.RegularPolygonMarker(location=points[0], color=color_type[BEGINNING], number_of_sides=3, radius=10).add_to(loc_map)
             folium.RegularPolygonMarker(location=points[-1], color=color_type[END], number_of_sides=3, radius=10).add_to(loc_map)
+    elif fast:
+        _add_points_layer(points, loc_map, type_)
     else:
         [folium.CircleMarker(point[:-1], color=color_type[type_], radius=5,
                              popup=folium.Popup(str(point[-1]), max_width=len(str(point[-1]))*20),opacity=0.5).add_to(loc_map) for point in points.values.tolist()]
     return loc_map
 
-def plot_waypoints(waypoints, clean_df=True, map_=None):
+def plot_waypoints(waypoints, clean_df=True, map_=None, fast=False):
     """Plots waypoints on a folium Map.
 
     Args:
         waypoints (pd.DataFrame): DataFrame with latitude, longitude and tracked_at columns.
         clean_df (bool, optional): Prepares waypoints before plotting if True. Defaults to True.
         map_ (folium.Map, optional): Existing Map object to plot the points on. Defaults to None.
+        fast (bool, optional): Specifies whether the points should be simplified and plotted as a single layer. Defaults to False.
 
     Returns:
         folium.Map: Map with points from the DataFrame
     """
     if clean_df:
-        return plot_gps(prepare(waypoints), loc_map=map_, type_=CLEAN, line=False)
+        return plot_gps(prepare(waypoints), loc_map=map_, type_=CLEAN, line=False, fast=fast)
     else:
-        return plot_gps(waypoints, loc_map=map_, type_=DIRTY, line=False)
+        return plot_gps(waypoints, loc_map=map_, type_=DIRTY, line=False, fast=fast)
 
-def plot_solos(solos, map_=None):
+def plot_solos(solos, map_=None, fast=False):
     """Plots DataFrame points on a folium Map without connecting them with a line.
 
     Args:
         solos (pd.DataFrame): DataFrame with latitude, longitude and tracked_at columns.
         map_ (folium.Map, optional): Existing Map object to plot the points on. Defaults to None.
+        fast (bool, optional): Specifies whether the points should be simplified and plotted as a single layer. Defaults to False.
 
     Returns:
         folium.Map: Map with points from the DataFrame
     """
-    return plot_gps(solos, loc_map=map_, type_=SOLO, line=False)
+    return plot_gps(solos, loc_map=map_, type_=SOLO, line=False, fast=fast)
 
 
-def get_leg_points(legs_from_waypoints, clean_waypoints, index, info=False):
+def get_leg_points(legs_from_waypoints, clean_waypoints, index, info=False, leg_index=None):
     """Returns a DataFrame with all the points belonging to the given leg.
 
     Args:
@@ -95,6 +226,7 @@ def get_leg_points(legs_from_waypoints, clean_waypoints, index, info=False):
         clean_waypoints (pd.DataFrame): DataFrame with latitude, longitude and tracked_at columns.
         index (int): Index of the leg.
         info (bool, optional): Defines whether additional info about the leg should be returned. Defaults to False.
+        leg_index (legs.LegPointIndex, optional): Index of the points of the legs, to be reused across calls. Built from the DataFrames if None. Defaults to None.
 
     Returns:
         pd.DataFrame: DataFrame with all the points belonging to the given leg
@@ -102,7 +234,11 @@ def get_leg_points(legs_from_waypoints, clean_waypoints, index, info=False):
     legs = legs_from_waypoints
     start = legs.iloc[index, legs.columns.get_loc('started_at')]
     end = legs.iloc[index, legs.columns.get_loc('finished_at')]
-    leg = clean_waypoints[(clean_waypoints['tracked_at']>=start) & (clean_waypoints['tracked_at']<=end)]
+    if leg_index is None:
+        leg_index = LegPointIndex(legs.iloc[[index]], clean_waypoints)
+        leg = leg_index.points(0)
+    else:
+        leg = leg_index.points(index)
 
     if info:
         day, start_time = start.split("T")
@@ -121,7 +257,7 @@ def get_leg_points(legs_from_waypoints, clean_waypoints, index, info=False):
     else:
         return leg
 
-def plot_leg(legs_from_waypoints, clean_waypoints, index, map_=None, info=False):
+def plot_leg(legs_from_waypoints, clean_waypoints, index, map_=None, info=False, fast=False, tolerance=None, leg_index=None):
     """Plots a selected leg on a folium Map.
 
     Args:
@@ -130,6 +266,9 @@ def plot_leg(legs_from_waypoints, clean_waypoints, index, map_=None, info=False)
         index (int): Index of the leg.
         map_ ([type], optional): Existing Map object to plot the points on. Defaults to None.
         info (bool, optional): Defines whether additional info about the leg should be returned. Defaults to False.
+        fast (bool, optional): Specifies whether the leg should be simplified before plotting. Defaults to False.
+        tolerance (float, optional): Simplification tolerance in meters, derived from the leg bounds if None. Defaults to None.
+        leg_index (legs.LegPointIndex, optional): Index of the points of the legs, to be reused across calls. Defaults to None.
 
     Returns:
         folium.Map: Map with points from the leg
@@ -137,30 +276,32 @@ def plot_leg(legs_from_waypoints, clean_waypoints, index, map_=None, info=False)
     legs = legs_from_waypoints
     leg_ty = legs.iloc[index, legs.columns.get_loc('type')]
     if info:
-        leg, info = get_leg_points(legs_from_waypoints, clean_waypoints, index, info=True)
-        return leg, info, plot_gps(leg, loc_map=map_, type_=leg_ty)
+        leg, info = get_leg_points(legs_from_waypoints, clean_waypoints, index, info=True, leg_index=leg_index)
+        return leg, info, plot_gps(leg, loc_map=map_, type_=leg_ty, fast=fast, tolerance=tolerance)
     else:
-        leg = get_leg_points(legs_from_waypoints, clean_waypoints, index)
-        return leg, plot_gps(leg, loc_map=map_, type_=leg_ty)
+        leg = get_leg_points(legs_from_waypoints, clean_waypoints, index, leg_index=leg_index)
+        return leg, plot_gps(leg, loc_map=map_, type_=leg_ty, fast=fast, tolerance=tolerance)
 
 
-def plot_legs(legs_from_waypoints, clean_waypoints, map_=None):
+def plot_legs(legs_from_waypoints, clean_waypoints, map_=None, fast=False):
     """Plots all the legs on a folium Map
 
     Args:
         legs_from_waypoints (pd.DataFrame): DataFrame with legs, coming from legs.get_user_legs.
         clean_waypoints (pd.DataFrame): DataFrame with latitude, longitude and tracked_at columns.
         map_ ([type], optional): Existing Map object to plot the points on. Defaults to None.
+        fast (bool, optional): Specifies whether the legs should be simplified before plotting, with a tolerance derived from the bounds of all the waypoints. Defaults to False.
 
     Returns:
         folium.Map: Map with points from the legs DataFrame
     """
-    df = pd.DataFrame()
     m = map_
+    tolerance = get_simplification_tolerance(clean_waypoints) if fast and clean_waypoints.shape[0] > 0 else None
+    leg_index = LegPointIndex(legs_from_waypoints, clean_waypoints)
     for i in range(len(legs_from_waypoints)):
-        points_df, m = plot_leg(legs_from_waypoints, clean_waypoints, i, map_=m)
-        df = df.append(points_df, ignore_index=True)
-    
+        _, m = plot_leg(legs_from_waypoints, clean_waypoints, i, map_=m, fast=fast, tolerance=tolerance, leg_index=leg_index)
+
+    df = leg_index.waypoints[leg_index.leg_ids >= 0]
     if(df.shape[0]>0):
         bounds = get_map_bounds(df)
         m.fit_bounds(bounds)
@@ -214,17 +355,93 @@ def plot_daily_legs(legs_from_waypoints, waypoints, day_num, first_=0, last_=-1,
         m = plot_gps(solo_points, loc_map=m, type_=SOLO, line=False)
     return m, infos
 
-def plot_all(legs_from_waypoints, waypoints):
+def plot_all(legs_from_waypoints, waypoints, fast=False):
     """Plots dirty waypoints, clean waypoints and resulting legs.
 
     Args:
         legs_from_waypoints (pd.DataFrame): DataFrame with legs, coming from legs.get_user_legs.
         waypoints (pd.DataFrame): DataFrame with latitude, longitude and tracked_at columns.
+        fast (bool, optional): Specifies whether points and legs should be simplified and points plotted as single layers. Defaults to False.
 
     Returns:
         folium.Map: Map with points from the DataFrames
     """
-    map_ = plot_waypoints(waypoints, clean_df=False)
-    map_ = plot_waypoints(waypoints, map_=map_)
-    map_ = plot_legs(legs_from_waypoints, waypoints, map_=map_)
-    return map_
\ No newline at end of file
+    map_ = plot_waypoints(waypoints, clean_df=False, fast=fast)
+    map_ = plot_waypoints(waypoints, map_=map_, fast=fast)
+    map_ = plot_legs(legs_from_waypoints, waypoints, map_=map_, fast=fast)
+    return map_
+
+def _render_user_days(args):
+    """Renders one map per day of legs of a single user and saves them as HTML files. A failing day is recorded and doesn't stop the other ones.
+
+    Args:
+        args: user_id, legs, waypoints, output_directory, fast
+
+    Returns:
+        list((str, str, str, int, int, str)): list of (user_id, day, path, legs, points, error)
+    """
+    user_id, user_legs, user_waypoints, output_directory, fast = args
+    report = []
+    try:
+        starts = _to_utc_nanoseconds(user_legs.started_at)
+        order = np.argsort(starts, kind='stable')
+        user_legs = user_legs.iloc[order]
+        leg_index = LegPointIndex(user_legs, user_waypoints)
+        days = pd.to_datetime(starts[order]).strftime('%Y-%m-%d').values
+        user_directory = os.path.join(output_directory, str(user_id).replace(os.sep, '_'))
+        os.makedirs(user_directory, exist_ok=True)
+    except Exception as error:
+        return [(user_id, None, None, len(user_legs), len(user_waypoints), repr(error))]
+
+    for day in pd.unique(days):
+        day_legs = np.flatnonzero(days == day)
+        path = os.path.join(user_directory, day + '.html')
+        n_points = int(leg_index.counts[day_legs].sum())
+        try:
+            m = None
+            for leg in day_legs:
+                points = leg_index.points(leg)
+                if points.shape[0] > 0:
+                    m = plot_gps(points, loc_map=m, type_=user_legs.type.iloc[leg], fast=fast)
+            if m is None:
+                raise ValueError('no waypoints during the legs of the day')
+            day_points = leg_index.waypoints.iloc[leg_index.starts[day_legs[0]]:leg_index.ends[day_legs[-1]]]
+            m.fit_bounds(get_map_bounds(day_points))
+            m.save(path)
+            report.append((user_id, day, path, len(day_legs), n_points, None))
+        except Exception as error:
+            report.append((user_id, day, None, len(day_legs), n_points, repr(error)))
+    return report
+
+def render_daily_maps(legs, waypoints, output_directory, fast=True, use_multiprocessing='auto', processes=None, progress=None) -> pd.DataFrame:
+    """Renders the legs of many users as one HTML map per user and day, saved to output_directory/<user_id>/<YYYY-MM-DD>.html. Users are rendered in a pool of workers and each map is written as soon as it is built. Failures are recorded in the returned report without stopping the batch.
+
+    Args:
+        legs (pd.DataFrame): DataFrame with legs of one or more users, coming from legs.get_user_legs, with a user_id column.
+        waypoints (pd.DataFrame): DataFrame with user_id, latitude, longitude and tracked_at columns.
+        output_directory (str): Directory the maps are written to.
+        fast (bool, optional): Specifies whether the legs should be simplified before plotting. Defaults to True.
+        use_multiprocessing (bool or str, optional): True for processes, False for serial, or a policy of the execution module. Defaults to 'auto', chosen by the cost model.
+        processes (int, optional): Number of workers. Defaults to the choice of the cost model, at most the number of CPUs minus one.
+        progress (callable, optional): Called as progress(done, total, user_id) after each user. Defaults to None.
+
+    Returns:
+        pd.DataFrame: Report with 'user_id', 'day', 'path', 'legs', 'points' and 'error' columns, one row per map
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    user_waypoints = dict(tuple(waypoints.groupby('user_id', sort=False)))
+    user_legs = list(legs.groupby('user_id', sort=False))
+
+    arguments = ((user_id, legs_, user_waypoints.get(user_id, waypoints.iloc[:0]), output_directory, fast)
+                 for user_id, legs_ in user_legs)
+
+    execution_plan = execution.plan('render_daily_maps', [len(user_waypoints.get(user_id, ())) for user_id, _ in user_legs],
+                                    use_multiprocessing, processes)
+    report = []
+    results = execution.execute_unordered(_render_user_days, arguments, execution_plan)
+    for done, user_report in enumerate(results, start=1):
+        report += user_report
+        if progress is not None:
+            progress(done, len(user_legs), user_report[0][0] if user_report else None)
+
+    return pd.DataFrame(report, columns=['user_id', 'day', 'path', 'legs', 'points', 'error'])
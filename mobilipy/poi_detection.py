@@ -1,10 +1,11 @@
 from numba import njit
 import numpy as np
-from haversine import haversine, Unit
 import pandas as pd
+from mobilipy import geodesy
+from mobilipy.instrumentation import instrumented
 pd.options.mode.chained_assignment = None
 
-@njit
+@njit(cache=True)
 def assign_cell(latitude, longitude, cell_size=0.2):
     """Assigns a cell_number based on the cantor pairing function and discretization into 25km * 25km cells.
 
@@ -16,14 +17,15 @@ def assign_cell(latitude, longitude, cell_size=0.2):
         cell_number (int): Cell number based on the cantor pair function.
     """
 
-    km_east = 111.320 * np.cos(np.deg2rad(latitude)) * longitude
-    km_north = 110.574 * latitude
+    km_east = geodesy.METERS_PER_DEGREE / 1000 * np.cos(np.deg2rad(latitude)) * longitude
+    km_north = geodesy.METERS_PER_DEGREE / 1000 * latitude
     x_index = km_east // cell_size
     y_index = km_north // cell_size
     cell_number = (1/2)*(y_index + x_index)*(y_index + x_index + 1) + x_index
     return cell_number
 
 
+@instrumented('detect_home_work')
 def detect_home_work(legs, waypoints, cell_size=0.2):
     """Detects home and work locations, tags them with 'Home' or 'Work' in the df
 
@@ -33,7 +35,8 @@ def detect_home_work(legs, waypoints, cell_size=0.2):
     """
     
     if legs.shape[0] != 0 and waypoints.shape[0] != 0:
-        waypoints_ = waypoints[['tracked_at', 'latitude', 'longitude', 'user_id']]
+        columns = ['tracked_at', 'latitude', 'longitude', 'user_id'] + (['weight'] if 'weight' in waypoints.columns else [])
+        waypoints_ = waypoints[columns]
         waypoints_["cell_number"] = assign_cell(waypoints_.latitude.values, waypoints_.longitude.values, cell_size)
         waypoints_["cell_number"] = waypoints_["cell_number"].astype('int64')
 
@@ -45,20 +48,10 @@ def detect_home_work(legs, waypoints, cell_size=0.2):
         waypoints_workdates = waypoints_workdates.drop(columns=['hour', 'weekday'])
 
         # Most_visited_cells_workdates finds the most visited cells during workdays
-        most_visited_cells_workdates = waypoints_workdates.drop(columns=["tracked_at", "user_id"])
-        most_visited_cells_workdates = most_visited_cells_workdates.groupby("cell_number").agg(["count", "mean"])
-        most_visited_cells_workdates.columns = most_visited_cells_workdates.columns.droplevel()
-        most_visited_cells_workdates.columns = ["count_lat", "mean_lat", "count_lon", "mean_lon"]
-        most_visited_cells_workdates = most_visited_cells_workdates.drop(columns="count_lat").reset_index()
-        most_visited_cells_workdates = most_visited_cells_workdates.rename(columns={"mean_lat": "latitude", "mean_lon": "longitude"}).sort_values(by="count_lon", ascending=False)
+        most_visited_cells_workdates = _most_visited_cells(waypoints_workdates)
 
         # Most_visited_cells finds the most visited cells overall
-        most_visited_cells = waypoints_.drop(columns=["tracked_at", "user_id"])
-        most_visited_cells = most_visited_cells.groupby("cell_number").agg(["count", "mean"])
-        most_visited_cells.columns = most_visited_cells.columns.droplevel()
-        most_visited_cells.columns = ["count_lat", "mean_lat", "count_lon", "mean_lon"]
-        most_visited_cells = most_visited_cells.drop(columns="count_lat").reset_index()
-        most_visited_cells = most_visited_cells.rename(columns={"mean_lat": "latitude", "mean_lon": "longitude"}).sort_values(by="count_lon", ascending=False)
+        most_visited_cells = _most_visited_cells(waypoints_)
 
         home_user_cell_number = most_visited_cells.iloc[0].cell_number
         home_user = (most_visited_cells.iloc[0]['latitude'], most_visited_cells.iloc[0]['longitude'])
@@ -83,6 +76,33 @@ def detect_home_work(legs, waypoints, cell_size=0.2):
         return None, None
 
 
+def _most_visited_cells(waypoints_):
+    """Counts the waypoints in each cell and averages their coordinates. Waypoints collapsed by preparation.collapse_stationary are counted as many times as their weight, so that the ranking matches the one of the full waypoints.
+
+    Args:
+        waypoints_ (pandas.DataFrame): Waypoints with their cell_number
+
+    Returns:
+        pandas.DataFrame: cell_number, count_lon, latitude and longitude of the cells, most visited first
+    """
+    if 'weight' not in waypoints_.columns:
+        most_visited_cells = waypoints_.drop(columns=["tracked_at", "user_id"])
+        most_visited_cells = most_visited_cells.groupby("cell_number").agg(["count", "mean"])
+        most_visited_cells.columns = most_visited_cells.columns.droplevel()
+        most_visited_cells.columns = ["count_lat", "mean_lat", "count_lon", "mean_lon"]
+        most_visited_cells = most_visited_cells.drop(columns="count_lat").reset_index()
+        return most_visited_cells.rename(columns={"mean_lat": "latitude", "mean_lon": "longitude"}).sort_values(by="count_lon", ascending=False)
+
+    weighted = pd.DataFrame({"cell_number": waypoints_.cell_number.values,
+                             "count_lon": waypoints_.weight.values,
+                             "latitude": waypoints_.latitude.values * waypoints_.weight.values,
+                             "longitude": waypoints_.longitude.values * waypoints_.weight.values})
+    most_visited_cells = weighted.groupby("cell_number").sum().reset_index()
+    most_visited_cells["latitude"] /= most_visited_cells.count_lon
+    most_visited_cells["longitude"] /= most_visited_cells.count_lon
+    return most_visited_cells.sort_values(by="count_lon", ascending=False)
+
+
 # Tags legs as home or work if they're close enough to either
 def _find_centroid(leg_index, legs, home_user, work_user):
     """Tags legs as home or work if they're close enough to either
@@ -95,10 +115,10 @@ def _find_centroid(leg_index, legs, home_user, work_user):
     """
     centroid = (legs.geometry[leg_index][0][0], legs.geometry[leg_index][0][1])
     if home_user is not None:
-        d_home = haversine(home_user, centroid)
-        if d_home < 0.03:
+        d_home = geodesy.haversine(home_user[0], home_user[1], centroid[0], centroid[1])
+        if d_home < 30:
             legs.loc[leg_index, 'purpose'] = 'Home'
     if work_user is not None:
-        d_work = haversine(work_user, centroid)
-        if d_work < 0.03:
+        d_work = geodesy.haversine(work_user[0], work_user[1], centroid[0], centroid[1])
+        if d_work < 30:
             legs.loc[leg_index, 'purpose'] = 'Work'
\ No newline at end of file
@@ -1,14 +1,28 @@
 import pandas as pd
 import math
 import numpy as np
+from numba import njit
+from mobilipy import geodesy
+from mobilipy.instrumentation import instrumented
 
-def prepare(df, accuracy_th=1000, sigma=10) -> pd.DataFrame:
+MAX_SPEED_MS = 70
+"""Speed above which a point that the next one comes back from is a GPS spike, in m/s"""
+
+STATIONARY_RADIUS_M = 10
+"""Distance from the first point of a stationary run under which points are collapsed into it, in meters. It should stay well under the segmentation radius."""
+
+MAX_RUN_DURATION_S = 300
+"""Longest stationary run collapsed into one point, in seconds. It must stay under the time_gap of segmentation.segment, which drops longer steps."""
+
+@instrumented('prepare')
+def prepare(df, accuracy_th=1000, sigma=10, downsample=False) -> pd.DataFrame:
     """Cleans a raw GPS points dataframe by filtering in the zurich area, rearranging features and applying gaussian smoothing.
 
     Args:
         df (pandas.DataFrame): DataFrame to be prepared for route processing
         accuracy_th (int, optional): Accuracy threshold for filtering. Defaults to 1000.
         sigma (int, optional): Sigma for Gaussian smoothing, defines the size of smoothing window. Defaults to 10.
+        downsample (bool, optional): Specifies whether GPS spikes should be dropped before smoothing and stationary runs collapsed after it, adding a 'weight' column with the number of points each row stands for. Defaults to False.
 
     Returns:
         pd.DataFrame: [description]
@@ -16,8 +30,104 @@ def prepare(df, accuracy_th=1000, sigma=10) -> pd.DataFrame:
     res = df
     if('accuracy' in df.columns):
         res = res[res.accuracy < accuracy_th]
+    if downsample:
+        res = filter_spikes(res)
     res = _gaussian_smoothing(res, sigma)
     res = res.drop(columns='index', errors='ignore')
+    if downsample:
+        res = collapse_stationary(res)
+    return res
+
+def _seconds(df) -> np.ndarray:
+    """Timestamps of the waypoints in seconds since the epoch, as float64"""
+    return pd.DatetimeIndex(pd.to_datetime(df.tracked_at, utc=True)).asi8 / 10**9
+
+@njit(cache=True)
+def _spike_mask(seconds, latitudes, longitudes, max_speed):
+    """Marks the points to be kept: a point reached from the last kept one above max_speed is dropped if the next point is reachable from that last kept one, i.e. the track jumps out and comes back. Points with the timestamp of the last kept one are dropped too.
+
+    Returns:
+        numpy.ndarray: Boolean mask of the points to be kept
+    """
+    n = seconds.shape[0]
+    keep = np.ones(n, dtype=np.bool_)
+    last = 0
+    for i in range(1, n):
+        elapsed = seconds[i] - seconds[last]
+        if elapsed <= 0:
+            keep[i] = False
+            continue
+        if geodesy.haversine(latitudes[last], longitudes[last], latitudes[i], longitudes[i]) <= max_speed * elapsed:
+            last = i
+            continue
+        if i + 1 < n and seconds[i + 1] > seconds[last] and \
+                geodesy.haversine(latitudes[last], longitudes[last], latitudes[i + 1], longitudes[i + 1]) <= max_speed * (seconds[i + 1] - seconds[last]):
+            keep[i] = False
+        else:
+            last = i
+    return keep
+
+@njit(cache=True)
+def _stationary_runs(seconds, latitudes, longitudes, radius, max_duration):
+    """Splits the points into runs of consecutive points within radius of the first one of the run and within max_duration of it
+
+    Returns:
+        numpy.ndarray: Position of the first point of each run, followed by the number of points
+    """
+    n = seconds.shape[0]
+    starts = np.empty(n + 1, dtype=np.int64)
+    runs = 0
+    i = 0
+    while i < n:
+        starts[runs] = i
+        runs += 1
+        j = i + 1
+        while j < n and seconds[j] - seconds[i] <= max_duration and \
+                geodesy.haversine(latitudes[i], longitudes[i], latitudes[j], longitudes[j]) <= radius:
+            j += 1
+        i = j
+    starts[runs] = n
+    return starts[:runs + 1]
+
+def filter_spikes(df, max_speed=MAX_SPEED_MS) -> pd.DataFrame:
+    """Drops physically impossible GPS jumps: points the track leaves to above max_speed and comes back from
+
+    Args:
+        df (pandas.DataFrame): Waypoints DataFrame sorted by tracked_at
+        max_speed (float, optional): Speed threshold in m/s. Defaults to MAX_SPEED_MS.
+
+    Returns:
+        pandas.DataFrame: DataFrame without the spikes
+    """
+    if df.shape[0] < 3:
+        return df
+    keep = _spike_mask(_seconds(df), df.latitude.values.astype(np.float64), df.longitude.values.astype(np.float64), float(max_speed))
+    return df[keep]
+
+def collapse_stationary(df, radius=STATIONARY_RADIUS_M, max_duration=MAX_RUN_DURATION_S) -> pd.DataFrame:
+    """Collapses runs of stationary points into one point each, at the mean position of the run and the time of its first point. A 'weight' column counts the points each row stands for, so that density-based clustering can weigh them (it's summed if the DataFrame was already collapsed).
+
+    Args:
+        df (pandas.DataFrame): Waypoints DataFrame sorted by tracked_at
+        radius (float, optional): Radius of a run in meters. Defaults to STATIONARY_RADIUS_M.
+        max_duration (float, optional): Longest run in seconds. Defaults to MAX_RUN_DURATION_S.
+
+    Returns:
+        pandas.DataFrame: Collapsed DataFrame with a 'weight' column
+    """
+    weights = df.weight.values if 'weight' in df.columns else np.ones(df.shape[0], dtype=np.int64)
+    if df.shape[0] == 0:
+        return df.assign(weight=weights)
+    latitudes = df.latitude.values.astype(np.float64)
+    longitudes = df.longitude.values.astype(np.float64)
+    bounds = _stationary_runs(_seconds(df), latitudes, longitudes, float(radius), float(max_duration))
+    starts = bounds[:-1]
+
+    res = df.iloc[starts].copy()
+    total_weights = np.add.reduceat(weights, starts)
+    res['latitude'] = np.add.reduceat(latitudes * weights, starts) / total_weights
+    res['longitude'] = np.add.reduceat(longitudes * weights, starts) / total_weights
+    res['weight'] = total_weights
     return res
 
 def _gaussian_smoothing(df, sigma=10) -> pd.DataFrame:
@@ -1,9 +1,14 @@
 import numpy as np 
-from haversine import haversine_vector, Unit
 from datetime import datetime, timedelta
 import pandas as pd
+from mobilipy import geodesy
+from mobilipy.legs import LegPointIndex
+from mobilipy.instrumentation import instrumented
 pd.options.mode.chained_assignment = None
 
+MIN_COUNT = 5
+"""Smallest count published by aggregate and the OD matrices when suppression is requested, smaller counts could single out individuals"""
+
 def add_noise(point, radius=100, offset=30):# -> tuple(float, float):
     """Adds random uniform noise to the given point, in a radius = radius - offset
 
@@ -39,13 +44,8 @@ def shift_point(point, latitude_shift_km, longitude_shift_km):# -> tuple(float,
     Returns:
         tuple: Shifted point expressed as (latitude, longitude)
     """
-    lat = point[0]
-    lon = point[1]
-    
-    lat_km = lat_to_km(lat) + latitude_shift_km
-    lon_km = lon_to_km(lat, lon) + longitude_shift_km
-    
-    return (km_to_lat(lat_km), km_to_lon(lon_km, lat))
+    latitudes, longitudes = geodesy.unproject([longitude_shift_km * 1000], [latitude_shift_km * 1000], point[0], point[1])
+    return (float(latitudes[0]), float(longitudes[0]))
 
 def lon_to_km(latitude, longitude) -> float:
     """Expresses given longitude in kilometers to the east
@@ -57,7 +57,7 @@ def lon_to_km(latitude, longitude) -> float:
     Returns:
         float: Longitude as kilometers to the east
     """
-    km_east = 111.320 * np.cos(np.deg2rad(latitude)) * longitude
+    km_east = geodesy.METERS_PER_DEGREE / 1000 * np.cos(np.deg2rad(latitude)) * longitude
     return km_east
 
 def lat_to_km(latitude) -> float:
@@ -69,7 +69,7 @@ def lat_to_km(latitude) -> float:
     Returns:
         float: Latitude expressed in kilometers to the north
     """
-    km_north = 110.574 * latitude
+    km_north = geodesy.METERS_PER_DEGREE / 1000 * latitude
     return km_north
 
 def km_to_lon(km_east, latitude) -> float:
@@ -82,7 +82,7 @@ def km_to_lon(km_east, latitude) -> float:
     Returns:
         float: Longitude in degrees
     """
-    lon = km_east/(111.320 * np.cos(np.deg2rad(latitude)))
+    lon = km_east/(geodesy.METERS_PER_DEGREE / 1000 * np.cos(np.deg2rad(latitude)))
     return lon
 
 def km_to_lat(km_north) -> float:
@@ -94,7 +94,7 @@ def km_to_lat(km_north) -> float:
     Returns:
         float: Latitude in degrees
     """
-    return km_north/110.574
+    return km_north/(geodesy.METERS_PER_DEGREE / 1000)
 
 def assign_cell_center(latitude, longitude, cell_size):# -> tuple(float, float):
     """Returns the closest cell center for the given coordinates, when the map is divided into a lattice with the supplied cell_size
@@ -118,6 +118,7 @@ def assign_cell_center(latitude, longitude, cell_size):# -> tuple(float, float):
 
     return (lat, lon)
 
+@instrumented('obfuscate')
 def obfuscate(df, locations, radius=100, offset=30, mode='remove') -> pd.DataFrame:
     """Obfuscates the regions of points given in 'locations' parameter by either removing all the points in their proximity, or changing the location of these points to one, noisy location in the proximity circle.
 
@@ -141,7 +142,7 @@ def obfuscate(df, locations, radius=100, offset=30, mode='remove') -> pd.DataFra
             shifted_location = add_noise(location, radius, offset)
             shifted_locations.append(shifted_location)
 
-            output_df['location_dist'] = haversine_vector(np.column_stack((output_df.latitude.values, output_df.longitude.values)), np.tile(np.array(shifted_location), (output_df.shape[0], 1)), Unit.METERS)
+            output_df['location_dist'] = geodesy.distance_to(output_df.latitude.values, output_df.longitude.values, *shifted_location)
 
             if mode=='remove':
                 output_df = output_df.loc[output_df['location_dist']>radius]
@@ -165,24 +166,12 @@ def get_obfuscation_utility(w_prepared, w_obfuscated, legs) -> float:
         [float]: Ratio of legs affected by obfuscation to total legs
     """
     if(w_obfuscated.shape[0] != w_prepared.shape[0]): #assume remove mode
-        timestamps = w_prepared[~w_prepared.tracked_at.isin(w_obfuscated.tracked_at)].tracked_at
+        affected = w_prepared[~w_prepared.tracked_at.isin(w_obfuscated.tracked_at)]
     else: #assume assign mode
-        timestamps = w_prepared[(w_prepared.latitude != w_obfuscated.latitude) | (w_prepared.longitude != w_obfuscated.longitude)].tracked_at
-    
-    count = 0
-    
-    timestamps = timestamps.values
-    
-    starts = legs.started_at.values
-    ends = legs.finished_at.values
-    
-    legs_size = legs.shape[0]
-    
-    for i in range(legs_size):
-        points_affected = timestamps[(timestamps>=starts[i]) & (timestamps<=ends[i])].shape[0]
-        if points_affected>0:
-            count += 1
-            
+        affected = w_prepared[(w_prepared.latitude != w_obfuscated.latitude) | (w_prepared.longitude != w_obfuscated.longitude)]
+
+    count = np.count_nonzero(LegPointIndex(legs, affected).counts > 0)
+
     return 1 - count/legs.shape[0]
 
 def dt_floor(dt, delta) -> datetime:
@@ -204,13 +193,32 @@ def dt_floor(dt, delta) -> datetime:
     )
     return dt - remainder
 
-def aggregate(waypoints_df, cell_size=0.2, delta=timedelta(minutes=15)) -> pd.DataFrame:
+def suppress_small_counts(counts, min_count=MIN_COUNT):
+    """Removes the counts under min_count, so that rare cells or flows can't single out individuals
+
+    Args:
+        counts (pandas.Series or scipy.sparse.spmatrix): Counts, e.g. the 'count' column of aggregate or an OD count matrix
+        min_count (int, optional): Smallest count kept. Defaults to MIN_COUNT.
+
+    Returns:
+        pandas.Series or scipy.sparse.csr_matrix: Counts of min_count or more. Removed entries are dropped from a Series and left empty in a sparse matrix.
+    """
+    if isinstance(counts, pd.Series):
+        return counts[counts >= min_count]
+    counts = counts.tocsr(copy=True)
+    counts.data[counts.data < min_count] = 0
+    counts.eliminate_zeros()
+    return counts
+
+@instrumented('aggregate')
+def aggregate(waypoints_df, cell_size=0.2, delta=timedelta(minutes=15), min_count=None) -> pd.DataFrame:
     """Aggregates users in timedeltas and cells on the map. Returns a DataFrame with the count of users in a given timedelta and cell.
 
     Args:
         waypoints_df (pandas.DataFrame): DataFrame with 'latitude', 'longitude', 'user_id' and 'tracked_at' columns.
         cell_size (float): Size of the square cells on the map, in kilometers.
         delta (datetime.timedelta): Frequency for the time aggregation, e.g. 15 minutes.
+        min_count (int, optional): If given, cells counting fewer users are suppressed with suppress_small_counts. Defaults to None.
 
     Returns:
         pandas.DataFrame: DataFrame with 'tracked_at', 'cell_latitude', 'cell_longitude' and 'count' columns. The 'cell_latitude' and 'cell_longitude' columns give coordinates of the centers of cells on the map.
@@ -235,4 +243,7 @@ def aggregate(waypoints_df, cell_size=0.2, delta=timedelta(minutes=15)) -> pd.Da
     df = df[['user_id', 'tracked_at', 'cell_latitude', 'cell_longitude']]
     df = df.drop_duplicates()
 
-    return df.groupby(['tracked_at','cell_latitude', 'cell_longitude']).agg('count').rename(columns={'user_id': 'count'})
\ No newline at end of file
+    res = df.groupby(['tracked_at','cell_latitude', 'cell_longitude']).agg('count').rename(columns={'user_id': 'count'})
+    if min_count is not None:
+        res = res.loc[suppress_small_counts(res['count'], min_count).index]
+    return res
\ No newline at end of file
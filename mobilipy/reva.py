@@ -3,23 +3,284 @@ from mobilipy import legs
 from mobilipy import mode_detection
 from mobilipy import preparation
 from mobilipy import segmentation
+from mobilipy import execution
+from mobilipy.waypointsdataframe import WaypointsDataFrame
+from mobilipy.instrumentation import instrumented
 
+import os
+import time
+import numpy as np
 import pandas as pd
 
-def analyse(df, user_id) -> pd.DataFrame:
+HOME_WORK_COLUMNS = ['user_id', 'home_latitude', 'home_longitude', 'work_latitude', 'work_longitude', 'error']
+
+@instrumented('analyse')
+def analyse(df, user_id, cache=None, use_multiprocessing='auto') -> pd.DataFrame:
     """Returns complete trip information from a raw GPS waypoints DataFrame. Segments the data into trips, detects the mode of transport and tags the home and work locations.
 
     Args:
         df (pandas.DataFrame): WaypointsDataFrame
         user_id (str): user's ID
+        cache (mobilipy.cache.StageCache, optional): Cache of the stage outputs, reused when the same data is analysed again. Defaults to None.
+        use_multiprocessing (bool or str, optional): Execution of the stages, True for processes, False for serial, or a policy of the execution module. Defaults to 'auto', chosen by the cost model.
 
     Returns:
         pandas.DataFrame: DataFrame with selected user's legs
     """
-    df_prepared = preparation.prepare(df)
-    route_clusters_detected = segmentation.segment(df_prepared)
-    route_clusters_detected = mode_detection.mode_detection(route_clusters_detected)
-    legs_user = legs.get_user_legs(route_clusters_detected, user_id)
+    if cache is not None:
+        df_prepared, route_clusters_detected = _run_cached_stages(df, cache, {}, {}, {}, use_multiprocessing)
+    else:
+        df_prepared = preparation.prepare(df)
+        route_clusters_detected = segmentation.segment(df_prepared, use_multiprocessing=use_multiprocessing)
+        route_clusters_detected = mode_detection.mode_detection(route_clusters_detected, use_multiprocessing=use_multiprocessing)
+    legs_user = legs.get_user_legs(route_clusters_detected, user_id, use_multiprocessing=use_multiprocessing)
     poi_detection.detect_home_work(legs_user, df_prepared)
         
-    return legs_user
\ No newline at end of file
+    return legs_user
+
+def _run_cached_stages(df, cache, prepare_kwargs, segment_kwargs, mode_detection_kwargs, use_multiprocessing):
+    """Runs preparation, route features, segmentation and mode detection through a stage cache.
+
+    Args:
+        df (pandas.DataFrame): WaypointsDataFrame of the user
+        cache (mobilipy.cache.StageCache): Cache of the stage outputs
+        prepare_kwargs (dict): Additional arguments of preparation.prepare
+        segment_kwargs (dict): Additional arguments of segmentation.segment
+        mode_detection_kwargs (dict): Additional arguments of mode_detection.mode_detection
+        use_multiprocessing (bool or str): Execution of the stages, as in segmentation.segment
+
+    Returns:
+        (pandas.DataFrame, pandas.DataFrame): prepared waypoints and segments with detected modes
+    """
+    df_prepared, key = cache.run('prepare', preparation.prepare, df, **prepare_kwargs)
+    route_user, key = cache.run('route', segmentation._create_route, df_prepared, key)
+    route_clusters_detected, key = cache.run('segment', segmentation.segment_route, route_user, key,
+                                             use_multiprocessing=use_multiprocessing, **segment_kwargs)
+    route_clusters_detected, _ = cache.run('mode_detection', mode_detection.mode_detection, route_clusters_detected, key,
+                                           use_multiprocessing=use_multiprocessing, **mode_detection_kwargs)
+    return df_prepared, route_clusters_detected
+
+def _run_stages(df, user_id, prepare_kwargs, segment_kwargs, mode_detection_kwargs, cache=None):
+    """Runs preparation, segmentation, mode detection and legs for a single user, without multiprocessing inside the stages.
+
+    Args:
+        df (pandas.DataFrame): WaypointsDataFrame of the user
+        user_id (str): user's ID
+        prepare_kwargs (dict): Additional arguments of preparation.prepare
+        segment_kwargs (dict): Additional arguments of segmentation.segment
+        mode_detection_kwargs (dict): Additional arguments of mode_detection.mode_detection
+        cache (mobilipy.cache.StageCache, optional): Cache of the stage outputs. Defaults to None.
+
+    Returns:
+        (pandas.DataFrame, pandas.DataFrame, pandas.DataFrame): prepared waypoints, segments with detected modes and legs
+    """
+    if cache is not None:
+        df_prepared, route_clusters_detected = _run_cached_stages(df, cache, prepare_kwargs, segment_kwargs, mode_detection_kwargs, False)
+    else:
+        df_prepared = preparation.prepare(df, **prepare_kwargs)
+        route_clusters_detected = segmentation.segment(df_prepared, use_multiprocessing=False, **segment_kwargs)
+        route_clusters_detected = mode_detection.mode_detection(route_clusters_detected, use_multiprocessing=False, **mode_detection_kwargs)
+    legs_user = legs.get_user_legs(route_clusters_detected, user_id, use_multiprocessing=False)
+    return df_prepared, route_clusters_detected, legs_user
+
+def _analyse_user(args):
+    """Runs the whole pipeline for a single user, without multiprocessing inside the stages.
+
+    Args:
+        args: user_id, df, prepare_kwargs, segment_kwargs, mode_detection_kwargs, cache
+
+    Returns:
+        (str, pandas.DataFrame, tuple, int, float, str): user_id, legs, (home, work), number of waypoints, processing time in seconds and error, if any
+    """
+    user_id, df, prepare_kwargs, segment_kwargs, mode_detection_kwargs, cache = args
+    start = time.perf_counter()
+    try:
+        df_prepared, _, legs_user = _run_stages(df, user_id, prepare_kwargs, segment_kwargs, mode_detection_kwargs, cache)
+        home_work = poi_detection.detect_home_work(legs_user, df_prepared)
+        return user_id, legs_user, home_work, df.shape[0], time.perf_counter() - start, None
+    except Exception as error:
+        return user_id, None, (None, None), df.shape[0], time.perf_counter() - start, repr(error)
+
+@instrumented('analyse_population')
+def analyse_population(df, use_multiprocessing='auto', processes=None, progress=None,
+                       prepare_kwargs=None, segment_kwargs=None, mode_detection_kwargs=None, cache=None):
+    """Runs the whole pipeline for every user of a multi-user waypoints DataFrame. Users are sent one by one to a pool of long-lived workers, each running all the stages for its user serially, so that there's no nested pooling. Results are collected as users finish.
+
+    Args:
+        df (pandas.DataFrame): WaypointsDataFrame with the waypoints of one or more users
+        use_multiprocessing (bool or str, optional): True for processes, False for serial, or a policy of the execution module. Defaults to 'auto', chosen by the cost model from the number of waypoints of each user.
+        processes (int, optional): Number of workers. Defaults to the choice of the cost model, at most the number of CPUs minus one.
+        progress (callable, optional): Called with the current metrics dict after each user. Defaults to None.
+        prepare_kwargs (dict, optional): Additional arguments of preparation.prepare. Defaults to None.
+        segment_kwargs (dict, optional): Additional arguments of segmentation.segment. Defaults to None.
+        mode_detection_kwargs (dict, optional): Additional arguments of mode_detection.mode_detection. Defaults to None.
+        cache (mobilipy.cache.StageCache, optional): Cache of the stage outputs, shared by the workers. Defaults to None.
+
+    Returns:
+        (pandas.DataFrame, pandas.DataFrame, dict): legs of all the users, home and work locations of each user and throughput metrics
+    """
+    start = time.perf_counter()
+    users = df.groupby('user_id', sort=False)
+    arguments = ((user_id, user_df, prepare_kwargs or {}, segment_kwargs or {}, mode_detection_kwargs or {}, cache)
+                 for user_id, user_df in users)
+
+    metrics = {
+        'users_total': users.ngroups,
+        'users_done': 0,
+        'users_failed': 0,
+        'points_done': 0,
+        'legs': 0,
+        'elapsed_s': 0.0,
+        'user_time_s': 0.0,
+        'users_per_hour': 0.0,
+        'points_per_s': 0.0,
+    }
+    all_legs = []
+    home_work = []
+
+    execution_plan = execution.plan('analyse', users.size().values, use_multiprocessing, processes)
+    results = execution.execute_unordered(_analyse_user, arguments, execution_plan)
+    for user_id, legs_user, (home, work), n_points, user_time, error in results:
+        if legs_user is not None:
+            all_legs.append(legs_user)
+            metrics['legs'] += legs_user.shape[0]
+        else:
+            metrics['users_failed'] += 1
+        home_work.append((user_id, *(home or (None, None)), *(work or (None, None)), error))
+
+        metrics['users_done'] += 1
+        metrics['points_done'] += n_points
+        metrics['user_time_s'] += user_time
+        metrics['elapsed_s'] = time.perf_counter() - start
+        metrics['users_per_hour'] = metrics['users_done'] / metrics['elapsed_s'] * 3600
+        metrics['points_per_s'] = metrics['points_done'] / metrics['elapsed_s']
+        if progress is not None:
+            progress(dict(metrics))
+
+    all_legs = pd.concat(all_legs, ignore_index=True) if all_legs else pd.DataFrame(columns=legs.LEG_FEATURES)
+    return all_legs, pd.DataFrame(home_work, columns=HOME_WORK_COLUMNS), metrics
+
+def _partition_directory(partition) -> str:
+    """Relative directory of a partition, in the hive layout
+
+    Args:
+        partition (tuple((str, object))): Partition keys and values
+
+    Returns:
+        str: e.g. 'user_id=u1/date=2022-01-04'
+    """
+    return os.path.join(*['{}={}'.format(key, value) for key, value in partition]) if partition else ''
+
+def _write_parquet(df, path):
+    """Writes a DataFrame to a Parquet file atomically, through a temporary file in the same directory.
+
+    Args:
+        df (pandas.DataFrame): DataFrame to be written
+        path (str): Path of the Parquet file
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+    os.replace(tmp_path, path)
+
+def _analyse_partition(args):
+    """Reads one partition of the waypoints dataset, runs preparation, segmentation, mode detection and legs for each of its users and writes the segments and the legs to the output dataset. A _SUCCESS marker is written last, once both outputs are complete.
+
+    Args:
+        args: partition, paths, output_path, prepare_kwargs, segment_kwargs, mode_detection_kwargs, cache
+
+    Returns:
+        (str, str, int, int, int, float, str): partition directory, status, number of users, points and legs, processing time in seconds and error, if any
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    partition, paths, output_path, prepare_kwargs, segment_kwargs, mode_detection_kwargs, cache = args
+    start = time.perf_counter()
+    directory = _partition_directory(partition)
+    n_users, n_points, n_legs = 0, 0, 0
+    try:
+        waypoints = pa.concat_tables([pq.read_table(path) for path in paths]).to_pandas()
+        for key, value in partition:
+            waypoints[key] = value
+        n_points = waypoints.shape[0]
+
+        all_segments = []
+        all_legs = []
+        for user_id, user_waypoints in waypoints.groupby('user_id', sort=False):
+            _, segments, legs_user = _run_stages(WaypointsDataFrame(user_waypoints), user_id,
+                                                 prepare_kwargs, segment_kwargs, mode_detection_kwargs, cache)
+            segments['user_id'] = user_id
+            legs_user['geometry'] = legs_user.geometry.map(lambda geometry: np.asarray(geometry, dtype=np.float64).tolist())
+            all_segments.append(segments)
+            all_legs.append(legs_user)
+            n_users += 1
+            n_legs += legs_user.shape[0]
+
+        if all_legs:
+            # partition keys are encoded in the directories, as in the input dataset
+            keys = [key for key, _ in partition]
+            all_segments = pd.concat(all_segments, ignore_index=True).drop(columns=keys, errors='ignore')
+            all_legs = pd.concat(all_legs, ignore_index=True).drop(columns=keys, errors='ignore')
+            _write_parquet(all_segments, os.path.join(output_path, 'segments', directory, 'part-0.parquet'))
+            _write_parquet(all_legs, os.path.join(output_path, 'legs', directory, 'part-0.parquet'))
+        os.makedirs(os.path.join(output_path, 'legs', directory), exist_ok=True)
+        open(os.path.join(output_path, 'legs', directory, '_SUCCESS'), 'w').close()
+        return directory, 'done', n_users, n_points, n_legs, time.perf_counter() - start, None
+    except Exception as error:
+        return directory, 'failed', n_users, n_points, n_legs, time.perf_counter() - start, repr(error)
+
+def analyse_parquet(input_path, output_path, use_multiprocessing='auto', processes=None, progress=None,
+                    prepare_kwargs=None, segment_kwargs=None, mode_detection_kwargs=None, cache=None) -> pd.DataFrame:
+    """Runs the pipeline over a Parquet dataset of waypoints partitioned by user and/or date in the hive layout (e.g. input_path/user_id=u1/date=2022-01-04/part-0.parquet), one partition at a time, so that memory only depends on the size of the partitions.
+
+    Segments and legs are written to output_path/segments and output_path/legs with the same partitioning. Partitions whose legs already have a _SUCCESS marker are skipped, so that an interrupted run resumes where it stopped.
+
+    Args:
+        input_path (str): Root directory of the waypoints dataset, with the columns of a WaypointsDataFrame
+        output_path (str): Root directory of the output datasets
+        use_multiprocessing (bool or str, optional): True for a pool of worker processes, False for serial, or a policy of the execution module. Defaults to 'auto', chosen by the cost model from the row counts in the Parquet metadata.
+        processes (int, optional): Number of workers. Defaults to the choice of the cost model, at most the number of CPUs minus one.
+        progress (callable, optional): Called as progress(done, total, partition) after each partition. Defaults to None.
+        prepare_kwargs (dict, optional): Additional arguments of preparation.prepare. Defaults to None.
+        segment_kwargs (dict, optional): Additional arguments of segmentation.segment. Defaults to None.
+        mode_detection_kwargs (dict, optional): Additional arguments of mode_detection.mode_detection. Defaults to None.
+        cache (mobilipy.cache.StageCache, optional): Cache of the stage outputs, shared by the workers. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: Report with 'partition', 'status' ('done', 'skipped' or 'failed'), 'users', 'points', 'legs', 'time_s' and 'error' columns, one row per partition
+    """
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(input_path, format='parquet', partitioning='hive')
+    partitions = {}
+    rows = {}
+    for fragment in dataset.get_fragments():
+        keys = ds.get_partition_keys(fragment.partition_expression)
+        # keeps the order of the keys in the input layout
+        directories = os.path.relpath(os.path.dirname(fragment.path), input_path).split(os.sep)
+        partition = tuple((key, keys[key]) for key in (directory.split('=', 1)[0] for directory in directories) if key in keys)
+        partitions.setdefault(partition, []).append(fragment.path)
+        rows[partition] = rows.get(partition, 0) + fragment.metadata.num_rows
+
+    report = []
+    arguments = []
+    sizes = []
+    for partition, paths in partitions.items():
+        directory = _partition_directory(partition)
+        if os.path.exists(os.path.join(output_path, 'legs', directory, '_SUCCESS')):
+            report.append((directory, 'skipped', 0, 0, 0, 0.0, None))
+        else:
+            arguments.append((partition, paths, output_path, prepare_kwargs or {}, segment_kwargs or {}, mode_detection_kwargs or {}, cache))
+            sizes.append(rows[partition])
+
+    execution_plan = execution.plan('analyse', sizes, use_multiprocessing, processes)
+    for done, result in enumerate(execution.execute_unordered(_analyse_partition, arguments, execution_plan), start=1):
+        report.append(result)
+        if progress is not None:
+            progress(done, len(arguments), result[0])
+
+    return pd.DataFrame(report, columns=['partition', 'status', 'users', 'points', 'legs', 'time_s', 'error'])
@@ -1,43 +1,19 @@
 import pandas as pd
 import numpy as np
-from sklearn.cluster import DBSCAN
 import more_itertools as mit
-import multiprocessing as mp
 from numba import njit
+from mobilipy import execution, geodesy, instrumentation
+from mobilipy.lazy import LazyModule
 pd.options.mode.chained_assignment = None
 
-@njit
-def _distance_between_two_coordinates(lat1_degrees, lon1_degrees, lat2_degrees, lon2_degrees) -> float:
-    """Distance in meters between two points given in coordinates using the haversine distance.
+cluster = LazyModule('sklearn.cluster')
+neighbors = LazyModule('sklearn.neighbors')
 
-    Args:
-        lat1_degrees (float): latitude of the first point in degrees.
-        lon1_degrees (float): longitude of the first point in degrees.
-        lat2_degrees (float): latitude of the second point in degrees.
-        lon2_degrees (float): longitude of the second point in degrees.
-
-    Returns:
-        float: distance in m between the two coordiantes.
-    """
-
-    # approximate radius of earth in km
-    R = 6373.0
-
-    lat1 = np.deg2rad(lat1_degrees)
-    lon1 = np.deg2rad(lon1_degrees)
-    lat2 = np.deg2rad(lat2_degrees)
-    lon2 = np.deg2rad(lon2_degrees)
+ENGINES = ('dbscan', 'staypoint')
+"""Activity detection engines of segment: per-day DBSCAN, or a single time/distance stay-point scan"""
 
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-
-    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * \
-        np.cos(lat2) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-
-    distance = R * c
-
-    return distance * 1000
+STAY_MIN_DURATION_S = 300
+"""Time a user has to remain within the radius of a stay for the stay-point engine to detect it, in seconds"""
 
 def _create_route(df) -> pd.DataFrame:
     """Adds distance, time_delta, speed (m/s) and acceleration to the waypoints DataFrame
@@ -65,7 +41,7 @@ def _create_route(df) -> pd.DataFrame:
             "accuracy_end",
         ], errors='ignore'
     )
-    res["distance"] = _distance_between_two_coordinates(
+    res["distance"] = geodesy.distance(
         res.latitude_start.values,
         res.longitude_start.values,
         res.latitude_end.values,
@@ -107,8 +83,34 @@ def _activities_density(args) -> pd.DataFrame:
     """
     df, clusterer = args
     clusters_start = clusterer.fit_predict(
-        np.radians(df[["latitude_start", "longitude_start"]]))
+        np.radians(df[["latitude_start", "longitude_start"]]),
+        sample_weight=_sample_weight(df))
+
+    return _apply_clusters(df, clusters_start)
+
+def _sample_weight(df):
+    """Returns the number of waypoints each route row stands for, when the waypoints were collapsed by preparation.collapse_stationary
+
+    Args:
+        df (pandas.DataFrame): Route DataFrame
+
+    Returns:
+        numpy.ndarray: float64 weights, or None if the waypoints weren't collapsed
+    """
+    if 'weight_start' not in df.columns:
+        return None
+    return df.weight_start.values.astype(np.float64)
+
+def _apply_clusters(df, clusters_start) -> pd.DataFrame:
+    """Tags as activities the consecutive waypoints belonging to the same cluster
+
+    Args:
+        df (pandas.DataFrame): Route DataFrame of one day, with the 'detection' column
+        clusters_start (numpy.ndarray): DBSCAN cluster label of each waypoint, -1 for noise
 
+    Returns:
+        pandas.DataFrame: DataFrame with 'cluster_start', 'cluster_end' and updated 'detection' columns
+    """
     df["cluster_start"] = clusters_start
     df["cluster_end"] = df.cluster_start.shift(-1).fillna(0).astype('int')
 
@@ -153,55 +155,99 @@ def _correct_clusters(df):
     df['detection'] = detection
 
 
-def segment(prepared_df, radius=0.025, min_samples=50, time_gap=850, use_multiprocessing=True) -> pd.DataFrame:
+def _split_days(route_df):
+    """Flags the route for detection and splits it by day, the unit on which DBSCAN is run
+
+    Args:
+        route_df (pandas.DataFrame): Route DataFrame, coming from _create_route
+
+    Returns:
+        (pandas.DataFrame, list(pandas.DataFrame)): route DataFrame with 'detection', 'day', 'month' and 'year' columns and its days
+    """
+    df = _prepare_for_detection(route_df)
+
+    df["day"] = df.tracked_at_start.apply(lambda x: x.day)
+    df["month"] = df.tracked_at_start.apply(lambda x: x.month)
+    df["year"] = df.tracked_at_start.apply(lambda x: x.year)
+
+    groups = df.groupby(['day', 'month', 'year']).groups.items()
+    return df, [df.iloc[list(indexes)] for _, indexes in groups]
+
+@instrumentation.instrumented('segment')
+def segment(prepared_df, radius=0.025, min_samples=50, time_gap=850, use_multiprocessing='auto', engine='dbscan', min_duration=STAY_MIN_DURATION_S) -> pd.DataFrame:
     """Finds clusters of waypoints for legs
 
     Args:
         df (pandas.DataFrame): Waypoints DataFrame to be processed
-        radius (float): Eps for DBSCAN
+        radius (float): Eps for DBSCAN, or radius of a stay for the stay-point engine, in km
         min_samples (int): Minimum number of samples to be considered for
         time_gap (float): Max time gap threshold for detected clusters
+        use_multiprocessing (bool or str, optional): Execution of the per-day DBSCAN: True for processes, False for serial, or a policy of the execution module. Defaults to 'auto', chosen by the cost model.
+        engine (str, optional): 'dbscan', or 'staypoint' for a linear-time scan that doesn't depend on the sampling rate. Defaults to 'dbscan'.
+        min_duration (float, optional): Shortest stay of the stay-point engine, in seconds. Defaults to STAY_MIN_DURATION_S.
 
     Returns:
         pandas.DataFrame: DataFrame with the segment starts and ends
     """
-    
-    route_user = _create_route(prepared_df)
-    df = _prepare_for_detection(route_user)
+    with instrumentation.span('segment.route', prepared_df.shape[0]) as step:
+        route_user = _create_route(prepared_df)
+        step.set(rows_out=route_user.shape[0])
+    return segment_route(route_user, radius, min_samples, time_gap, use_multiprocessing, engine, min_duration)
 
-    df["day"] = df.tracked_at_start.apply(lambda x: x.day)
-    df["month"] = df.tracked_at_start.apply(lambda x: x.month)
-    df["year"] = df.tracked_at_start.apply(lambda x: x.year)
+def segment_route(route_df, radius=0.025, min_samples=50, time_gap=850, use_multiprocessing='auto', engine='dbscan', min_duration=STAY_MIN_DURATION_S) -> pd.DataFrame:
+    """Finds clusters of waypoints for legs, from waypoints already turned into a route by _create_route, so that the route can be reused across parameters
 
-    db = DBSCAN(eps=radius / 6371.0, min_samples=min_samples,
+    Args:
+        route_df (pandas.DataFrame): Route DataFrame, with distance, time_delta, speed and acceleration
+        radius (float): Eps for DBSCAN, or radius of a stay for the stay-point engine, in km
+        min_samples (int): Minimum number of samples to be considered for
+        time_gap (float): Max time gap threshold for detected clusters
+        use_multiprocessing (bool or str, optional): Execution of the per-day DBSCAN: True for processes, False for serial, or a policy of the execution module. Defaults to 'auto', chosen by the cost model.
+        engine (str, optional): 'dbscan', or 'staypoint' for a linear-time scan that doesn't depend on the sampling rate. Defaults to 'dbscan'.
+        min_duration (float, optional): Shortest stay of the stay-point engine, in seconds. Defaults to STAY_MIN_DURATION_S.
+
+    Returns:
+        pandas.DataFrame: DataFrame with the segment starts and ends
+    """
+    assert engine in ENGINES, "engine must be either 'dbscan' or 'staypoint'"
+    if engine == 'staypoint':
+        return _segment_stay_points(route_df, radius, time_gap, min_duration)
+
+    df, days = _split_days(route_df)
+
+    db = cluster.DBSCAN(eps=radius * 1000 / geodesy.EARTH_RADIUS_M, min_samples=min_samples,
                 algorithm="ball_tree", metric="haversine")
 
     route_clusters_detected = pd.DataFrame(columns=list(
         df.columns) + list(['cluster_start', 'cluster_end']))
 
-    arguments = list(df.groupby(['day', 'month', 'year']).groups.items())
-    arguments = list(map(lambda x: (df.iloc[list(x[1])], db), arguments))
+    arguments = list(map(lambda x: (x, db), days))
 
-    if use_multiprocessing:
-        pool = mp.Pool(processes=(mp.cpu_count() - 1))
-        results = pool.map_async(_activities_density, arguments)
-        pool.close()
-        pool.join()
-
-        for res in results.get(timeout=1):
-            route_clusters_detected = route_clusters_detected.append(res)
-    else:
-        for argument_list in arguments:
-            res = _activities_density(argument_list)
+    with instrumentation.span('segment.dbscan', df.shape[0]) as step:
+        execution_plan = execution.plan('segment.dbscan', [day.shape[0] for day in days], use_multiprocessing)
+        for res in execution.execute(_activities_density, arguments, execution_plan, step):
             route_clusters_detected = route_clusters_detected.append(res)
 
+    return _finalize_segments(route_clusters_detected, time_gap)
+
+def _finalize_segments(route_clusters_detected, time_gap) -> pd.DataFrame:
+    """Sorts the clustered days, corrects the detections and drops the waypoints after a time gap
+
+    Args:
+        route_clusters_detected (pandas.DataFrame): Clustered route DataFrames of all the days
+        time_gap (float): Max time gap threshold for detected clusters
+
+    Returns:
+        pandas.DataFrame: DataFrame with the segment starts and ends
+    """
     route_clusters_detected = route_clusters_detected.sort_values(
         by='tracked_at_start', ascending=True)
     route_clusters_detected = route_clusters_detected.drop(
-        columns=['day', 'month', 'year'])
+        columns=['day', 'month', 'year'], errors='ignore')
     route_clusters_detected = route_clusters_detected.reset_index().drop(columns="index")
 
-    _correct_clusters(route_clusters_detected)
+    with instrumentation.span('segment.correct_clusters', route_clusters_detected.shape[0]):
+        _correct_clusters(route_clusters_detected)
 
     route_clusters_detected = (route_clusters_detected.drop(
         route_clusters_detected[route_clusters_detected.time_delta >
@@ -214,3 +260,209 @@ def segment(prepared_df, radius=0.025, min_samples=50, time_gap=850, use_multipr
     route_clusters_detected = route_clusters_detected.drop(
         columns=['cluster_start', 'cluster_end'])
     return route_clusters_detected
+
+
+@njit(cache=True)
+def _stay_points(seconds, latitudes, longitudes, weights, radius, min_duration) -> np.ndarray:
+    """Labels the stays of a route in a single pass. A stay grows while the points stay within radius of its weighted centroid and is kept if it lasts at least min_duration, otherwise a new one starts at the point that left it.
+
+    Args:
+        seconds (numpy.ndarray): Timestamps of the points, in seconds
+        latitudes (numpy.ndarray): Latitudes of the points in degrees
+        longitudes (numpy.ndarray): Longitudes of the points in degrees
+        weights (numpy.ndarray): Number of waypoints each point stands for
+        radius (float): Radius of a stay, in meters
+        min_duration (float): Shortest stay, in seconds
+
+    Returns:
+        numpy.ndarray: Stay label of each point, -1 outside of the stays, as the cluster labels of DBSCAN
+    """
+    n = seconds.shape[0]
+    labels = np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return labels
+    label = 0
+    start = 0
+    latitude_sum = latitudes[0] * weights[0]
+    longitude_sum = longitudes[0] * weights[0]
+    weight_sum = weights[0]
+    for i in range(1, n + 1):
+        if i < n and geodesy.haversine(latitude_sum / weight_sum, longitude_sum / weight_sum, latitudes[i], longitudes[i]) <= radius:
+            latitude_sum += latitudes[i] * weights[i]
+            longitude_sum += longitudes[i] * weights[i]
+            weight_sum += weights[i]
+            continue
+        if seconds[i - 1] - seconds[start] >= min_duration:
+            labels[start:i] = label
+            label += 1
+        if i < n:
+            start = i
+            latitude_sum = latitudes[i] * weights[i]
+            longitude_sum = longitudes[i] * weights[i]
+            weight_sum = weights[i]
+    return labels
+
+def _segment_stay_points(route_df, radius, time_gap, min_duration) -> pd.DataFrame:
+    """Detects activities with the stay-point engine, over the whole route at once, and tags them as segment_route does
+
+    Args:
+        route_df (pandas.DataFrame): Route DataFrame, coming from _create_route
+        radius (float): Radius of a stay, in km
+        time_gap (float): Max time gap threshold for detected clusters
+        min_duration (float): Shortest stay, in seconds
+
+    Returns:
+        pandas.DataFrame: DataFrame with the segment starts and ends
+    """
+    df = _prepare_for_detection(route_df)
+    with instrumentation.span('segment.staypoint', df.shape[0]):
+        seconds = pd.DatetimeIndex(pd.to_datetime(df.tracked_at_start, utc=True)).asi8 / 10**9
+        weights = _sample_weight(df)
+        if weights is None:
+            weights = np.ones(df.shape[0], dtype=np.float64)
+        labels = _stay_points(seconds, df.latitude_start.values.astype(np.float64), df.longitude_start.values.astype(np.float64),
+                              weights, float(radius * 1000), float(min_duration))
+        df = _apply_clusters(df, labels)
+    return _finalize_segments(df, time_gap)
+
+def _neighbourhood_graph(tree, coordinates, radius):
+    """Computes the radius-neighbourhood graph of the waypoints of one day in compressed sparse row form: the neighbours of point i are indices[indptr[i]:indptr[i + 1]]. This is the query sklearn's DBSCAN runs, distances being left out as they cost several times the search on dense stays.
+
+    Args:
+        tree (sklearn.neighbors.BallTree): Haversine ball tree of the waypoints
+        coordinates (numpy.ndarray): Latitudes and longitudes of the waypoints, in radians
+        radius (float): Radius of the graph, in km
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): indptr and indices
+    """
+    neighbours = tree.query_radius(coordinates, r=radius * 1000 / geodesy.EARTH_RADIUS_M)
+    counts = np.fromiter((len(row) for row in neighbours), dtype=np.int64, count=len(neighbours))
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    indices = np.concatenate(neighbours).astype(np.int64, copy=False) if len(neighbours) else np.empty(0, dtype=np.int64)
+    return indptr, indices
+
+@njit(cache=True)
+def _dbscan_from_graph(indptr, indices, weights, min_samples) -> np.ndarray:
+    """Labels the waypoints as sklearn's DBSCAN would, from the neighbourhood graph at its eps
+
+    Args:
+        indptr (numpy.ndarray): Row pointers of the graph
+        indices (numpy.ndarray): Column indices of the graph
+        weights (numpy.ndarray): Number of waypoints each row stands for
+        min_samples (int): Minimum weight of the neighbours of a core point, itself included
+
+    Returns:
+        numpy.ndarray: Cluster label of each waypoint, -1 for noise
+    """
+    n = len(indptr) - 1
+    degree = np.zeros(n, dtype=np.float64)
+    for i in range(n):
+        for j in range(indptr[i], indptr[i + 1]):
+            degree[i] += weights[indices[j]]
+
+    # Points are labelled when pushed, so that each one is pushed at most once. The points of a cluster don't depend on the order of the expansion.
+    labels = np.full(n, -1, dtype=np.int64)
+    stack = np.empty(n, dtype=np.int64)
+    label = 0
+    for start in range(n):
+        if labels[start] != -1 or degree[start] < min_samples:
+            continue
+        labels[start] = label
+        stack[0] = start
+        size = 1
+        while size > 0:
+            size -= 1
+            i = stack[size]
+            if degree[i] >= min_samples:
+                for j in range(indptr[i], indptr[i + 1]):
+                    if labels[indices[j]] == -1:
+                        labels[indices[j]] = label
+                        stack[size] = indices[j]
+                        size += 1
+        label += 1
+    return labels
+
+def _sweep_day(args):
+    """Clusters one day for every (radius, min_samples) pair. The ball tree of the day is built once, and the neighbourhood graph once per radius, every min_samples being derived from it. Radii don't share a graph, see segment_sweep.
+
+    Args:
+        args: df, parameters with df the route DataFrame of one day and parameters a list of (radius, min_samples) pairs
+
+    Returns:
+        list(numpy.ndarray): Cluster labels of the day for each pair
+    """
+    df, parameters = args
+    coordinates = np.radians(df[["latitude_start", "longitude_start"]].values)
+    tree = neighbors.BallTree(coordinates, metric="haversine")
+    weights = _sample_weight(df)
+    if weights is None:
+        weights = np.ones(len(df), dtype=np.float64)
+
+    labels = {}
+    for radius in dict.fromkeys(radius for radius, _ in parameters):
+        indptr, indices = _neighbourhood_graph(tree, coordinates, radius)
+        for samples in dict.fromkeys(samples for other, samples in parameters if other == radius):
+            labels[(radius, samples)] = _dbscan_from_graph(indptr, indices, weights, samples)
+    return [labels[pair] for pair in parameters]
+
+def _summarize_segments(df) -> dict:
+    """Summarizes the detections of a segmented DataFrame
+
+    Args:
+        df (pandas.DataFrame): DataFrame coming from segment
+
+    Returns:
+        dict: number of activities and trips, and their total durations in seconds
+    """
+    detection = df.detection.values
+    starts = np.flatnonzero(np.concatenate([[True], detection[1:] != detection[:-1]])) if len(detection) else np.empty(0, dtype=int)
+    durations = df.time_delta.values
+    return {
+        'waypoints': len(df),
+        'activities': int(np.sum(detection[starts] == 'activity')),
+        'trips': int(np.sum(detection[starts] == 'trip')),
+        'activity_duration': float(np.sum(durations[detection == 'activity'])),
+        'trip_duration': float(np.sum(durations[detection == 'trip'])),
+    }
+
+@instrumentation.instrumented('segment_sweep')
+def segment_sweep(prepared_df, radii=(0.025,), min_samples=(50,), time_gaps=(850,), use_multiprocessing='auto', return_segments=False):
+    """Runs segment for every combination of parameters. The route is computed once, and the radius-neighbourhood graph of each day once per radius, the clusters of every min_samples being derived from it. Radii don't share a graph: each one runs its own neighbour query, as deriving the smaller radii from the distances of the largest one costs more than the queries on dense stays. The savings therefore come from the min_samples and time_gaps axes, a grid over radii alone costing about as much as calling segment for each radius. Results are the same as calling segment for each combination.
+
+    Args:
+        prepared_df (pandas.DataFrame): Waypoints DataFrame to be processed
+        radii (list(float), optional): Eps values for DBSCAN, in km. Defaults to (0.025,).
+        min_samples (list(int), optional): Minimum numbers of samples of a cluster. Defaults to (50,).
+        time_gaps (list(float), optional): Max time gap thresholds for detected clusters. Defaults to (850,).
+        use_multiprocessing (bool or str, optional): True for processes, False for serial, or a policy of the execution module. Defaults to 'auto', chosen by the cost model.
+        return_segments (bool, optional): Specifies whether the segmented DataFrames should be returned too. Defaults to False.
+
+    Returns:
+        pandas.DataFrame: One row per combination, with 'radius', 'min_samples', 'time_gap', 'waypoints', 'activities', 'trips', 'activity_duration' and 'trip_duration' columns. If return_segments is True, a dict mapping each (radius, min_samples, time_gap) to its segmented DataFrame is returned as well.
+    """
+    parameters = [(radius, samples) for radius in radii for samples in min_samples]
+    df, days = _split_days(_create_route(prepared_df))
+    arguments = [(day, parameters) for day in days]
+
+    execution_plan = execution.plan('segment_sweep', [day.shape[0] * len(parameters) for day in days], use_multiprocessing)
+    days_labels = execution.execute(_sweep_day, arguments, execution_plan)
+
+    rows = []
+    segments = {}
+    for k, (radius, samples) in enumerate(parameters):
+        clustered = [_apply_clusters(day.copy(), labels[k]) for day, labels in zip(days, days_labels)]
+        if clustered:
+            route_clusters_detected = pd.concat(clustered)
+        else:
+            route_clusters_detected = pd.DataFrame(columns=list(df.columns) + ['cluster_start', 'cluster_end'])
+        for time_gap in time_gaps:
+            segmented = _finalize_segments(route_clusters_detected, time_gap)
+            rows.append({'radius': radius, 'min_samples': samples, 'time_gap': time_gap, **_summarize_segments(segmented)})
+            if return_segments:
+                segments[(radius, samples, time_gap)] = segmented
+
+    table = pd.DataFrame(rows, columns=['radius', 'min_samples', 'time_gap', 'waypoints', 'activities', 'trips', 'activity_duration', 'trip_duration'])
+    if return_segments:
+        return table, segments
+    return table
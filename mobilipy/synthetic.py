@@ -0,0 +1,380 @@
+import os
+import json
+import zlib
+import numpy as np
+import pandas as pd
+from mobilipy import geodesy
+
+ORIGIN = (47.3769, 8.5417)
+"""Center of the generated area (Zurich), as (latitude, longitude)"""
+
+AREA_RADIUS_M = 8000
+"""Radius around the origin where homes and workplaces are drawn, in meters"""
+
+SPEEDS_MS = {'Walk': 1.3, 'Transit': 9.0, 'Car': 14.0}
+"""Cruise speed of each mode, in m/s"""
+
+STOP_SPACING_M = {'Walk': np.inf, 'Transit': 600.0, 'Car': 900.0}
+"""Distance between two stops (transit stops, traffic lights) of each mode, in meters"""
+
+STOP_DWELL_S = {'Walk': 0.0, 'Transit': 30.0, 'Car': 20.0}
+"""Time spent at each stop of each mode, in seconds"""
+
+WALK_DISTANCE_M = 1500
+"""Commutes shorter than this are walked"""
+
+ACCESS_DISTANCE_M = 300
+"""Walk between home or work and the transit stop, in meters"""
+
+TRUTH_COLUMNS = ['user_id', 'started_at', 'finished_at', 'type', 'mode']
+
+
+def _offset(point, north_m, east_m):
+    """Moves a point by a distance in meters, on a local flat approximation
+
+    Args:
+        point ((float, float)): latitude and longitude in degrees
+        north_m (float or numpy.ndarray): distance to the north, in meters
+        east_m (float or numpy.ndarray): distance to the east, in meters
+
+    Returns:
+        (float, float): latitude and longitude in degrees
+    """
+    latitude = point[0] + north_m / geodesy.METERS_PER_DEGREE
+    longitude = point[1] + east_m / (geodesy.METERS_PER_DEGREE * np.cos(np.deg2rad(point[0])))
+    return latitude, longitude
+
+def _distance_m(a, b) -> float:
+    """Great-circle distance between two points, in meters"""
+    return float(geodesy.haversine(a[0], a[1], b[0], b[1]))
+
+def _interpolate(a, b, fraction):
+    """Points at the given fractions of the segment from a to b"""
+    return a[0] + (b[0] - a[0]) * fraction, a[1] + (b[1] - a[1]) * fraction
+
+def _travelled_m(elapsed, mode, distance):
+    """Distance travelled after elapsed seconds by a mode cruising between evenly spaced stops
+
+    Args:
+        elapsed (numpy.ndarray): seconds since the departure
+        mode (str): 'Walk', 'Transit' or 'Car'
+        distance (float): length of the trip, in meters
+
+    Returns:
+        numpy.ndarray: travelled distance in meters, at most distance
+    """
+    speed, spacing, dwell = SPEEDS_MS[mode], STOP_SPACING_M[mode], STOP_DWELL_S[mode]
+    if not np.isfinite(spacing):
+        return np.minimum(elapsed * speed, distance)
+    period = spacing / speed + dwell
+    hops, within = np.divmod(elapsed, period)
+    return np.minimum(hops * spacing + np.minimum(within * speed, spacing), distance)
+
+def _travel_time_s(mode, distance) -> float:
+    """Duration of a trip of the given length with the given mode, in seconds"""
+    speed, spacing, dwell = SPEEDS_MS[mode], STOP_SPACING_M[mode], STOP_DWELL_S[mode]
+    stops = 0 if not np.isfinite(spacing) else max(int(np.ceil(distance / spacing)) - 1, 0)
+    return distance / speed + stops * dwell
+
+def _plan_day(rng, home, work, commute_mode, day_start):
+    """Plans the stays and moves of one day: home, commute, work with an optional lunch walk, commute back, home
+
+    Args:
+        rng (numpy.random.Generator): random generator of the user
+        home ((float, float)): home location
+        work ((float, float)): work location
+        commute_mode (str): 'Walk', 'Transit' or 'Car'
+        day_start (float): seconds since the epoch of the start of the day
+
+    Returns:
+        list(tuple): (start, end, mode, a, b) for each segment, mode being None for stays
+    """
+    segments = []
+    clock = day_start
+
+    def stay(point, duration):
+        nonlocal clock
+        segments.append((clock, clock + duration, None, point, point))
+        clock += duration
+
+    def move(a, b, mode):
+        nonlocal clock
+        duration = _travel_time_s(mode, _distance_m(a, b))
+        segments.append((clock, clock + duration, mode, a, b))
+        clock += duration
+
+    def commute(a, b):
+        if commute_mode == 'Transit':
+            distance = _distance_m(a, b)
+            stop_a = _interpolate(a, b, ACCESS_DISTANCE_M / distance)
+            stop_b = _interpolate(a, b, 1 - ACCESS_DISTANCE_M / distance)
+            move(a, stop_a, 'Walk')
+            stay(stop_a, rng.uniform(60, 300))
+            move(stop_a, stop_b, 'Transit')
+            move(stop_b, b, 'Walk')
+        else:
+            move(a, b, commute_mode)
+
+    stay(home, rng.normal(7.5, 0.5) * 3600)
+    commute(home, work)
+    if rng.random() < 0.5:
+        stay(work, max(day_start + rng.normal(12, 0.25) * 3600 - clock, 600))
+        lunch = _offset(work, *rng.normal(0, 300, 2))
+        move(work, lunch, 'Walk')
+        stay(lunch, rng.uniform(30, 60) * 60)
+        move(lunch, work, 'Walk')
+    stay(work, max(day_start + rng.normal(17, 0.5) * 3600 - clock, 1800))
+    commute(work, home)
+    stay(home, day_start + 24 * 3600 - clock)
+    return segments
+
+def _sample(segments, rng, sampling_interval, noise_m, jitter):
+    """Samples positions along planned segments
+
+    Args:
+        segments (list(tuple)): segments coming from _plan_day
+        rng (numpy.random.Generator): random generator of the user
+        sampling_interval (float): seconds between two waypoints
+        noise_m (float): standard deviation of the GPS noise, in meters
+        jitter (float): standard deviation of the sampling times, as a fraction of the sampling interval
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray): seconds since the epoch, latitudes and longitudes
+    """
+    starts = np.array([segment[0] for segment in segments])
+    times = np.arange(starts[0], segments[-1][1], sampling_interval)
+    if jitter > 0:
+        times = np.sort(times + rng.normal(0, jitter * sampling_interval, len(times)))
+        times = times[(times >= starts[0]) & (times < segments[-1][1])]
+    owner = np.searchsorted(starts, times, side='right') - 1
+
+    latitudes = np.empty(len(times))
+    longitudes = np.empty(len(times))
+    for k, (start, _, mode, a, b) in enumerate(segments):
+        mask = owner == k
+        if mode is None:
+            latitudes[mask], longitudes[mask] = a
+        else:
+            distance = _distance_m(a, b)
+            fraction = _travelled_m(times[mask] - start, mode, distance) / distance if distance > 0 else 0.0
+            latitudes[mask], longitudes[mask] = _interpolate(a, b, fraction)
+
+    latitudes, longitudes = _offset((latitudes, longitudes), rng.normal(0, noise_m, len(times)), rng.normal(0, noise_m, len(times)))
+    return times, latitudes, longitudes
+
+def generate_user(user_id, days=1, sampling_interval=10, noise_m=5, jitter=0.0, seed=0, start='2022-01-03', origin=ORIGIN, return_truth=False):
+    """Generates the waypoints of one user: days spent at home and work, with walk, transit-like or car-like commutes and optional lunch walks. The output only depends on the arguments.
+
+    Args:
+        user_id (str): user's ID
+        days (int, optional): Number of days. Defaults to 1.
+        sampling_interval (float, optional): Seconds between two waypoints. Defaults to 10.
+        noise_m (float, optional): Standard deviation of the GPS noise, in meters. Defaults to 5.
+        jitter (float, optional): Standard deviation of the sampling times, as a fraction of the sampling interval. Defaults to 0.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+        start (str, optional): First day, in UTC. Defaults to '2022-01-03'.
+        origin ((float, float), optional): Center of the area. Defaults to ORIGIN.
+        return_truth (bool, optional): Specifies whether the planned stays and moves should be returned too. Defaults to False.
+
+    Returns:
+        pandas.DataFrame: Waypoints with tracked_at, latitude, longitude, user_id and accuracy columns. If return_truth is True, a DataFrame with the planned segments, in TRUTH_COLUMNS, is returned as well.
+    """
+    rng = np.random.default_rng([seed, zlib.crc32(str(user_id).encode())])
+    home = _offset(origin, *rng.uniform(-AREA_RADIUS_M, AREA_RADIUS_M, 2) / np.sqrt(2))
+    work = _offset(origin, *rng.uniform(-AREA_RADIUS_M, AREA_RADIUS_M, 2) / np.sqrt(2))
+    if _distance_m(home, work) < WALK_DISTANCE_M:
+        commute_mode = 'Walk'
+    else:
+        commute_mode = 'Transit' if rng.random() < 0.5 else 'Car'
+
+    first_day = pd.Timestamp(start, tz='UTC').value / 1e9
+    segments = []
+    for day in range(days):
+        segments += _plan_day(rng, home, work, commute_mode, first_day + day * 24 * 3600)
+    times, latitudes, longitudes = _sample(segments, rng, sampling_interval, noise_m, jitter)
+
+    df = pd.DataFrame({
+        'tracked_at': pd.to_datetime(np.round(times * 1e9).astype(np.int64), utc=True),
+        'latitude': latitudes,
+        'longitude': longitudes,
+        'user_id': user_id,
+        'accuracy': np.maximum(np.round(np.abs(rng.normal(noise_m, noise_m / 2, len(times)))), 1).astype(np.int64),
+    })
+    if not return_truth:
+        return df
+
+    truth = pd.DataFrame([(user_id, start_s, end_s, 'Stay' if mode is None else 'Track', mode)
+                          for start_s, end_s, mode, _, _ in segments], columns=TRUTH_COLUMNS)
+    truth['started_at'] = pd.to_datetime(np.round(truth.started_at * 1e9).astype(np.int64), utc=True)
+    truth['finished_at'] = pd.to_datetime(np.round(truth.finished_at * 1e9).astype(np.int64), utc=True)
+    return df, truth
+
+def iter_users(users=10, days=1, seed=0, **kwargs):
+    """Generates users one by one, so that large populations don't have to fit in memory
+
+    Args:
+        users (int, optional): Number of users. Defaults to 10.
+        days (int, optional): Number of days per user. Defaults to 1.
+        seed (int, optional): Seed of the random generators. Defaults to 0.
+        **kwargs: Additional arguments of generate_user
+
+    Yields:
+        pandas.DataFrame: Waypoints of one user
+    """
+    for user in range(users):
+        yield generate_user('user_{}'.format(user), days=days, seed=seed, **kwargs)
+
+def generate(users=10, days=1, seed=0, **kwargs) -> pd.DataFrame:
+    """Generates the waypoints of several users
+
+    Args:
+        users (int, optional): Number of users. Defaults to 10.
+        days (int, optional): Number of days per user. Defaults to 1.
+        seed (int, optional): Seed of the random generators. Defaults to 0.
+        **kwargs: Additional arguments of generate_user
+
+    Returns:
+        pandas.DataFrame: Waypoints of all the users, user after user
+    """
+    return pd.concat(iter_users(users, days, seed, **kwargs), ignore_index=True)
+
+def generate_points(n_points, days=1, sampling_interval=10, seed=0, **kwargs) -> pd.DataFrame:
+    """Generates about n_points waypoints, adding whole users until the target is reached
+
+    Args:
+        n_points (int): Target number of waypoints
+        days (int, optional): Number of days per user. Defaults to 1.
+        sampling_interval (float, optional): Seconds between two waypoints. Defaults to 10.
+        seed (int, optional): Seed of the random generators. Defaults to 0.
+        **kwargs: Additional arguments of generate_user
+
+    Returns:
+        pandas.DataFrame: Waypoints of int(ceil(n_points / points per user)) users
+    """
+    points_per_user = days * 24 * 3600 / sampling_interval
+    users = max(int(np.ceil(n_points / points_per_user)), 1)
+    return generate(users, days, seed, sampling_interval=sampling_interval, **kwargs)
+
+def write_gtfs(directory, routes=10, stops_per_route=20, trips_per_route=60, seed=0, origin=ORIGIN, start_date='20220101', end_date='20221231'):
+    """Writes a GTFS feed of radial lines around the origin, with weekday and weekend services, readable by GTFS_Helper
+
+    Args:
+        directory (str): Directory where the .txt files are written
+        routes (int, optional): Number of lines. Defaults to 10.
+        stops_per_route (int, optional): Number of stops of each line. Defaults to 20.
+        trips_per_route (int, optional): Number of trips of each line and service, in both directions. Defaults to 60.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+        origin ((float, float), optional): Center of the area. Defaults to ORIGIN.
+        start_date (str, optional): First day of the services, as YYYYMMDD. Defaults to '20220101'.
+        end_date (str, optional): Last day of the services, as YYYYMMDD. Defaults to '20221231'.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    bearings = rng.uniform(0, 2 * np.pi, routes)
+    distances = (np.arange(stops_per_route) - stops_per_route // 2) * STOP_SPACING_M['Transit']
+    route_ids = np.repeat(['R{}'.format(route) for route in range(routes)], stops_per_route)
+    stop_ids = np.array(['S{}_{}'.format(route, stop) for route in range(routes) for stop in range(stops_per_route)])
+    latitudes, longitudes = _offset(origin, np.outer(np.cos(bearings), distances).ravel(), np.outer(np.sin(bearings), distances).ravel())
+    pd.DataFrame({'stop_id': stop_ids, 'stop_name': stop_ids, 'stop_lat': latitudes, 'stop_lon': longitudes}).to_csv(
+        os.path.join(directory, 'stops.txt'), index=False)
+
+    pd.DataFrame({'service_id': ['WD', 'WE'],
+                  'monday': [1, 0], 'tuesday': [1, 0], 'wednesday': [1, 0], 'thursday': [1, 0], 'friday': [1, 0],
+                  'saturday': [0, 1], 'sunday': [0, 1],
+                  'start_date': [start_date, start_date], 'end_date': [end_date, end_date]}).to_csv(
+        os.path.join(directory, 'calendar.txt'), index=False)
+    pd.DataFrame({'service_id': ['WD', 'WE'], 'date': [start_date] * 2, 'exception_type': [2, 1]}).to_csv(
+        os.path.join(directory, 'calendar_dates.txt'), index=False)
+
+    hop_s = _travel_time_s('Transit', STOP_SPACING_M['Transit'])
+    trips = []
+    stop_times = []
+    for route in range(routes):
+        route_stops = stop_ids[route * stops_per_route:(route + 1) * stops_per_route]
+        for service, first, last in (('WD', 5, 24), ('WE', 7, 23)):
+            departures = np.sort(rng.uniform(first * 3600, last * 3600, trips_per_route)).astype(np.int64)
+            for trip, departure in enumerate(departures):
+                trip_id = 'T{}_{}_{}'.format(route, service, trip)
+                direction = trip % 2
+                trips.append(('R{}'.format(route), service, trip_id, direction))
+                ordered = route_stops if direction == 0 else route_stops[::-1]
+                arrivals = departure + np.round(np.arange(stops_per_route) * hop_s).astype(np.int64)
+                stop_times.append(pd.DataFrame({'trip_id': trip_id, 'arrival_time': arrivals,
+                                                'departure_time': arrivals + int(STOP_DWELL_S['Transit']),
+                                                'stop_id': ordered, 'stop_sequence': np.arange(1, stops_per_route + 1)}))
+    pd.DataFrame(trips, columns=['route_id', 'service_id', 'trip_id', 'direction_id']).to_csv(
+        os.path.join(directory, 'trips.txt'), index=False)
+
+    stop_times = pd.concat(stop_times, ignore_index=True)
+    for column in ('arrival_time', 'departure_time'):
+        seconds = stop_times[column].values
+        stop_times[column] = ['{:02d}:{:02d}:{:02d}'.format(s // 3600, s % 3600 // 60, s % 60) for s in seconds]
+    stop_times.to_csv(os.path.join(directory, 'stop_times.txt'), index=False)
+
+def write_road_network(path, size=30, spacing_m=200.0, oneway_every=5, origin=ORIGIN):
+    """Writes a grid of streets around the origin as a GeoJSON file, readable by map_matching.read_road_graph. Every oneway_every-th street is one-way, alternately in each direction.
+
+    Args:
+        path (str): Path of the GeoJSON file
+        size (int, optional): Number of streets in each direction. Defaults to 30.
+        spacing_m (float, optional): Distance between two parallel streets, in meters. Defaults to 200.
+        oneway_every (int, optional): Period of the one-way streets, 0 for none. Defaults to 5.
+        origin ((float, float), optional): Center of the grid. Defaults to ORIGIN.
+    """
+    along = (np.arange(size) - (size - 1) / 2) * spacing_m
+    features = []
+    for street, across in enumerate(along):
+        oneway = oneway_every and street % oneway_every == 0
+        for name, north_m, east_m in (('Street', np.full(size, across), along), ('Avenue', along, np.full(size, across))):
+            latitudes, longitudes = _offset(origin, north_m, east_m)
+            features.append({'type': 'Feature',
+                             'properties': {'name': '{} {}'.format(name, street), 'highway': 'residential',
+                                            'oneway': ('yes' if street % (2 * oneway_every) == 0 else '-1') if oneway else 'no'},
+                             'geometry': {'type': 'LineString', 'coordinates': np.column_stack((longitudes, latitudes)).tolist()}})
+    with open(path, 'w') as file:
+        json.dump({'type': 'FeatureCollection', 'features': features}, file)
+
+def generate_road_legs(graph, legs=100, edges_per_leg=20, spacing_m=30.0, noise_m=5, seed=0, user_id='user_0', return_truth=False):
+    """Generates Track legs driven along random walks on a road graph, respecting one-way streets and avoiding U-turns, e.g. to benchmark map matching
+
+    Args:
+        graph (mobilipy.map_matching.RoadGraph): Road graph
+        legs (int, optional): Number of legs. Defaults to 100.
+        edges_per_leg (int, optional): Number of edges of each walk. Defaults to 20.
+        spacing_m (float, optional): Distance between two points of a leg, in meters. Defaults to 30.
+        noise_m (float, optional): Standard deviation of the GPS noise, in meters. Defaults to 5.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+        user_id (str, optional): user's ID. Defaults to 'user_0'.
+        return_truth (bool, optional): Specifies whether the length of each walk, in meters, should be returned too. Defaults to False.
+
+    Returns:
+        pandas.DataFrame: Legs, in legs.LEG_FEATURES. If return_truth is True, a numpy.ndarray with the length of each walk is returned as well.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    lengths = np.zeros(legs)
+    started_at = pd.Timestamp('2022-01-03 08:00', tz='UTC')
+    for leg in range(legs):
+        edge = rng.integers(graph.n_edges)
+        nodes = [graph.edge_sources[edge], graph.edge_targets[edge]]
+        for _ in range(edges_per_leg - 1):
+            outgoing = graph.edge_targets[graph.offsets[nodes[-1]]:graph.offsets[nodes[-1] + 1]]
+            forward = outgoing[outgoing != nodes[-2]]
+            if forward.shape[0] == 0:
+                break
+            nodes.append(rng.choice(forward))
+
+        x, y = geodesy.project(graph.latitudes[nodes], graph.longitudes[nodes], graph.latitude0, graph.longitude0)
+        travelled = np.concatenate(([0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+        positions = np.arange(0, travelled[-1], spacing_m)
+        latitudes, longitudes = geodesy.unproject(np.interp(positions, travelled, x) + rng.normal(0, noise_m, positions.shape[0]),
+                                                  np.interp(positions, travelled, y) + rng.normal(0, noise_m, positions.shape[0]),
+                                                  graph.latitude0, graph.longitude0)
+        lengths[leg] = positions[-1]
+        finished_at = started_at + pd.Timedelta(seconds=positions[-1] / SPEEDS_MS['Car'])
+        rows.append((user_id, started_at, finished_at, 'Track', 'Car', np.nan, list(np.column_stack((latitudes, longitudes)))))
+        started_at = finished_at + pd.Timedelta(minutes=10)
+
+    df = pd.DataFrame(rows, columns=['user_id', 'started_at', 'finished_at', 'type', 'detected_mode', 'purpose', 'geometry'])
+    return (df, lengths) if return_truth else df
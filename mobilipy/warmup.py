@@ -0,0 +1,71 @@
+import os
+import time
+import tempfile
+import importlib
+import numpy as np
+
+from mobilipy import geodesy, gtfs_helper, map_matching, poi_detection, preparation, segmentation, synthetic
+
+LAZY_DEPENDENCIES = ['sklearn.cluster', 'sklearn.neighbors', 'scipy.sparse', 'skfuzzy', 'shapely.geometry', 'numba.typed']
+"""Dependencies imported on first use by the pipeline stages"""
+
+PLOT_DEPENDENCIES = ['folium']
+"""Dependencies imported on first use by the plot module"""
+
+
+def _precompile_kernels():
+    """Calls each numba kernel once on tiny inputs with the types used by the pipeline. With cache=True, the machine code is written next to the modules and later processes load it instead of compiling."""
+    coordinates = np.array([47.37, 47.38])
+    geodesy.distance(coordinates, coordinates, coordinates + 1e-3, coordinates)
+    geodesy.distance_to(coordinates, coordinates, 47.37, 8.54)
+    geodesy.consecutive_distance(coordinates, coordinates)
+    geodesy.project(coordinates, coordinates, 47.37, 8.54)
+    geodesy.unproject(coordinates, coordinates, 47.37, 8.54)
+    segmentation._dbscan_from_graph(np.array([0, 1, 2], dtype=np.int64), np.array([0, 1], dtype=np.int64), np.ones(2), 1)
+    segmentation._stay_points(np.array([0.0, 1.0]), coordinates, coordinates, np.ones(2), 25.0, 300.0)
+    preparation._spike_mask(np.array([0.0, 1.0]), coordinates, coordinates, 70.0)
+    preparation._stationary_runs(np.array([0.0, 1.0]), coordinates, coordinates, 10.0, 300.0)
+    poi_detection.assign_cell(coordinates, coordinates, 0.2)
+    graph = map_matching.RoadGraph.from_lines([np.column_stack((coordinates, coordinates)), np.array([[47.38, 47.38], [47.38, 47.39]])])
+    map_matching.MapMatcher(graph).match_points(coordinates, coordinates)
+
+    from mobilipy import plot
+    plot._time_aware_douglas_peucker(coordinates, coordinates, np.array([0.0, 1.0]), 1.0)
+
+def _precompile_gtfs():
+    """Runs a journey query on a tiny synthetic feed, compiling the connection scan"""
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic.write_gtfs(directory, routes=1, stops_per_route=3, trips_per_route=2)
+        gtfs = gtfs_helper.GTFS_Helper(directory, cache_transfers=False)
+        gtfs.earliest_arrival('S0_0', 'S0_2', '2022-01-04', '08:00:00')
+
+def warmup(gtfs=True, plotting=False) -> dict:
+    """Imports the lazily loaded dependencies and compiles the numba kernels ahead of time, e.g. in a pool initializer, or once in a container build so that later processes start from the on-disk cache. Worker processes forked from a warm parent inherit its compiled kernels, while those of a fork server or of spawn load them from the cache.
+
+    Args:
+        gtfs (bool, optional): Specifies whether the GTFS journey planner should be compiled too. Defaults to True.
+        plotting (bool, optional): Specifies whether the plotting dependencies should be imported too. Defaults to False.
+
+    Returns:
+        dict: Seconds spent on each step
+    """
+    timings = {}
+    start = time.perf_counter()
+    for name in LAZY_DEPENDENCIES + (PLOT_DEPENDENCIES if plotting else []):
+        importlib.import_module(name)
+    timings['imports'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _precompile_kernels()
+    timings['kernels'] = time.perf_counter() - start
+
+    if gtfs:
+        start = time.perf_counter()
+        _precompile_gtfs()
+        timings['gtfs'] = time.perf_counter() - start
+    return timings
+
+
+if __name__ == '__main__':
+    for step, seconds in warmup(plotting=True).items():
+        print('{}: {:.2f} s'.format(step, seconds))